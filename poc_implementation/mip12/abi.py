@@ -0,0 +1,295 @@
+import struct
+from typing import Callable, List, Tuple, Union
+
+from poc_implementation.mip12.execution_context import ExecutionContext
+from poc_implementation.mip12.encoding import Encoding, INT_ENCODING
+
+STRUCT_BYTE_ORDER = '>'  # INT_ENCODING
+ABI_STR_ENCODING = 'utf-8'
+
+
+class Field:
+    """
+    A parameter of an app function. Fixed fields have a struct format and are decoded together with the fixed fields next to them,
+    variable fields decode themselves
+    """
+    FORMAT: Union[str, None] = None
+
+    def encode(self, value) -> bytes:
+        raise Exception("{} cannot be encoded".format(type(self).__name__))
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[object, int]:
+        """
+        :return: (value, offset of the next field)
+        """
+        raise Exception("{} cannot be decoded".format(type(self).__name__))
+
+    def from_struct(self, value):
+        return value
+
+    def to_struct(self, value):
+        return value
+
+
+class Fixed(Field):
+    def __init__(self, _format: str):
+        self.FORMAT = _format
+        self.struct = struct.Struct(STRUCT_BYTE_ORDER + _format)
+
+    def encode(self, value) -> bytes:
+        return self.struct.pack(self.to_struct(value))
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[object, int]:
+        return self.from_struct(self.struct.unpack_from(data, offset)[0]), offset + self.struct.size
+
+
+class Bytes(Fixed):
+    """
+    Fixed length bytes, e.g. an address
+    """
+
+    def __init__(self, length: int):
+        super().__init__('{}s'.format(length))
+        self.length = length
+
+    def to_struct(self, value: bytes) -> bytes:
+        if len(value) != self.length:
+            raise Exception("Expected {} bytes, got {}".format(self.length, len(value)))
+        return value
+
+
+class Symbol(Bytes):
+    """
+    Fixed length string, e.g. an asset symbol
+    """
+
+    def from_struct(self, value: bytes) -> str:
+        return value.decode(ABI_STR_ENCODING)
+
+    def to_struct(self, value: Union[str, bytes]) -> bytes:
+        return super().to_struct(value.encode(ABI_STR_ENCODING) if type(value) == str else value)
+
+
+class Int(Field):
+    """
+    Unsigned integer of any size: length prefix + big endian bytes (Encoding.pack_int)
+    """
+
+    def encode(self, value: int) -> bytes:
+        return Encoding.pack_int(value)
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[int, int]:
+        l, offset = Encoding.read_length(data, offset)
+        if offset + l > len(data):
+            raise Exception("Truncated parameters")
+        return int.from_bytes(data[offset:offset + l], INT_ENCODING), offset + l
+
+
+class VarBytes(Field):
+    """
+    Length prefix + bytes
+    """
+
+    def encode(self, value: bytes) -> bytes:
+        return Encoding.pack_length(len(value)) + value
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[bytes, int]:
+        l, offset = Encoding.read_length(data, offset)
+        if offset + l > len(data):
+            raise Exception("Truncated parameters")
+        return data[offset:offset + l], offset + l
+
+
+class ByteList(Field):
+    """
+    Count(1) + one byte per item, e.g. the token modes
+    """
+
+    def encode(self, value: List[int]) -> bytes:
+        return bytes([len(value)]) + bytes(value)
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[List[int], int]:
+        if offset >= len(data):
+            raise Exception("Truncated parameters")
+        l = data[offset]
+        offset += 1
+        if offset + l > len(data):
+            raise Exception("Truncated parameters")
+        return list(data[offset:offset + l]), offset + l
+
+
+class Array(Field):
+    """
+    MAM array (Encoding.array_to_bytes) of items laid out by the item schema. Items are kept as raw bytes when there is no item schema
+    """
+
+    def __init__(self, item: 'Schema' = None):
+        self.item = item
+
+    def encode(self, value: list) -> bytes:
+        return Encoding.array_to_bytes(value if self.item is None else [self.item.encode(*item) for item in value])
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[list, int]:
+        if offset >= len(data):
+            return [], offset
+        size, header_length = Encoding.read_array_size(data[offset:])
+        offset += header_length
+        items = []
+        for i in range(size):
+            l, offset = Encoding.read_length(data, offset)
+            if offset + l > len(data):
+                raise Exception("Truncated parameters")
+            entry = data[offset:offset + l]
+            if self.item is None:
+                execution_context.op(1)
+                items.append(entry)
+            else:
+                items.append(self.item.decode(entry, execution_context))
+            offset += l
+        return items, offset
+
+
+class Sized(Field):
+    """
+    Length prefix + a variable field
+    """
+
+    def __init__(self, field: Field):
+        self.field = field
+
+    def encode(self, value) -> bytes:
+        data = self.field.encode(value)
+        return Encoding.pack_length(len(data)) + data
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[object, int]:
+        l, offset = Encoding.read_length(data, offset)
+        if offset + l > len(data):
+            raise Exception("Truncated parameters")
+        return self.field.decode(data[:offset + l], offset, execution_context)[0], offset + l
+
+
+class Repeated(Field):
+    """
+    Records laid out by the item schema repeated up to the end of the parameters. Must be the last field
+    """
+
+    def __init__(self, item: 'Schema'):
+        self.item = item
+
+    def encode(self, value: list) -> bytes:
+        return b''.join(self.item.encode(*item) for item in value)
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[list, int]:
+        items = []
+        while offset < len(data):
+            item, offset = self.item.decode_from(data, offset, execution_context)
+            items.append(item)
+        return items, offset
+
+
+class Optional(Field):
+    """
+    Field that can be left out at the end of the parameters
+    """
+
+    def __init__(self, field: Field, default):
+        self.field = field
+        self.default = default
+
+    def encode(self, value) -> bytes:
+        return bytes(0) if value is None else self.field.encode(value)
+
+    def decode(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[object, int]:
+        if offset >= len(data):
+            return self.default, offset
+        return self.field.decode(data, offset, execution_context)
+
+
+SYMBOL = Symbol(4)
+ADDRESS = Bytes(12)
+U8 = Fixed('B')
+U16 = Fixed('H')
+APP_ID = Fixed('I')
+AMOUNT = Fixed('Q')
+INT = Int()
+BYTES = VarBytes()
+BYTE_LIST = ByteList()
+
+
+class Schema:
+    """
+    Layout of the parameters of an app function. The decoder is built once: consecutive fixed fields are decoded
+    with a single struct, variable fields in the same pass.
+    Decoding costs one simple op per field, the items of arrays and repeated records are charged as well
+    """
+
+    def __init__(self, *fields: Field):
+        self.fields = fields
+        self.steps: List[Callable[[bytes, int, list, ExecutionContext], int]] = []
+        fixed: List[Field] = []
+        for field in list(fields) + [None]:
+            if field is not None and field.FORMAT is not None:
+                fixed.append(field)
+                continue
+            if len(fixed) > 0:
+                self.steps.append(Schema.struct_step(fixed))
+                fixed = []
+            if field is not None:
+                self.steps.append(Schema.field_step(field))
+
+    @staticmethod
+    def struct_step(fields: List[Field]) -> Callable[[bytes, int, list, ExecutionContext], int]:
+        s = struct.Struct(STRUCT_BYTE_ORDER + ''.join(field.FORMAT for field in fields))
+        converters = [field.from_struct for field in fields]
+
+        def step(data: bytes, offset: int, values: list, execution_context: ExecutionContext) -> int:
+            values.extend(convert(value) for convert, value in zip(converters, s.unpack_from(data, offset)))
+            return offset + s.size
+        return step
+
+    @staticmethod
+    def field_step(field: Field) -> Callable[[bytes, int, list, ExecutionContext], int]:
+        def step(data: bytes, offset: int, values: list, execution_context: ExecutionContext) -> int:
+            value, offset = field.decode(data, offset, execution_context)
+            values.append(value)
+            return offset
+        return step
+
+    def encode(self, *values) -> bytes:
+        if len(values) != len(self.fields):
+            raise Exception("Expected {} parameters, got {}".format(len(self.fields), len(values)))
+        return b''.join(field.encode(value) for field, value in zip(self.fields, values))
+
+    def decode_from(self, data: bytes, offset: int, execution_context: ExecutionContext) -> Tuple[tuple, int]:
+        execution_context.op(len(self.fields))
+        values = []
+        try:
+            for step in self.steps:
+                offset = step(data, offset, values, execution_context)
+        except struct.error:
+            raise Exception("Truncated parameters")
+        return tuple(values), offset
+
+    def decode(self, data: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> tuple:
+        values, offset = self.decode_from(data, 0, execution_context)
+        if offset != len(data):
+            raise Exception("Unexpected {} trailing bytes in parameters".format(len(data) - offset))
+        return values
+
+
+class Function:
+    """
+    Entry of the dispatch table of an app: selector -> Function(name of the handler method, parameters layout)
+    The handler is called with (caller, execution context, *decoded parameters)
+    """
+
+    def __init__(self, name: str, *fields: Field):
+        self.name = name
+        self.schema = Schema(*fields)
+
+    def encode(self, *values) -> bytes:
+        return self.schema.encode(*values)
+
+    def decode(self, data: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> tuple:
+        return self.schema.decode(data, execution_context)
+
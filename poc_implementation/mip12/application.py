@@ -2,8 +2,14 @@ from poc_implementation.mip12.execution_context import ExecutionContext
 
 
 class ApplicationInstance:
+    TEMPLATE_TYPE: int = None
+    FUNCTIONS: dict = {}  # dispatch table: function selector -> abi.Function
+
     def execute(self, caller: bytes, function_selector: int, function_param: bytes, execution_context: ExecutionContext):
-        pass
+        function = self.FUNCTIONS.get(function_selector)
+        if function is None:
+            raise Exception("No such method")
+        return getattr(self, function.name)(caller, execution_context, *function.decode(function_param, execution_context))
 
     def init(self, instance_id: int, instance_address: bytes) -> 'ApplicationInstance':
         pass
@@ -17,6 +23,15 @@ class ApplicationInstance:
     def get_max_storage(self) -> int:
         pass
 
+    def get_template_type(self) -> int:
+        return self.TEMPLATE_TYPE
+
+    def end_block(self, execution_context: ExecutionContext):
+        """
+        Called by the MAM once per block, after the block transactions. No gas is charged to any user
+        """
+        pass
+
 
 class ApplicationTemplate:
     def __init__(self, _type: int):
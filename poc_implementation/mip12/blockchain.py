@@ -1,7 +1,146 @@
+import time
+import hashlib
+from typing import List
+
+HASH_LENGTH = 32
+BNUM_LENGTH = 8
+TIME_LENGTH = 8
+TX_COUNT_LENGTH = 4
+TRAILER_INT_ENCODING = 'big'
+TRAILER_LENGTH = HASH_LENGTH + BNUM_LENGTH + TIME_LENGTH + HASH_LENGTH + HASH_LENGTH + TX_COUNT_LENGTH + HASH_LENGTH
+STATE_ROOT_ELEMENT_LENGTH = 384  # 3072 bits elements of the state root group
+STATE_ROOT_MODULUS = (1 << (8 * STATE_ROOT_ELEMENT_LENGTH)) - 1103717  # largest 3072 bits safe prime, as MuHash3072
+
+
+class BlockTrailer:
+    """
+    Block trailer: previous block hash(32) + bnum(8) + time(8) + state root(32) + tx root(32) + tx count(4) + block hash(32).
+    The block hash is the hash of the rest of the trailer, trailers are chained by the previous block hash
+    """
+
+    def __init__(self, previous_hash: bytes, bnum: int, stime: int, state_root: bytes, tx_root: bytes, tx_count: int, block_hash: bytes = None):
+        self.previous_hash = previous_hash
+        self.bnum = bnum
+        self.stime = stime
+        self.state_root = state_root
+        self.tx_root = tx_root
+        self.tx_count = tx_count
+        self.block_hash = self.compute_hash() if block_hash is None else block_hash
+
+    def body(self) -> bytes:
+        return self.previous_hash + self.bnum.to_bytes(BNUM_LENGTH, TRAILER_INT_ENCODING) + self.stime.to_bytes(TIME_LENGTH, TRAILER_INT_ENCODING) \
+            + self.state_root + self.tx_root + self.tx_count.to_bytes(TX_COUNT_LENGTH, TRAILER_INT_ENCODING)
+
+    def compute_hash(self) -> bytes:
+        return hashlib.sha256(self.body()).digest()
+
+    def to_bytes(self) -> bytes:
+        return self.body() + self.block_hash
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'BlockTrailer':
+        if len(data) != TRAILER_LENGTH:
+            raise Exception("Invalid trailer length {}".format(len(data)))
+        offset = 0
+        previous_hash = data[offset:offset + HASH_LENGTH]
+        offset += HASH_LENGTH
+        bnum = int.from_bytes(data[offset:offset + BNUM_LENGTH], TRAILER_INT_ENCODING)
+        offset += BNUM_LENGTH
+        stime = int.from_bytes(data[offset:offset + TIME_LENGTH], TRAILER_INT_ENCODING)
+        offset += TIME_LENGTH
+        state_root = data[offset:offset + HASH_LENGTH]
+        offset += HASH_LENGTH
+        tx_root = data[offset:offset + HASH_LENGTH]
+        offset += HASH_LENGTH
+        tx_count = int.from_bytes(data[offset:offset + TX_COUNT_LENGTH], TRAILER_INT_ENCODING)
+        offset += TX_COUNT_LENGTH
+        return BlockTrailer(previous_hash, bnum, stime, state_root, tx_root, tx_count, data[offset:offset + HASH_LENGTH])
+
+    @staticmethod
+    def merkle_root(hashes: List[bytes]) -> bytes:
+        if len(hashes) <= 0:
+            return bytes(HASH_LENGTH)
+        while len(hashes) > 1:
+            if len(hashes) % 2 == 1:
+                hashes = hashes + [hashes[-1]]
+            hashes = [hashlib.sha256(hashes[i] + hashes[i + 1]).digest() for i in range(0, len(hashes), 2)]
+        return hashes[0]
+
+
+class StateRoot:
+    """
+    Incremental hash of the state: product modulo a 3072 bits prime of the hashes of the (key, value) entries (MuHash).
+    An additive hash modulo 2^256 (AdHash) falls to Wagner's generalised birthday attack, finding a set of entries with a given sum
+    is far easier than a hash collision. Finding a product modulo a large prime is a discrete logarithm problem instead.
+    Entries are hashed to 3072 bits with SHAKE256. Removed entries are multiplied into a denominator so that a write costs
+    two multiplications, whatever the size of the state. The single modular inversion is made by digest, once a block
+    """
+
+    def __init__(self):
+        self.numerator = 1
+        self.denominator = 1
+
+    @staticmethod
+    def leaf(encoded_key: bytes, value: bytes) -> int:
+        data = len(encoded_key).to_bytes(2, TRAILER_INT_ENCODING) + encoded_key + value
+        return int.from_bytes(hashlib.shake_256(data).digest(STATE_ROOT_ELEMENT_LENGTH), TRAILER_INT_ENCODING) % STATE_ROOT_MODULUS
+
+    def update(self, encoded_key: bytes, old_value: bytes, new_value: bytes):
+        if len(old_value) > 0:
+            self.denominator = self.denominator * StateRoot.leaf(encoded_key, old_value) % STATE_ROOT_MODULUS
+        if len(new_value) > 0:
+            self.numerator = self.numerator * StateRoot.leaf(encoded_key, new_value) % STATE_ROOT_MODULUS
+
+    def digest(self) -> bytes:
+        value = self.numerator * pow(self.denominator, -1, STATE_ROOT_MODULUS) % STATE_ROOT_MODULUS
+        self.numerator = value  # the denominator is folded in so that it does not need to be inverted again
+        self.denominator = 1
+        return hashlib.sha256(value.to_bytes(STATE_ROOT_ELEMENT_LENGTH, TRAILER_INT_ENCODING)).digest()
+
 
 class Blockchain:
+    """
+    Chain of the block trailers. The hashes of the transactions of the block being built are collected until it is mined
+    """
+
     def __init__(self):
         self.bnum = 0
+        self.last_hash = bytes(HASH_LENGTH)
+        self.trailers: List[BlockTrailer] = []
+        self.tx_hashes: List[bytes] = []
+
+    def add_transaction(self, tx_hash: bytes):
+        self.tx_hashes.append(tx_hash)
 
-    def mine_block(self):
+    def mine_block(self, state_root: bytes = bytes(HASH_LENGTH), stime: int = None) -> BlockTrailer:
+        trailer = BlockTrailer(self.last_hash, self.bnum, int(time.time()) if stime is None else stime, state_root,
+                               BlockTrailer.merkle_root(self.tx_hashes), len(self.tx_hashes))
+        self.tx_hashes = []
+        self.add_trailer(trailer)
+        return trailer
+
+    def add_trailer(self, trailer: BlockTrailer):
+        """
+        Append the trailer of the next block, checking its hash and its link to the last block
+        """
+        if trailer.bnum != self.bnum:
+            raise Exception("Expected trailer of block {}, got {}".format(self.bnum, trailer.bnum))
+        if trailer.previous_hash != self.last_hash:
+            raise Exception("Trailer of block {} does not link to the previous block".format(trailer.bnum))
+        if trailer.compute_hash() != trailer.block_hash:
+            raise Exception("Invalid hash for the trailer of block {}".format(trailer.bnum))
+        self.trailers.append(trailer)
+        self.last_hash = trailer.block_hash
         self.bnum += 1
+
+    def rollback(self, count: int):
+        """
+        Remove the trailers of the last count blocks, the block being built is discarded
+        """
+        if count < 0 or count > len(self.trailers):
+            raise Exception("Cannot roll back {} blocks of a chain of {} trailers".format(count, len(self.trailers)))
+        if count > 0:
+            del self.trailers[-count:]
+        self.bnum -= count
+        self.last_hash = self.trailers[-1].block_hash if len(self.trailers) > 0 else bytes(HASH_LENGTH)
+        self.tx_hashes = []
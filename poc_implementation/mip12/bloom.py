@@ -0,0 +1,85 @@
+import math
+import hashlib
+from typing import Iterable
+
+BLOOM_MAGIC = b'MIP12BLM'
+BLOOM_CAPACITY = 1 << 16  # keys a filter is sized for
+BLOOM_FALSE_POSITIVE_RATE = 0.01
+BLOOM_INT_ENCODING = 'big'
+BLOOM_INT_LENGTH = 8
+
+
+class BloomFilter:
+    """
+    Bloom filter over storage keys (bytes). might_contain is False only for keys that were never added, so a negative lookup
+    does not have to reach the storage. Keys cannot be removed: a deleted key is a false positive until the filter is rebuilt.
+
+    The filter is sized for capacity keys at false_positive_rate. The k bit positions of a key are derived from a single
+    blake2b digest (double hashing).
+    Saved as: magic + bit count(8) + hash count(8) + capacity(8) + key count(8) + bits
+    """
+
+    def __init__(self, capacity: int = BLOOM_CAPACITY, false_positive_rate: float = BLOOM_FALSE_POSITIVE_RATE):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.bit_count = max(8, int(-capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def positions(self, key: bytes) -> Iterable[int]:
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], BLOOM_INT_ENCODING)
+        h2 = int.from_bytes(digest[8:], BLOOM_INT_ENCODING) | 1
+        return ((h1 + i * h2) % self.bit_count for i in range(self.hash_count))
+
+    def add(self, key: bytes):
+        added = False
+        for position in self.positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+
+    def might_contain(self, key: bytes) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+    def is_full(self) -> bool:
+        return self.count > self.capacity
+
+    @staticmethod
+    def build(keys: Iterable[bytes], capacity: int = BLOOM_CAPACITY, false_positive_rate: float = BLOOM_FALSE_POSITIVE_RATE) -> 'BloomFilter':
+        bloom_filter = BloomFilter(capacity, false_positive_rate)
+        for key in keys:
+            bloom_filter.add(key)
+        return bloom_filter
+
+    def to_bytes(self) -> bytes:
+        return BLOOM_MAGIC + b''.join(i.to_bytes(BLOOM_INT_LENGTH, BLOOM_INT_ENCODING) for i in [self.bit_count, self.hash_count, self.capacity, self.count]) + self.bits
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'BloomFilter':
+        if data[:len(BLOOM_MAGIC)] != BLOOM_MAGIC:
+            raise Exception("Not a bloom filter")
+        offset = len(BLOOM_MAGIC)
+        bit_count, hash_count, capacity, count = (int.from_bytes(data[offset + i * BLOOM_INT_LENGTH:offset + (i + 1) * BLOOM_INT_LENGTH], BLOOM_INT_ENCODING) for i in range(4))
+        offset += 4 * BLOOM_INT_LENGTH
+        if len(data) - offset != (bit_count + 7) // 8:
+            raise Exception("Corrupted bloom filter")
+        bloom_filter = BloomFilter(capacity)
+        bloom_filter.bit_count = bit_count
+        bloom_filter.hash_count = hash_count
+        bloom_filter.bits = bytearray(data[offset:])
+        bloom_filter.count = count
+        return bloom_filter
+
+    def save(self, path: str):
+        with open(path, 'wb') as f:
+            f.write(self.to_bytes())
+
+    @staticmethod
+    def load(path: str) -> 'BloomFilter':
+        with open(path, 'rb') as f:
+            return BloomFilter.from_bytes(f.read())
@@ -0,0 +1,131 @@
+from typing import Literal
+
+from poc_implementation.mip12.execution_context import ExecutionContext
+
+INT_ENCODING: Literal['big', 'little'] = "big"
+DATA_LENGTH = 8
+
+# Storage encodings. Lengths are written on DATA_LENGTH bytes (fixed) or as varints (compact).
+# A fixed length always starts with a 0x00 byte while a varint always starts with its high bit set so readers handle both
+ENCODING_VERSION_FIXED = 1
+ENCODING_VERSION_VARINT = 2
+VARINT_FLAG = 0x80
+VARINT_MORE = 0x40
+ARRAY_EXTENDED_SIZE = 0xFF
+
+
+class Encoding:
+    """
+    Length prefixes, packed integers and arrays of the app and account storages.
+    Shared by the MAM and the schemas of the app functions, exposed by the MAM under the same names
+    """
+
+    VERSION = ENCODING_VERSION_FIXED  # encoding of the data written from now on
+
+    @staticmethod
+    def int_byte_size(value: int):
+        b = (value.bit_length() + 7) // 8
+        if b > (1 << (11 << DATA_LENGTH)) - 1:
+            raise Exception("Overflow")
+        return b
+
+    @staticmethod
+    def pack_int(value: int) -> bytes:
+        assert type(value) == int
+        l = Encoding.int_byte_size(value)
+        return Encoding.pack_length(l) + value.to_bytes(l, INT_ENCODING)
+
+    @staticmethod
+    def unpack_int(packed: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> int:
+        execution_context.op(8)
+        if len(packed) <= 0:
+            return 0
+        l, offset = Encoding.read_length(packed, 0)
+        return int.from_bytes(packed[offset:offset + l], INT_ENCODING)
+
+    @staticmethod
+    def pack_length(length: int) -> bytes:
+        """
+        Encode a length prefix with the current Encoding.VERSION.
+        Varint: the first byte holds the flag, a 'more' bit and the 6 lowest bits, then LEB128 (7 bits per byte, lowest first)
+        """
+        if Encoding.VERSION == ENCODING_VERSION_FIXED:
+            return length.to_bytes(DATA_LENGTH, INT_ENCODING)
+        if length < VARINT_MORE:
+            return bytes([VARINT_FLAG | length])
+        buffer = bytearray([VARINT_FLAG | VARINT_MORE | (length & (VARINT_MORE - 1))])
+        length >>= 6
+        while length >= 0x80:
+            buffer.append(0x80 | (length & 0x7F))
+            length >>= 7
+        buffer.append(length)
+        return bytes(buffer)
+
+    @staticmethod
+    def read_length(data: bytes, offset: int, execution_context: ExecutionContext = ExecutionContext.no_op()) -> (int, int):
+        """
+        Decode a length prefix written with any encoding version
+        :return: (length, offset of the data following the prefix)
+        """
+        execution_context.op(2)
+        if offset >= len(data) or not data[offset] & VARINT_FLAG:
+            return int.from_bytes(data[offset:offset + DATA_LENGTH], INT_ENCODING), offset + DATA_LENGTH
+        b = data[offset]
+        offset += 1
+        length = b & (VARINT_MORE - 1)
+        if b & VARINT_MORE:
+            shift = 6
+            while True:
+                execution_context.op(1)
+                b = data[offset]
+                offset += 1
+                length |= (b & 0x7F) << shift
+                shift += 7
+                if not b & 0x80:
+                    break
+        return length, offset
+
+    @staticmethod
+    def read_array_size(array_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> (int, int):
+        """
+        :return: (number of entries, offset of the first entry)
+        """
+        size = array_storage[0]
+        if size == ARRAY_EXTENDED_SIZE and len(array_storage) > 1 and array_storage[1] & VARINT_FLAG:
+            return Encoding.read_length(array_storage, 1, execution_context)
+        return size, 1
+
+    @staticmethod
+    def parse_array(array_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()):
+        execution_context.op(3)
+        if len(array_storage) <= 0:
+            return []
+        execution_context.op(1)
+        entries = []
+        execution_context.op(4)
+        size, offset = Encoding.read_array_size(array_storage, execution_context)
+        for i in range(size):
+            execution_context.op(1)
+            execution_context.op(5)
+            l, offset = Encoding.read_length(array_storage, offset)
+            execution_context.op(6)
+            entries.append(array_storage[offset:offset+l])
+            execution_context.op(3)
+            offset += l
+        return entries
+
+    @staticmethod
+    def array_to_bytes(array: list, execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
+        execution_context.op(2)
+        array = [e for e in array if len(e) > 0]
+        if len(array) < ARRAY_EXTENDED_SIZE:
+            buffer = len(array).to_bytes(1, INT_ENCODING)
+        elif Encoding.VERSION == ENCODING_VERSION_VARINT:
+            buffer = ARRAY_EXTENDED_SIZE.to_bytes(1, INT_ENCODING) + Encoding.pack_length(len(array))
+        elif len(array) == ARRAY_EXTENDED_SIZE:
+            buffer = len(array).to_bytes(1, INT_ENCODING)
+        else:
+            raise Exception("Array is too large")
+        for e in array:
+            buffer += Encoding.pack_length(len(e)) + e
+        return bytes(buffer)
@@ -0,0 +1,77 @@
+import multiprocessing
+from typing import List, Tuple, Union
+
+from poc_implementation.mip12.mochimo_application_machine import MAM
+from poc_implementation.mip12.snapshot import Snapshot
+
+ESTIMATE_CHUNK_SIZE = 8  # requests sent to a worker at once
+
+# state of a worker process: the MAM loaded from the last snapshot it was asked to use
+worker_mam: Union[MAM, None] = None
+worker_snapshot_path: Union[str, None] = None
+
+
+def estimate_gas(request: Tuple[str, bytes, int, int, bytes]) -> Tuple[int, Union[str, None]]:
+    """
+    Worker side of the GasEstimator: dry run a call on the MAM of the worker
+    :param request: (snapshot path, caller address, app id, function selector, function parameters)
+    :return: (gas used, error)
+    """
+    global worker_mam, worker_snapshot_path
+    snapshot_path, caller_address, app_id, function_selector, function_parameters = request
+    if snapshot_path != worker_snapshot_path:
+        MAM.INSTANCE = None  # a forked worker inherits the MAM of the node
+        worker_mam = None
+        worker_mam = Snapshot.load(snapshot_path, reindex=False)
+        worker_mam.reindex_app_storage_sizes()  # a dry run checks the max storage of the instances, the other node side indexes are not needed
+        worker_snapshot_path = snapshot_path
+    try:
+        gas_used, gas_cost, error, events = worker_mam.call(True, caller_address, None, app_id, function_selector, function_parameters)
+    except Exception as e:
+        return 0, str(e)
+    return gas_used, error
+
+
+class GasEstimator:
+    """
+    Estimates the gas of calls (EVM 'estimate_gas') away from the node. The node writes a snapshot of its state and hands it to the estimator,
+    every worker process of the pool loads the snapshot in its own MAM and dry runs the requests on it. Snapshots are mapped
+    so the workers share the pages of the state they read.
+
+    Estimates never touch the MAM of the node: blocks are applied while the workers run, estimates are made against the state of the
+    last snapshot given to update. Requests submitted after update are run on the new snapshot, each worker loads it on its next request
+    """
+
+    def __init__(self, snapshot_path: str, processes: int = None):
+        self.snapshot_path = snapshot_path
+        self.pool = multiprocessing.Pool(processes)
+
+    def update(self, snapshot_path: str):
+        """
+        Estimate on a newer snapshot from now on. The previous snapshot file must be kept until the pending estimates are collected
+        """
+        self.snapshot_path = snapshot_path
+
+    def submit(self, requests: List[Tuple[bytes, int, int, bytes]]) -> object:
+        """
+        Start the dry runs of a batch of requests
+        :param requests: [(caller address, app id, function selector, function parameters), ...]
+        :return: a pending estimation to pass to collect
+        """
+        return self.pool.map_async(estimate_gas, [(self.snapshot_path,) + tuple(request) for request in requests], chunksize=ESTIMATE_CHUNK_SIZE)
+
+    def collect(self, pending: object) -> List[Tuple[int, Union[str, None]]]:
+        """
+        Wait for a pending estimation
+        :return: (gas used, error) of each request, error is None if the dry run succeeded
+        """
+        return pending.get()
+
+    def estimate(self, requests: List[Tuple[bytes, int, int, bytes]]) -> List[Tuple[int, Union[str, None]]]:
+        return self.collect(self.submit(requests))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,157 @@
+import hashlib
+from typing import Dict, List, Tuple
+
+INT_ENCODING = "big"
+APP_INSTANCE_ID_LENGTH = 4
+ITEM_LENGTH = 2
+COUNT_LENGTH = 1
+DATA_LENGTH = 4
+
+
+class Event:
+    """
+    An event emitted by an app instance during a transaction.
+    topics[0] is the event name (ex: b'Transfer'), the other topics and the addresses are indexed by the block bloom filter
+    """
+
+    def __init__(self, app_id: int, topics: List[bytes], addresses: List[bytes], data: bytes = bytes(0)):
+        self.app_id = app_id
+        self.topics = topics
+        self.addresses = addresses
+        self.data = data
+
+    def to_bytes(self) -> bytes:
+        buffer = self.app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
+        for items in (self.topics, self.addresses):
+            buffer += len(items).to_bytes(COUNT_LENGTH, INT_ENCODING)
+            for item in items:
+                buffer += len(item).to_bytes(ITEM_LENGTH, INT_ENCODING) + item
+        return buffer + len(self.data).to_bytes(DATA_LENGTH, INT_ENCODING) + self.data
+
+    @staticmethod
+    def from_bytes(storage: bytes, offset: int = 0) -> Tuple['Event', int]:
+        app_id = int.from_bytes(storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
+        offset += APP_INSTANCE_ID_LENGTH
+        lists = []
+        for i in range(2):
+            items = []
+            count = storage[offset]
+            offset += COUNT_LENGTH
+            for j in range(count):
+                l = int.from_bytes(storage[offset:offset + ITEM_LENGTH], INT_ENCODING)
+                offset += ITEM_LENGTH
+                items.append(bytes(storage[offset:offset + l]))
+                offset += l
+            lists.append(items)
+        l = int.from_bytes(storage[offset:offset + DATA_LENGTH], INT_ENCODING)
+        offset += DATA_LENGTH
+        data = bytes(storage[offset:offset + l])
+        offset += l
+        return Event(app_id, lists[0], lists[1], data), offset
+
+    def bloom_items(self) -> List[bytes]:
+        return [BloomFilter.app_item(self.app_id)] + [BloomFilter.topic_item(t) for t in self.topics] + [BloomFilter.address_item(a) for a in self.addresses]
+
+    def __repr__(self):
+        return 'Event(app={}, topics={}, addresses={}, data={})'.format(self.app_id, self.topics, [a.hex() for a in self.addresses], self.data.hex())
+
+
+class BloomFilter:
+    """
+    2048 bits bloom filter with 3 hash functions taken from a sha256 digest, as the Ethereum logs bloom
+    """
+    SIZE = 2048
+    HASH_COUNT = 3
+
+    def __init__(self, bits: int = 0):
+        self.bits = bits
+
+    @staticmethod
+    def positions(item: bytes) -> List[int]:
+        digest = hashlib.sha256(item).digest()
+        return [int.from_bytes(digest[2 * i:2 * i + 2], INT_ENCODING) % BloomFilter.SIZE for i in range(BloomFilter.HASH_COUNT)]
+
+    def add(self, item: bytes):
+        for p in BloomFilter.positions(item):
+            self.bits |= 1 << p
+
+    def might_contain(self, item: bytes) -> bool:
+        return all(self.bits >> p & 1 for p in BloomFilter.positions(item))
+
+    def to_bytes(self) -> bytes:
+        return self.bits.to_bytes(BloomFilter.SIZE // 8, INT_ENCODING)
+
+    @staticmethod
+    def app_item(app_id: int) -> bytes:
+        return b'app:' + app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
+
+    @staticmethod
+    def topic_item(topic: bytes) -> bytes:
+        return b'topic:' + topic
+
+    @staticmethod
+    def address_item(address: bytes) -> bytes:
+        return b'address:' + address
+
+
+class EventLog:
+    """
+    Events of each block, stored encoded along with a bloom filter over their app id, topics and addresses.
+    Queries only decode the blocks whose bloom filter matches
+    """
+
+    def __init__(self):
+        self.blocks: Dict[int, Tuple[BloomFilter, bytearray]] = {}
+
+    def add_events(self, bnum: int, events: List[Event]):
+        if len(events) <= 0:
+            return
+        bloom, storage = self.blocks.setdefault(bnum, (BloomFilter(), bytearray()))
+        for event in events:
+            for item in event.bloom_items():
+                bloom.add(item)
+            storage += event.to_bytes()
+
+    def truncate(self, bnum: int):
+        """
+        Drop the events of the blocks from bnum on
+        """
+        for b in [b for b in self.blocks if b >= bnum]:
+            del self.blocks[b]
+
+    def get_events(self, bnum: int) -> List[Event]:
+        if bnum not in self.blocks:
+            return []
+        storage = self.blocks[bnum][1]
+        events = []
+        offset = 0
+        while offset < len(storage):
+            event, offset = Event.from_bytes(storage, offset)
+            events.append(event)
+        return events
+
+    def query(self, from_bnum: int, to_bnum: int, app_id: int = None, topics: List[bytes] = (), address: bytes = None) -> List[Tuple[int, Event]]:
+        """
+        :return: [(bnum, event), ...] of the events of blocks from_bnum to to_bnum (included) matching all the criteria
+        """
+        items = [BloomFilter.topic_item(t) for t in topics]
+        if app_id is not None:
+            items.append(BloomFilter.app_item(app_id))
+        if address is not None:
+            items.append(BloomFilter.address_item(address))
+
+        matches = []
+        for bnum in range(from_bnum, to_bnum + 1):
+            if bnum not in self.blocks:
+                continue
+            if not all(self.blocks[bnum][0].might_contain(item) for item in items):
+                continue
+            for event in self.get_events(bnum):
+                if app_id is not None and event.app_id != app_id:
+                    continue
+                if any(t not in event.topics for t in topics):
+                    continue
+                if address is not None and address not in event.addresses:
+                    continue
+                matches.append((bnum, event))
+        return matches
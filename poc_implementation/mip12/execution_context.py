@@ -1,21 +1,68 @@
+from typing import List
+
+from poc_implementation.mip12.events import Event
 from poc_implementation.mip12.storage import Storage
+from poc_implementation.mip12.ledger import BalanceLedger
+
+
+class WriteStats:
+    """
+    Write amplification of persisted execution contexts: bytes of the values written to storage against bytes that actually changed.
+    Buffered values identical to the stored ones are not written
+    """
+
+    def __init__(self):
+        self.keys = 0  # keys buffered
+        self.keys_skipped = 0  # keys buffered with an unchanged value
+        self.bytes_buffered = 0  # bytes of the buffered values
+        self.bytes_written = 0  # bytes of the values written
+        self.bytes_changed = 0  # bytes of the changed ranges of the values written plus the bytes removed from shrunk values
+
+    def add(self, stats: 'WriteStats'):
+        self.keys += stats.keys
+        self.keys_skipped += stats.keys_skipped
+        self.bytes_buffered += stats.bytes_buffered
+        self.bytes_written += stats.bytes_written
+        self.bytes_changed += stats.bytes_changed
+
+    def write_amplification(self) -> float:
+        if self.bytes_changed <= 0:
+            return 1.0 if self.bytes_written <= 0 else float('inf')
+        return self.bytes_written / self.bytes_changed
+
+    def __repr__(self):
+        return "{} keys ({} unchanged), {} bytes buffered, {} written, {} changed, write amplification {:.2f}".format(
+            self.keys, self.keys_skipped, self.bytes_buffered, self.bytes_written, self.bytes_changed, self.write_amplification())
 
 
 class ExecutionContext:
+    """
+    Buffers the reads and writes of a transaction and accounts for its gas.
+    MCM balances are read and written with read_balance/write_balance: they are buffered apart from the account storages
+    and the MCM entries of the account storages are derived from them when the MAM persists the context
+    """
     GAS_SIMPLE_OP = 1
     GAS_READ_STORAGE = GAS_SIMPLE_OP * 10
     GAS_WRITE_STORAGE_BASE = GAS_READ_STORAGE * 10
     GAS_WRITE_STORAGE_PER_BYTE = 10
+    GAS_EMIT_BASE = GAS_READ_STORAGE * 2
+    GAS_EMIT_PER_TOPIC = GAS_READ_STORAGE
+    GAS_EMIT_PER_BYTE = GAS_SIMPLE_OP
+    GAS_WRITE_BALANCE = GAS_WRITE_STORAGE_BASE + GAS_WRITE_STORAGE_PER_BYTE * 8
 
-    def __init__(self, max_gas: int, app_storage: Storage, account_storage: Storage, no_op: bool = False):
+    def __init__(self, max_gas: int, app_storage: Storage, account_storage: Storage, no_op: bool = False, balance_ledger: BalanceLedger = None):
         self.max_gas = max_gas
         self.app_storage = app_storage
         self.app_storage_buffer = {}
         self.account_storage = account_storage
         self.account_storage_buffer = {}
+        self.balance_ledger = balance_ledger
+        self.balance_buffer = {}
+        self.events: List[Event] = []
         self.total_gas = 0
         self.error = None
         self.no_op = no_op
+        self.write_stats = WriteStats()
 
     def _check_gas(self):
         if self.no_op:
@@ -33,10 +80,7 @@ class ExecutionContext:
         self.total_gas += ExecutionContext.GAS_READ_STORAGE
         self._check_gas()
         if key not in self.app_storage_buffer:
-            if key not in self.app_storage.db:
-                return bytes(0)
-            else:
-                return self.app_storage.read(key)
+            return self.app_storage.read(key)
         else:
             return self.app_storage_buffer[key]
 
@@ -50,10 +94,7 @@ class ExecutionContext:
             self.total_gas += ExecutionContext.GAS_READ_STORAGE
             self._check_gas()
         if key not in self.account_storage_buffer:
-            if key not in self.account_storage.db:
-                return bytes(0)
-            else:
-                return self.account_storage.read(key)
+            return self.account_storage.read(key)
         else:
             return self.account_storage_buffer[key]
 
@@ -63,16 +104,74 @@ class ExecutionContext:
             self._check_gas()
         self.account_storage_buffer[key] = value
 
+    def read_balance(self, address: bytes, update_gas=True) -> int:
+        if update_gas:
+            self.total_gas += ExecutionContext.GAS_READ_STORAGE
+            self._check_gas()
+        if address in self.balance_buffer:
+            return self.balance_buffer[address]
+        return self.balance_ledger.get(address)
+
+    def write_balance(self, address: bytes, balance: int, update_gas=True):
+        if update_gas:
+            self.total_gas += ExecutionContext.GAS_WRITE_BALANCE
+            self._check_gas()
+        if balance < 0:
+            raise Exception("Negative balance")
+        self.balance_buffer[address] = balance
+
+    def read_balances(self, addresses: List[bytes], update_gas=True) -> List[int]:
+        """
+        Read the balances of many addresses, those that are not buffered are read from the ledger in bulk
+        """
+        if update_gas:
+            self.total_gas += ExecutionContext.GAS_READ_STORAGE * len(addresses)
+            self._check_gas()
+        unbuffered = [address for address in addresses if address not in self.balance_buffer]
+        balances = dict(zip(unbuffered, self.balance_ledger.get_many(unbuffered)))
+        return [self.balance_buffer[address] if address in self.balance_buffer else balances[address] for address in addresses]
+
+    def credit_balances(self, addresses: List[bytes], amounts: List[int], update_gas=True):
+        balances = self.read_balances(addresses, update_gas)
+        if update_gas:
+            self.total_gas += ExecutionContext.GAS_WRITE_BALANCE * len(addresses)
+            self._check_gas()
+        for address, balance, amount in zip(addresses, balances, amounts):
+            self.balance_buffer[address] = balance + amount
+
+    def emit(self, app_id: int, topics: List[bytes], addresses: List[bytes], data: bytes = bytes(0)):
+        if self.no_op:
+            return
+        self.total_gas += ExecutionContext.GAS_EMIT_BASE + ExecutionContext.GAS_EMIT_PER_TOPIC * (len(topics) + len(addresses)) \
+            + ExecutionContext.GAS_EMIT_PER_BYTE * (sum(len(t) for t in topics) + sum(len(a) for a in addresses) + len(data))
+        self._check_gas()
+        self.events.append(Event(app_id, topics, addresses, data))
+
     def total_gas_used(self):
         if self.no_op:
             raise Exception("NO-OP")
         return self.total_gas
 
-    def persists(self):
-        for key in self.app_storage_buffer:
-            self.app_storage.write(key, self.app_storage_buffer[key])
-        for key in self.account_storage_buffer:
-            self.account_storage.write(key, self.account_storage_buffer[key])
+    def persists(self) -> WriteStats:
+        """
+        Write the buffered values that differ from the stored ones, with their changed ranges. The writes to each storage are a single batch
+        :return: the write amplification of the context
+        """
+        for storage, buffer in [(self.app_storage, self.app_storage_buffer), (self.account_storage, self.account_storage_buffer)]:
+            writes = []
+            for key, value in buffer.items():
+                self.write_stats.keys += 1
+                self.write_stats.bytes_buffered += len(value)
+                old_value = storage.read(key)
+                if old_value == value:
+                    self.write_stats.keys_skipped += 1
+                    continue
+                ranges = Storage.changed_ranges(old_value, value)
+                self.write_stats.bytes_written += len(value)
+                self.write_stats.bytes_changed += sum(end - start for start, end in ranges) + max(0, len(old_value) - len(value))
+                writes.append((key, value, ranges))
+            storage.write_batch(writes)
+        return self.write_stats
 
     @staticmethod
     def no_op():
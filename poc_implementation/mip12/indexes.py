@@ -0,0 +1,273 @@
+import bisect
+import itertools
+from fractions import Fraction
+from typing import Dict, Iterator, List, Set, Tuple, Union
+
+
+class SortedList:
+    """
+    Sorted list kept as a list of buckets of at most 2 * BUCKET_SIZE items along with the last item of each bucket.
+    add and remove bisect the last items then shift the items of a single bucket: O(log n + BUCKET_SIZE) whatever the
+    number of items, where a plain sorted list shifts O(n) items. Iteration is in sorted order
+    """
+    BUCKET_SIZE = 512
+
+    def __init__(self):
+        self.buckets: List[list] = []
+        self.maxes: list = []  # last item of each bucket
+        self.length = 0
+
+    def add(self, item):
+        if len(self.buckets) <= 0:
+            self.buckets.append([item])
+            self.maxes.append(item)
+            self.length += 1
+            return
+        i = min(bisect.bisect_left(self.maxes, item), len(self.maxes) - 1)
+        bucket = self.buckets[i]
+        bisect.insort(bucket, item)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) > 2 * SortedList.BUCKET_SIZE:
+            self.buckets.insert(i + 1, bucket[SortedList.BUCKET_SIZE:])
+            del bucket[SortedList.BUCKET_SIZE:]
+            self.maxes.insert(i, bucket[-1])
+        self.length += 1
+
+    def remove(self, item):
+        i = bisect.bisect_left(self.maxes, item)
+        bucket = self.buckets[i] if i < len(self.buckets) else []
+        j = bisect.bisect_left(bucket, item)
+        if j >= len(bucket) or bucket[j] != item:
+            raise Exception("Item {} not found".format(item))
+        del bucket[j]
+        if len(bucket) > 0:
+            self.maxes[i] = bucket[-1]
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+        self.length -= 1
+
+    def first(self):
+        return self.buckets[0][0]
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.buckets)
+
+    def __len__(self):
+        return self.length
+
+
+class OrderBook:
+    """
+    Node side index of the live offers of a MarketPlace instance.
+    Offers are grouped in books keyed by (goods symbol, price symbol) and sorted by unit price (price amount / goods amount),
+    then by offer id so that offers with the same price are served first in, first out.
+    Only offers trading a single goods asset for a single price asset are indexed
+    """
+
+    def __init__(self):
+        self.books: Dict[Tuple[str, str], SortedList] = {}  # sorted (unit price, offer id)
+        self.offers: Dict[int, Tuple[Tuple[str, str], Tuple[Fraction, int], int, int]] = {}
+
+    def add(self, offer_id: int, goods_symbol: str, goods_amount: int, price_symbol: str, price_amount: int):
+        if offer_id in self.offers:
+            self.remove(offer_id)
+        if goods_amount <= 0:
+            return
+        book_key = (goods_symbol, price_symbol)
+        entry = (Fraction(price_amount, goods_amount), offer_id)
+        self.books.setdefault(book_key, SortedList()).add(entry)
+        self.offers[offer_id] = (book_key, entry, goods_amount, price_amount)
+
+    def remove(self, offer_id: int):
+        if offer_id not in self.offers:
+            return
+        book_key, entry, _, _ = self.offers.pop(offer_id)
+        book = self.books[book_key]
+        book.remove(entry)
+        if len(book) <= 0:
+            del self.books[book_key]
+
+    def best_offer(self, goods_symbol: str, price_symbol: str) -> Union[Tuple[int, int, int], None]:
+        """
+        :return: (offer id, goods amount, price amount) of the cheapest offer or None if the book is empty
+        """
+        book = self.books.get((goods_symbol, price_symbol))
+        if not book:
+            return None
+        offer_id = book.first()[1]
+        return (offer_id,) + self.offers[offer_id][2:]
+
+    def iter_offers(self, goods_symbol: str, price_symbol: str, max_unit_price: Fraction = None) -> Iterator[Tuple[int, int, int]]:
+        """
+        Iterate offers from the cheapest to the most expensive
+        :return: iterator of (offer id, goods amount, price amount)
+        """
+        for unit_price, offer_id in self.books.get((goods_symbol, price_symbol), SortedList()):
+            if max_unit_price is not None and unit_price > max_unit_price:
+                break
+            yield (offer_id,) + self.offers[offer_id][2:]
+
+    def __len__(self):
+        return len(self.offers)
+
+
+class Inbox:
+    """
+    Node side index of the Chat messages: recipient -> senders whose current message is addressed to the recipient.
+    Senders are kept in the order their message was received so that inboxes are paged from the most recent message
+    """
+
+    def __init__(self):
+        self.recipients: Dict[bytes, Dict[bytes, None]] = {}
+
+    def add(self, recipient: bytes, sender: bytes):
+        senders = self.recipients.setdefault(recipient, {})
+        senders.pop(sender, None)
+        senders[sender] = None
+
+    def remove(self, recipient: bytes, sender: bytes):
+        senders = self.recipients.get(recipient)
+        if senders is None:
+            return
+        senders.pop(sender, None)
+        if len(senders) <= 0:
+            del self.recipients[recipient]
+
+    def senders(self, recipient: bytes, start: int = 0, count: int = None) -> List[bytes]:
+        """
+        :return: the senders of the messages to the recipient, most recent first
+        """
+        senders = self.recipients.get(recipient, {})
+        stop = None if count is None else start + count
+        return list(itertools.islice(reversed(senders), start, stop))
+
+    def count(self, recipient: bytes) -> int:
+        return len(self.recipients.get(recipient, {}))
+
+
+class HolderIndex:
+    """
+    Node side index of the holders of the tokens of an Assets instance: symbol -> address -> balance.
+    A rich list sorted by decreasing balance and the circulating supply are maintained along with the balances
+    """
+
+    def __init__(self):
+        self.balances: Dict[str, Dict[bytes, int]] = {}
+        self.rich_lists: Dict[str, SortedList] = {}  # sorted (-balance, address)
+        self.supplies: Dict[str, int] = {}
+
+    def update(self, symbol: str, address: bytes, balance: int):
+        balances = self.balances.setdefault(symbol, {})
+        rich_list = self.rich_lists.setdefault(symbol, SortedList())
+        old_balance = balances.pop(address, 0)
+        if old_balance > 0:
+            rich_list.remove((-old_balance, address))
+        if balance > 0:
+            balances[address] = balance
+            rich_list.add((-balance, address))
+        self.supplies[symbol] = self.supplies.get(symbol, 0) + balance - old_balance
+
+    def balance_of(self, symbol: str, address: bytes) -> int:
+        return self.balances.get(symbol, {}).get(address, 0)
+
+    def holder_count(self, symbol: str) -> int:
+        return len(self.balances.get(symbol, {}))
+
+    def circulating_supply(self, symbol: str) -> int:
+        return self.supplies.get(symbol, 0)
+
+    def top_holders(self, symbol: str, count: int) -> List[Tuple[bytes, int]]:
+        """
+        :return: [(address, balance), ...] sorted by decreasing balance
+        """
+        return [(address, -balance) for balance, address in itertools.islice(self.rich_lists.get(symbol, SortedList()), count)]
+
+
+class StorageSizeIndex:
+    """
+    Node side running byte counters of the state: size of each account storage, of each app entry of an account storage
+    and of the app storage owned by each app instance. Counters are updated with the size deltas of the persisted writes
+    so that size queries cost O(1). Addresses whose account size changed are kept in a dirty set until take_dirty().
+    The keys owned by each app instance (its app storage keys and the addresses holding an entry of the instance) are kept
+    as well, so that the state of a single instance can be visited without a pass over the whole state
+    """
+
+    def __init__(self):
+        self.account_sizes: Dict[bytes, int] = {}
+        self.account_app_sizes: Dict[bytes, Dict[int, int]] = {}
+        self.app_sizes: Dict[int, int] = {}
+        self.app_keys: Dict[int, Set[object]] = {}
+        self.app_addresses: Dict[int, Set[bytes]] = {}
+        self.dirty: Set[bytes] = set()
+
+    def update_account(self, address: bytes, size: int, app_sizes: Dict[int, int]):
+        """
+        :param app_sizes: {app id: size of the entry of the app instance in the account storage}
+        """
+        if self.account_sizes.get(address, 0) != size:
+            self.dirty.add(address)
+        if size > 0:
+            self.account_sizes[address] = size
+        else:
+            self.account_sizes.pop(address, None)
+        old_app_sizes = self.account_app_sizes.get(address, {})
+        for app_id in old_app_sizes:
+            if app_id not in app_sizes:
+                StorageSizeIndex.discard(self.app_addresses, app_id, address)
+        for app_id in app_sizes:
+            if app_id not in old_app_sizes:
+                self.app_addresses.setdefault(app_id, set()).add(address)
+        if len(app_sizes) > 0:
+            self.account_app_sizes[address] = app_sizes
+        else:
+            self.account_app_sizes.pop(address, None)
+
+    def update_app_storage(self, app_id: int, key, old_size: int, new_size: int):
+        size = self.app_sizes.get(app_id, 0) + new_size - old_size
+        if size > 0:
+            self.app_sizes[app_id] = size
+        else:
+            self.app_sizes.pop(app_id, None)
+        if new_size > 0:
+            self.app_keys.setdefault(app_id, set()).add(key)
+        else:
+            StorageSizeIndex.discard(self.app_keys, app_id, key)
+
+    @staticmethod
+    def discard(index: Dict[int, set], app_id: int, key):
+        keys = index.get(app_id)
+        if keys is None:
+            return
+        keys.discard(key)
+        if len(keys) <= 0:
+            del index[app_id]
+
+    def account_size(self, address: bytes) -> int:
+        return self.account_sizes.get(address, 0)
+
+    def account_app_size(self, address: bytes, app_id: int) -> int:
+        return self.account_app_sizes.get(address, {}).get(app_id, 0)
+
+    def app_size(self, app_id: int) -> int:
+        return self.app_sizes.get(app_id, 0)
+
+    def app_storage_keys(self, app_id: int) -> Set[object]:
+        """
+        :return: the non empty app storage keys owned by the app instance
+        """
+        return self.app_keys.get(app_id, set())
+
+    def app_account_addresses(self, app_id: int) -> Set[bytes]:
+        """
+        :return: the addresses whose account storage holds an entry of the app instance
+        """
+        return self.app_addresses.get(app_id, set())
+
+    def take_dirty(self) -> Set[bytes]:
+        """
+        :return: the addresses whose account size changed since the previous call
+        """
+        dirty = self.dirty
+        self.dirty = set()
+        return dirty
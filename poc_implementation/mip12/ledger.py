@@ -0,0 +1,155 @@
+import mmap
+from array import array
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+ADDRESS_LENGTH = 12
+BALANCE_LENGTH = 8
+BALANCES_FILE_SUFFIX = '.balances'
+ADDRESSES_FILE_SUFFIX = '.addresses'
+
+
+class BalanceLedger:
+    """
+    Columnar MCM balances: address -> slot index and a contiguous column of unsigned 64 bits balances.
+    The MCM entry of an account storage is a view of the ledger, refreshed when the balances of an execution context are persisted.
+
+    The column is saved as raw native-endian uint64 next to the addresses column so that a saved ledger can be mapped
+    in memory and paged in on demand. A mapped column is private (copy on write) and is copied to memory when a new slot is added
+    """
+
+    def __init__(self):
+        self.slots: Dict[bytes, int] = {}
+        self.addresses: List[bytes] = []
+        self.balances: Union[array, memoryview] = array('Q')
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __contains__(self, address: bytes):
+        return address in self.slots
+
+    def get(self, address: bytes) -> int:
+        slot = self.slots.get(address)
+        return 0 if slot is None else self.balances[slot]
+
+    def set(self, address: bytes, balance: int):
+        slot = self.slot(address)
+        self.balances[slot] = balance
+
+    def slot(self, address: bytes) -> int:
+        slot = self.slots.get(address)
+        if slot is None:
+            if type(self.balances) != array:
+                self.balances = array('Q', self.balances)
+            slot = len(self.addresses)
+            self.slots[address] = slot
+            self.addresses.append(address)
+            self.balances.append(0)
+        return slot
+
+    def get_many(self, addresses: Iterable[bytes]) -> array:
+        return array('Q', map(self.get, addresses))
+
+    def credit_many(self, addresses: List[bytes], amounts: Iterable[int]):
+        slots = [self.slot(address) for address in addresses]
+        balances = self.balances
+        for slot, balance in zip(slots, map(int.__add__, (balances[slot] for slot in slots), amounts)):
+            balances[slot] = balance
+
+    def debit_many(self, addresses: List[bytes], amounts: Iterable[int]) -> array:
+        """
+        Debit each address of at most its balance
+        :return: the amounts actually debited
+        """
+        slots = [self.slot(address) for address in addresses]
+        balances = self.balances
+        debits = array('Q', map(min, (balances[slot] for slot in slots), amounts))
+        for slot, debit in zip(slots, debits):
+            balances[slot] -= debit
+        return debits
+
+    def items(self) -> Iterator[Tuple[bytes, int]]:
+        return zip(self.addresses, self.balances)
+
+    def save(self, path: str):
+        with open(path + BALANCES_FILE_SUFFIX, 'wb') as f:
+            f.write(self.balances)
+        with open(path + ADDRESSES_FILE_SUFFIX, 'wb') as f:
+            f.write(b''.join(self.addresses))
+
+    @staticmethod
+    def load(path: str) -> 'BalanceLedger':
+        ledger = BalanceLedger()
+        with open(path + ADDRESSES_FILE_SUFFIX, 'rb') as f:
+            addresses = f.read()
+        ledger.addresses = [addresses[i:i + ADDRESS_LENGTH] for i in range(0, len(addresses), ADDRESS_LENGTH)]
+        ledger.slots = {address: slot for slot, address in enumerate(ledger.addresses)}
+        if len(ledger.addresses) > 0:
+            with open(path + BALANCES_FILE_SUFFIX, 'rb') as f:
+                ledger.balances = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)).cast('Q')
+        if len(ledger.balances) != len(ledger.addresses):
+            raise Exception("Corrupted ledger {}".format(path))
+        return ledger
+
+
+class MappedBalanceLedger(BalanceLedger):
+    """
+    Balance ledger over a mapped column of sorted addresses and its column of balances. Mapped addresses are found
+    by binary search so that no per account structure is built when the ledger is opened. The mapped balances are updated in place,
+    new addresses get a slot in memory
+    """
+
+    def __init__(self, mapped_addresses: memoryview, mapped_balances: memoryview):
+        super().__init__()
+        self.mapped_addresses = mapped_addresses
+        self.mapped_balances = mapped_balances
+
+    def __len__(self):
+        return len(self.mapped_balances) + len(self.addresses)
+
+    def __contains__(self, address: bytes):
+        return address in self.slots or self.mapped_slot(address) >= 0
+
+    def mapped_slot(self, address: bytes) -> int:
+        """
+        :return: the slot of address in the mapped columns or -1
+        """
+        low = 0
+        high = len(self.mapped_balances)
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self.mapped_addresses[middle * ADDRESS_LENGTH:(middle + 1) * ADDRESS_LENGTH]) < address:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.mapped_balances) and self.mapped_addresses[low * ADDRESS_LENGTH:(low + 1) * ADDRESS_LENGTH] == address:
+            return low
+        return -1
+
+    def get(self, address: bytes) -> int:
+        if address in self.slots:
+            return super().get(address)
+        slot = self.mapped_slot(address)
+        return 0 if slot < 0 else self.mapped_balances[slot]
+
+    def set(self, address: bytes, balance: int):
+        slot = -1 if address in self.slots else self.mapped_slot(address)
+        if slot < 0:
+            super().set(address, balance)
+        else:
+            self.mapped_balances[slot] = balance
+
+    def credit_many(self, addresses: List[bytes], amounts: Iterable[int]):
+        for address, amount in zip(addresses, amounts):
+            self.set(address, self.get(address) + amount)
+
+    def debit_many(self, addresses: List[bytes], amounts: Iterable[int]) -> array:
+        debits = array('Q', map(min, map(self.get, addresses), amounts))
+        for address, debit in zip(addresses, debits):
+            self.set(address, self.get(address) - debit)
+        return debits
+
+    def items(self) -> Iterator[Tuple[bytes, int]]:
+        for slot in range(len(self.mapped_balances)):
+            yield bytes(self.mapped_addresses[slot * ADDRESS_LENGTH:(slot + 1) * ADDRESS_LENGTH]), self.mapped_balances[slot]
+        yield from super().items()
@@ -1,21 +1,24 @@
 import math
+import hashlib
 import traceback
-from typing import List, Dict, Union, Literal
+from typing import Iterator, List, Dict, Union
 
 from poc_implementation.mip12.application import ApplicationTemplate, ApplicationInstance
 from poc_implementation.mip12.storage import Storage
-from poc_implementation.mip12.blockchain import Blockchain
-from poc_implementation.mip12.execution_context import ExecutionContext
+from poc_implementation.mip12.blockchain import Blockchain, StateRoot
+from poc_implementation.mip12.execution_context import ExecutionContext, WriteStats
+from poc_implementation.mip12.encoding import Encoding, INT_ENCODING
+from poc_implementation.mip12.events import EventLog
+from poc_implementation.mip12.indexes import OrderBook, Inbox, HolderIndex, StorageSizeIndex
+from poc_implementation.mip12.ledger import BalanceLedger
+from poc_implementation.mip12.transaction import Transaction, SignatureVerifier, VERIFY_BATCH_SIZE, FUNCTION_SELECTOR_LENGTH
+from poc_implementation.mip12.abi import Function, Schema, Array, Sized, Repeated, Optional, SYMBOL, ADDRESS, U8, U16, APP_ID, AMOUNT, INT, BYTES, BYTE_LIST
 
 
-INT_ENCODING: Literal['big', 'little'] = "big"
 STR_ENCODING = "utf-8"
 DECIMAL_SCALE = 10000
 APP_INSTANCE_ID_LENGTH = 4
 
-BNUM_LENGTH = 8
-DATA_LENGTH = 8
-
 APP_TEMPLATE_TYPE_MCM = 0
 APP_TEMPLATE_TYPE_ASSETS = 1
 APP_TEMPLATE_TYPE_AMM = 2
@@ -23,12 +26,26 @@ APP_TEMPLATE_TYPE_MARKETPLACE = 3
 APP_TEMPLATE_TYPE_CHAT = 5
 
 MCM_APP_ID = 0
+INSTANCE_ADDRESS_PREFIX = bytes(10)
+INSTANCE_ADDRESS_ID_LENGTH = 2
+REPLAY_CHUNK_SIZE = 4096
+
+KEY_TYPE_APP = 0  # app storage of an app instance
+KEY_TYPE_APP_SUB_KEY = 1  # (app id, sub key) app storage
+KEY_TYPE_ACCOUNT = 2  # account storage
 
 GAS_PRICE = 3
 
 
 class MCM(ApplicationInstance):
+    TEMPLATE_TYPE = APP_TEMPLATE_TYPE_MCM
     BALANCE_LENGTH = 8
+    PUBLIC_KEY_HASH_KEY_PREFIX = b'K'
+
+    FUNCTIONS = {
+        1: Function('create_tag', ADDRESS, AMOUNT),  # create_tag(tag)
+        2: Function('transfer', Array(Schema(AMOUNT, ADDRESS, BYTES))),  # transfer([(amount, destination, memo), ...])
+    }
 
     def __init__(self):
         self.instance_address = None
@@ -49,83 +66,71 @@ class MCM(ApplicationInstance):
     def get_max_storage(self) -> int:
         return self.max_storage
 
-    def execute(self, caller: bytes, function_selector: int, function_param: bytes, execution_context: ExecutionContext):
-        if function_selector == 1:  # create_tag(tag)
-            execution_context.op(3)
-            new_address = function_param[:12]
-            execution_context.op(5)
-            funding = int.from_bytes(function_param[12:12+MCM.BALANCE_LENGTH], INT_ENCODING)
-            execution_context.op(3)
-            if funding < 500:
-                raise Exception("Not enough funding")
-
-            # substract funding from caller
-            caller_account_storage = execution_context.read_account_storage(caller)
-            caller_account_array = MAM.parse_array(caller_account_storage, execution_context)
-            caller_app_storage, caller_mcm_app_index = MAM.get_app_data_from_array(MCM_APP_ID, caller_account_array, execution_context)
-            caller_balance = MCM.get_balance(caller_app_storage, execution_context)
-            execution_context.op(2)
-            if caller_balance < funding:
-                raise Exception("Not enough balance to fund new address")
-            caller_app_storage = MCM.subtract_from_balance(caller_app_storage, funding, execution_context)
-            caller_account_array[caller_mcm_app_index] = caller_app_storage
-            caller_account_storage = MAM.account_array_to_bytes(caller_account_array, execution_context)
-            execution_context.write_account_storage(caller, caller_account_storage)
-
-            new_account_storage = execution_context.read_account_storage(new_address)
-            execution_context.op(3)
-            if len(new_account_storage) > 0:
-                raise Exception("Address {} already exists".format(new_address.hex()))
+    def create_tag(self, caller: bytes, execution_context: ExecutionContext, new_address: bytes, funding: int):
+        execution_context.op(3)
+        if funding < 500:
+            raise Exception("Not enough funding")
+
+        # substract funding from caller
+        caller_balance = execution_context.read_balance(caller)
+        execution_context.op(2)
+        if caller_balance < funding:
+            raise Exception("Not enough balance to fund new address")
+        execution_context.write_balance(caller, caller_balance - funding)
+
+        new_account_storage = execution_context.read_account_storage(new_address)
+        execution_context.op(3)
+        if len(new_account_storage) > 0:
+            raise Exception("Address {} already exists".format(new_address.hex()))
 
+        execution_context.op(4)
+        new_account_storage = funding.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
+        new_account_storage = self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(len(new_account_storage)) + new_account_storage
+        new_account_storage = MAM.account_array_to_bytes([new_account_storage], execution_context)
+        execution_context.write_account_storage(new_address, new_account_storage)
+        execution_context.write_balance(new_address, funding)
+        execution_context.emit(self.instance_id, [b'Transfer'], [caller, new_address], MAM.pack_int(funding))
+
+        return 0
+
+    def transfer(self, caller: bytes, execution_context: ExecutionContext, transfers: list):
+        total = 0
+        credits = {}  # destination -> amount, each account is read and written once whatever the number of transfers to it
+        for amount, destination, memo in transfers:
+            if len(memo) > 64:
+                raise Exception("Memo is too long")
             execution_context.op(4)
-            new_account_storage = funding.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
-            new_account_storage = self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + len(new_account_storage).to_bytes(DATA_LENGTH, INT_ENCODING) + new_account_storage
-            new_account_storage = MAM.account_array_to_bytes([new_account_storage], execution_context)
-            execution_context.write_account_storage(new_address, new_account_storage)
+            total += amount
+            credits[destination] = credits.get(destination, 0) + amount
+            execution_context.emit(self.instance_id, [b'Transfer'], [caller, destination], MAM.pack_int(amount))
 
-            return 0
-        elif function_selector == 2:  # transfer([(amount, destination, memo), ...])
-            transfers = MAM.parse_array(function_param, execution_context)
-            total = 0
-            for tx in transfers:
-                amount = int.from_bytes(tx[:MCM.BALANCE_LENGTH], INT_ENCODING)
-                destination = tx[MCM.BALANCE_LENGTH:MCM.BALANCE_LENGTH+12]
-                l = int.from_bytes(tx[MCM.BALANCE_LENGTH+12:MCM.BALANCE_LENGTH+12+DATA_LENGTH], INT_ENCODING)
-                if l > 64:
-                    raise Exception("Memo is too long")
-                memo = tx[MCM.BALANCE_LENGTH+12+DATA_LENGTH:MCM.BALANCE_LENGTH+12+DATA_LENGTH+l]
-
-                # credit amount to destination
-                destination_account_storage = execution_context.read_account_storage(destination)
-                if len(destination_account_storage) <= 0:
-                    raise Exception("Destination {} not found".format(destination.decode(STR_ENCODING)))
-                destination_account_array = MAM.parse_array(destination_account_storage, execution_context)
-                destination_app_storage, destination_mcm_app_index = MAM.get_app_data_from_array(MCM_APP_ID, destination_account_array, execution_context)
-                destination_app_storage = MCM.add_to_balance(destination_app_storage, amount, execution_context)
-                MAM.set_to_array(destination_app_storage, destination_account_array, destination_mcm_app_index)
-                destination_account_storage = MAM.array_to_bytes(destination_account_array, execution_context)
-                execution_context.write_account_storage(destination, destination_account_storage)
-
-            # subtract total from caller
-            caller_account_storage = execution_context.read_account_storage(caller)
-            caller_account_array = MAM.parse_array(caller_account_storage, execution_context)
-            caller_app_storage, caller_mcm_app_index = MAM.get_app_data_from_array(MCM_APP_ID, caller_account_array, execution_context)
-            caller_balance = MCM.get_balance(caller_app_storage, execution_context)
-            execution_context.op(2)
-            if caller_balance < total:
-                raise Exception("Not enough balance")
-            caller_app_storage = MCM.subtract_from_balance(caller_app_storage, total, execution_context)
-            caller_account_array[caller_mcm_app_index] = caller_app_storage
-            caller_account_storage = MAM.account_array_to_bytes(caller_account_array, execution_context)
-            execution_context.write_account_storage(caller, caller_account_storage)
-        else:
-            raise Exception("No such method")
+        # subtract total from caller
+        caller_balance = execution_context.read_balance(caller)
+        execution_context.op(2)
+        if caller_balance < total:
+            raise Exception("Not enough balance")
+        execution_context.write_balance(caller, caller_balance - total)
+
+        # credit destinations
+        for destination in credits:
+            if len(execution_context.read_account_storage(destination)) <= 0:
+                raise Exception("Destination {} not found".format(destination.hex()))
+        execution_context.credit_balances(list(credits), list(credits.values()))
 
     @staticmethod
     def get_balance(app_account_data: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> int:
         execution_context.op(1)
+        offset = MCM.get_balance_offset(app_account_data, execution_context)
         execution_context.op(6)
-        return int.from_bytes(app_account_data[APP_INSTANCE_ID_LENGTH + DATA_LENGTH:APP_INSTANCE_ID_LENGTH+DATA_LENGTH+MCM.BALANCE_LENGTH], INT_ENCODING)
+        return int.from_bytes(app_account_data[offset:offset+MCM.BALANCE_LENGTH], INT_ENCODING)
+
+    @staticmethod
+    def get_balance_offset(app_account_data: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> int:
+        """
+        :return: offset of the balance in the MCM entry (app id + length + balance)
+        """
+        execution_context.op(2)
+        return MAM.read_length(app_account_data, APP_INSTANCE_ID_LENGTH)[1]
 
     @staticmethod
     def subtract_from_balance(app_account_data: bytes, amount: int, execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
@@ -138,7 +143,8 @@ class MCM(ApplicationInstance):
         if balance < 0:
             raise Exception("Negative balance")
         execution_context.op(6)
-        _copy[APP_INSTANCE_ID_LENGTH+DATA_LENGTH:APP_INSTANCE_ID_LENGTH+DATA_LENGTH+MCM.BALANCE_LENGTH] = balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
+        offset = MCM.get_balance_offset(_copy)
+        _copy[offset:offset+MCM.BALANCE_LENGTH] = balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
         return bytes(_copy)
 
     @staticmethod
@@ -150,7 +156,8 @@ class MCM(ApplicationInstance):
         execution_context.op(2)
         balance += amount
         execution_context.op(6)
-        _copy[APP_INSTANCE_ID_LENGTH + DATA_LENGTH:APP_INSTANCE_ID_LENGTH + DATA_LENGTH + MCM.BALANCE_LENGTH] = balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
+        offset = MCM.get_balance_offset(_copy)
+        _copy[offset:offset + MCM.BALANCE_LENGTH] = balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
         return bytes(_copy)
 
     @staticmethod
@@ -158,14 +165,82 @@ class MCM(ApplicationInstance):
         execution_context.op(1)
         _copy = bytearray(app_account_data)
         execution_context.op(6)
-        _copy[APP_INSTANCE_ID_LENGTH + DATA_LENGTH:APP_INSTANCE_ID_LENGTH + DATA_LENGTH + MCM.BALANCE_LENGTH] = balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
+        offset = MCM.get_balance_offset(_copy)
+        _copy[offset:offset + MCM.BALANCE_LENGTH] = balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
         return bytes(_copy)
 
+    @staticmethod
+    def get_account_balance_offset(account_storage: bytes) -> int:
+        """
+        The MCM entry is the first entry of an account storage as entries are sorted by app id
+        :return: offset of the balance in the account storage or -1 if the account has no MCM entry
+        """
+        if len(account_storage) <= 0:
+            return -1
+        size, offset = MAM.read_array_size(account_storage)
+        if size <= 0:
+            return -1
+        l, offset = MAM.read_length(account_storage, offset)
+        if int.from_bytes(account_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING) != MCM_APP_ID:
+            return -1
+        return MAM.read_length(account_storage, offset + APP_INSTANCE_ID_LENGTH)[1]
+
+    @staticmethod
+    def public_key_hash_storage_key(address: bytes) -> tuple:
+        """
+        App storage key of the hash of the public key that signs the next transaction of address (MIP12B1)
+        """
+        return MCM_APP_ID, MCM.PUBLIC_KEY_HASH_KEY_PREFIX + address
+
+    @staticmethod
+    def accessed_addresses(caller: bytes, function_selector: int, function_parameters: bytes) -> List[bytes]:
+        """
+        Addresses whose account storage an MCM call may read or write, known from its parameters before it is executed.
+        Parameters that cannot be decoded make the call fail, it then only charges the caller
+        :return: [caller, ...] without duplicates
+        """
+        addresses = [caller]
+        try:
+            parameters = MCM.FUNCTIONS[function_selector].decode(function_parameters)
+        except:
+            return addresses
+        if function_selector == 1:
+            addresses.append(parameters[0])
+        elif function_selector == 2:
+            addresses.extend(destination for amount, destination, memo in parameters[0])
+        return list(dict.fromkeys(addresses))
+
+    @staticmethod
+    def get_account_balance(account_storage: bytes) -> Union[int, None]:
+        """
+        :return: the balance of the MCM entry of the account storage or None if the account has no MCM entry
+        """
+        offset = MCM.get_account_balance_offset(account_storage)
+        if offset < 0:
+            return None
+        return int.from_bytes(account_storage[offset:offset + MCM.BALANCE_LENGTH], INT_ENCODING)
+
+    @staticmethod
+    def patch_account_balance(account_storage: bytes, balance: int) -> bytes:
+        """
+        Write the balance in the MCM entry of the account storage in place. The entry is created if the account has none
+        """
+        offset = MCM.get_account_balance_offset(account_storage)
+        if offset < 0:
+            account_array = MAM.parse_array(account_storage)
+            account_array.append(MCM_APP_ID.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(MCM.BALANCE_LENGTH) + balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING))
+            return MAM.account_array_to_bytes(account_array)
+        return account_storage[:offset] + balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING) + account_storage[offset + MCM.BALANCE_LENGTH:]
+
 
 class Assets(ApplicationInstance):
     """
     Internal storage: [(symbol, total supply, options)]
+    Bulk mint cursors: (id, AIRDROP_CURSOR_KEY_PREFIX + symbol) -> last recipient minted
+
+    The node indexes the holders of each token in a HolderIndex
     """
+    TEMPLATE_TYPE = APP_TEMPLATE_TYPE_ASSETS
 
     TYPE_FUNGIBLE = 1
     TYPE_NON_FUNGIBLE = 2
@@ -173,14 +248,28 @@ class Assets(ApplicationInstance):
 
     SYMBOL_LENGTH = 4
 
+    AIRDROP_CURSOR_KEY_PREFIX = b'C'
+    AIRDROP_FLAG_START = 1
+
+    FUNCTIONS = {
+        1: Function('create', SYMBOL, U8, ADDRESS, BYTE_LIST, BYTES),  # create(symbol, type, admin, modes, data)
+        2: Function('mint', SYMBOL, Array(Schema(INT, ADDRESS))),  # mint([(symbol, [(value, recipient), ...]), ...]) value cant be amount of NFT id
+        3: Function('transfer', Array(Schema(SYMBOL, INT, ADDRESS))),  # transfer([(symbol, value, recipient), ...] value cant be amount of NFT id
+        4: Function('set_admin', SYMBOL, ADDRESS),  # setAdmin(symbol, new_admin_address)
+        5: Function('set_modes', SYMBOL, BYTE_LIST),  # setModes([mode, ...])
+        6: Function('bulk_mint', SYMBOL, U8, Repeated(Schema(ADDRESS, INT))),  # bulk_mint(symbol, flags, (recipient, value), (recipient, value), ...)
+    }
+
     def __init__(self):
         self.instance_address = None
         self.instance_id = None
         self.max_storage = 128 * 1024 * 1024
+        self.holder_index = HolderIndex()
 
     def init(self, instance_id: int, instance_address: bytes) -> 'ApplicationInstance':
         self.instance_id = instance_id
         self.instance_address = instance_address
+        MAM.INSTANCE.account_storage.add_listener(self.on_account_storage_write)
         return self
 
     def get_instance_address(self) -> bytes:
@@ -192,104 +281,125 @@ class Assets(ApplicationInstance):
     def get_max_storage(self) -> int:
         return self.max_storage
 
-    def execute(self, caller: bytes, function_selector: int, function_param: bytes, execution_context: ExecutionContext):
-        if function_selector == 1:  # create(symbol, type, admin, modes, data)
-            app_storage = execution_context.read_app_storage(self.instance_id)
-            app_array = MAM.parse_array(app_storage, execution_context)
-            tokens_info = Assets.app_array_to_tokens_info(app_array)
-            new_token = Assets.get_token_info(function_param)
-
-            if new_token[0] in tokens_info:
-                raise Exception("Token already exists")
-
-            if new_token[1] == Assets.TYPE_FUNGIBLE:
-                if new_token[4][0] != 0:
-                    raise Exception("Total supply must be 0")
-                if new_token[4][1] > 18:
-                    raise Exception("Decimal cannot be grater than 18")
-
-                app_array.append(function_param)
-                app_storage = MAM.array_to_bytes(app_array, execution_context)
-                execution_context.write_app_storage(self.instance_id, app_storage)
-            elif new_token[1] == Assets.TYPE_NON_FUNGIBLE:
-                raise Exception("Not implemented")
-            else:
-                raise Exception("Unhandled token type")
-        elif function_selector == 2:  # mint([(symbol, [(value, recipient), ...]), ...]) value cant be amount of NFT id
-            offset = 0
-            symbol = function_param[offset:offset+Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
-            offset += Assets.SYMBOL_LENGTH
-            mint_list = MAM.parse_array(function_param[offset:])
+    def create(self, caller: bytes, execution_context: ExecutionContext, symbol: str, token_type: int, admin: bytes, modes: list, data: bytes):
+        app_storage = execution_context.read_app_storage(self.instance_id)
+        app_array = MAM.parse_array(app_storage, execution_context)
+        tokens_info = Assets.app_array_to_tokens_info(app_array)
+        token_storage = Assets.FUNCTIONS[1].encode(symbol, token_type, admin, modes, data)
+        new_token = Assets.get_token_info(token_storage)
 
-            asset_storage = execution_context.read_app_storage(self.instance_id)
-            app_array = MAM.parse_array(asset_storage, execution_context)
-            tokens_info = Assets.app_array_to_tokens_info(app_array)
+        if new_token[0] in tokens_info:
+            raise Exception("Token already exists")
 
-            if symbol not in tokens_info:
-                raise Exception("Symbol {} not found".format(symbol))
-            token_info = tokens_info[symbol]
-            if not Assets.is_mintable(caller, token_info):
-                raise Exception("Not mintable")
-
-            for mint in mint_list:
-                offset = 0
-                l = int.from_bytes(mint[offset:offset+DATA_LENGTH], INT_ENCODING)
-                offset += DATA_LENGTH
-                amount = int.from_bytes(mint[offset:offset + l], INT_ENCODING)
-                offset += l
-                recipient = mint[offset:offset+12]
-                recipient_storage = execution_context.read_account_storage(recipient)
-                recipient_array = MAM.parse_array(recipient_storage, execution_context)
-                recipient_asset_storage, recipient_asset_index = MAM.get_app_data_from_array(self.instance_id, recipient_array, execution_context)
-                recipient_asset_storage = Assets.update_balance(self.instance_id, recipient_asset_storage, symbol, token_info[1], amount, execution_context)
-                MAM.set_to_array(recipient_asset_storage, recipient_array, recipient_asset_index, execution_context)
-                recipient_storage = MAM.account_array_to_bytes(recipient_array, execution_context)
-                execution_context.write_account_storage(recipient, recipient_storage)
+        if new_token[1] == Assets.TYPE_FUNGIBLE:
+            if new_token[4][0] != 0:
+                raise Exception("Total supply must be 0")
+            if new_token[4][1] > 18:
+                raise Exception("Decimal cannot be grater than 18")
 
-            return 0
-        elif function_selector == 3:  # transfer([(symbol, value, recipient), ...] value cant be amount of NFT id
-            token_params = MAM.parse_array(function_param)
-            asset_storage = execution_context.read_app_storage(self.instance_id)
-            app_array = MAM.parse_array(asset_storage, execution_context)
-            tokens_info = Assets.app_array_to_tokens_info(app_array)
-
-            for tp in token_params:
-                symbol = tp[:Assets.SYMBOL_LENGTH].decode()
-                if symbol not in tokens_info:
-                    raise Exception("Symbol {} not found".format(symbol))
-                token_info = tokens_info[symbol]
-                offset = Assets.SYMBOL_LENGTH
-                l = int.from_bytes(tp[offset:offset + DATA_LENGTH], INT_ENCODING)
-                offset += DATA_LENGTH
-                amount = int.from_bytes(tp[offset:offset+l], INT_ENCODING)
-                offset += l
-                if amount == 0:
-                    continue
-                recipient = tp[offset:offset+12]
-
-                caller_storage = execution_context.read_account_storage(caller)
-                caller_array = MAM.parse_array(caller_storage, execution_context)
-                caller_asset_storage, caller_asset_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
-                if caller_asset_index < 0:
-                    raise Exception("Caller's storage of token {} is empty".format(symbol))
-                caller_asset_storage = Assets.update_balance(self.instance_id, caller_asset_storage, symbol, token_info[1], -amount, execution_context)
-                caller_array[caller_asset_index] = caller_asset_storage
-                caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
-                execution_context.write_account_storage(caller, caller_storage)
-
-                recipient_storage = execution_context.read_account_storage(recipient)
-                recipient_array = MAM.parse_array(recipient_storage, execution_context)
-                recipient_asset_storage, recipient_asset_index = MAM.get_app_data_from_array(self.instance_id, recipient_array, execution_context)
-                recipient_asset_storage = Assets.update_balance(self.instance_id, recipient_asset_storage, symbol, token_info[1], amount, execution_context)
-                MAM.set_to_array(recipient_asset_storage, recipient_array, recipient_asset_index, execution_context)
-                recipient_storage = MAM.account_array_to_bytes(recipient_array, execution_context)
-                execution_context.write_account_storage(recipient, recipient_storage)
-        elif function_selector == 4:  # setAdmin(symbol, new_admin_address)
-            raise Exception("Not implemented")
-        elif function_selector == 5:  # setModes([mode, ...])
+            app_array.append(token_storage)
+            app_storage = MAM.array_to_bytes(app_array, execution_context)
+            execution_context.write_app_storage(self.instance_id, app_storage)
+        elif new_token[1] == Assets.TYPE_NON_FUNGIBLE:
             raise Exception("Not implemented")
         else:
-            raise Exception("No such method")
+            raise Exception("Unhandled token type")
+
+    def mint(self, caller: bytes, execution_context: ExecutionContext, symbol: str, mint_list: list):
+        asset_storage = execution_context.read_app_storage(self.instance_id)
+        app_array = MAM.parse_array(asset_storage, execution_context)
+        tokens_info = Assets.app_array_to_tokens_info(app_array)
+
+        if symbol not in tokens_info:
+            raise Exception("Symbol {} not found".format(symbol))
+        token_info = tokens_info[symbol]
+        if not Assets.is_mintable(caller, token_info):
+            raise Exception("Not mintable")
+
+        for amount, recipient in mint_list:
+            recipient_storage = execution_context.read_account_storage(recipient)
+            recipient_array = MAM.parse_array(recipient_storage, execution_context)
+            recipient_asset_storage, recipient_asset_index = MAM.get_app_data_from_array(self.instance_id, recipient_array, execution_context)
+            recipient_asset_storage = Assets.update_balance(self.instance_id, recipient_asset_storage, symbol, token_info[1], amount, execution_context)
+            MAM.set_to_array(recipient_asset_storage, recipient_array, recipient_asset_index, execution_context)
+            recipient_storage = MAM.account_array_to_bytes(recipient_array, execution_context)
+            execution_context.write_account_storage(recipient, recipient_storage)
+            execution_context.emit(self.instance_id, [b'Mint', symbol.encode(STR_ENCODING)], [recipient], MAM.pack_int(amount))
+
+        return 0
+
+    def transfer(self, caller: bytes, execution_context: ExecutionContext, token_params: list):
+        asset_storage = execution_context.read_app_storage(self.instance_id)
+        app_array = MAM.parse_array(asset_storage, execution_context)
+        tokens_info = Assets.app_array_to_tokens_info(app_array)
+
+        # net changes {address: {symbol: change}}, each account is read and written once whatever the number of transfers to it
+        changes = {caller: {}}
+        for symbol, amount, recipient in token_params:
+            if symbol not in tokens_info:
+                raise Exception("Symbol {} not found".format(symbol))
+            if amount == 0:
+                continue
+
+            execution_context.op(8)
+            changes[caller][symbol] = changes[caller].get(symbol, 0) - amount
+            recipient_changes = changes.setdefault(recipient, {})
+            recipient_changes[symbol] = recipient_changes.get(symbol, 0) + amount
+            execution_context.emit(self.instance_id, [b'Transfer', symbol.encode(STR_ENCODING)], [caller, recipient], MAM.pack_int(amount))
+
+        Assets.apply_balance_changes(self.instance_id, changes, tokens_info, execution_context)
+
+    def set_admin(self, caller: bytes, execution_context: ExecutionContext, symbol: str, new_admin: bytes):
+        raise Exception("Not implemented")
+
+    def set_modes(self, caller: bytes, execution_context: ExecutionContext, symbol: str, modes: list):
+        raise Exception("Not implemented")
+
+    def bulk_mint(self, caller: bytes, execution_context: ExecutionContext, symbol: str, flags: int, recipients: list):
+        # Airdrop streamed over several calls: the recipients are not wrapped in an array so a chunk is not limited to 255 recipients.
+        # Recipients must be sorted in strictly ascending order within and across chunks so that each account is touched once.
+        # The last recipient minted is kept as a cursor so that an interrupted airdrop resumes with the next chunk
+        asset_storage = execution_context.read_app_storage(self.instance_id)
+        app_array = MAM.parse_array(asset_storage, execution_context)
+        tokens_info = Assets.app_array_to_tokens_info(app_array)
+
+        if symbol not in tokens_info:
+            raise Exception("Symbol {} not found".format(symbol))
+        if not Assets.is_mintable(caller, tokens_info[symbol]):
+            raise Exception("Not mintable")
+
+        cursor_key = Assets.airdrop_cursor_storage_key(self.instance_id, symbol)
+        cursor = bytes(0) if flags & Assets.AIRDROP_FLAG_START else execution_context.read_app_storage(cursor_key)
+        changes = {}
+        for recipient, amount in recipients:
+            execution_context.op(3)
+            if recipient <= cursor:
+                raise Exception("Recipients must be sorted after {}".format(cursor.hex()))
+            cursor = recipient
+            changes[recipient] = {symbol: amount}
+            execution_context.emit(self.instance_id, [b'Mint', symbol.encode(STR_ENCODING)], [recipient], MAM.pack_int(amount))
+
+        Assets.apply_balance_changes(self.instance_id, changes, tokens_info, execution_context)
+        execution_context.write_app_storage(cursor_key, cursor)
+        return 0
+
+    @staticmethod
+    def airdrop_cursor_storage_key(app_instance_id: int, symbol: Union[str, bytes]) -> tuple:
+        if type(symbol) == str:
+            symbol = symbol.encode(STR_ENCODING)
+        return app_instance_id, Assets.AIRDROP_CURSOR_KEY_PREFIX + symbol
+
+    def on_account_storage_write(self, address: bytes, old_value: bytes, new_value: bytes):
+        old_entry, old_index = MAM.get_app_data_from_array(self.instance_id, MAM.parse_array(old_value))
+        new_entry, new_index = MAM.get_app_data_from_array(self.instance_id, MAM.parse_array(new_value))
+        if old_entry == new_entry:
+            return
+        old_tokens = Assets.get_account_tokens(old_entry)
+        new_tokens = Assets.get_account_tokens(new_entry)
+        for symbol in set(old_tokens) | set(new_tokens):
+            balance = new_tokens[symbol][2] if symbol in new_tokens else 0
+            if symbol not in old_tokens or old_tokens[symbol][2] != balance:
+                self.holder_index.update(symbol, address, balance)
 
     @staticmethod
     def get_token_info(token_storage: bytes):
@@ -309,28 +419,23 @@ class Assets(ApplicationInstance):
         for i in range(l):
             modes.append(int(token_storage[offset + 1 + i]))
         offset += 1 + l
-        l = int.from_bytes(token_storage[offset:offset+DATA_LENGTH], INT_ENCODING)
-        offset += DATA_LENGTH
+        l, offset = MAM.read_length(token_storage, offset)
 
         data = token_storage[offset:offset+l]
         if token_type == Assets.TYPE_FUNGIBLE:
             offset = 0
-            l = int.from_bytes(data[offset:offset+DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
+            l, offset = MAM.read_length(data, offset)
             total_supply = int.from_bytes(data[offset:offset+l], INT_ENCODING)
             offset += l
-            l = int.from_bytes(data[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
+            l, offset = MAM.read_length(data, offset)
             decimal = int.from_bytes(data[offset:offset + l], INT_ENCODING)
             data = (total_supply, decimal)
         elif token_type == Assets.TYPE_NON_FUNGIBLE:
             offset = 0
-            l = int.from_bytes(data[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
+            l, offset = MAM.read_length(data, offset)
             total_supply = int.from_bytes(data[offset:offset + l], INT_ENCODING)
             offset += l
-            l = int.from_bytes(data[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
+            l, offset = MAM.read_length(data, offset)
             base_url = data[offset:offset + l].decode(STR_ENCODING)
             data = (total_supply, base_url)
         else:
@@ -362,9 +467,10 @@ class Assets(ApplicationInstance):
     def get_account_tokens(account_assets_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> dict:
         execution_context.op(1)
         tokens = {}
-        if len(account_assets_storage) <= APP_INSTANCE_ID_LENGTH+DATA_LENGTH:
+        if len(account_assets_storage) <= APP_INSTANCE_ID_LENGTH:
             return tokens
-        account_asset_array = MAM.parse_array(account_assets_storage[APP_INSTANCE_ID_LENGTH+DATA_LENGTH:], execution_context)
+        l, offset = MAM.read_length(account_assets_storage, APP_INSTANCE_ID_LENGTH)
+        account_asset_array = MAM.parse_array(account_assets_storage[offset:offset+l], execution_context)
         for account_asset in account_asset_array:
             execution_context.op(4)
             symbol = account_asset[:Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
@@ -376,9 +482,8 @@ class Assets(ApplicationInstance):
             execution_context.op(2)
             if token_type == Assets.TYPE_FUNGIBLE:
                 execution_context.op(5)
-                l = int.from_bytes(account_asset[offset:offset+DATA_LENGTH], INT_ENCODING)
                 execution_context.op(2)
-                offset += DATA_LENGTH
+                l, offset = MAM.read_length(account_asset, offset)
                 execution_context.op(5)
                 balance = int.from_bytes(account_asset[offset:offset+l], INT_ENCODING)
                 execution_context.op(1)
@@ -392,6 +497,60 @@ class Assets(ApplicationInstance):
 
         return tokens
 
+    @staticmethod
+    def apply_balance_changes(app_instance_id: int, changes: Dict[bytes, Dict[str, int]], tokens_info: dict, execution_context: ExecutionContext, accounts: Dict[bytes, bytes] = None):
+        """
+        Apply net balance changes {address: {symbol: change}} reading, parsing and writing each account once
+        :param accounts: account storage already read by the caller, to avoid reading it again
+        """
+        accounts = {} if accounts is None else accounts
+        for address in sorted(changes):
+            execution_context.op(2)
+            account_changes = {symbol: change for symbol, change in changes[address].items() if change != 0}
+            if len(account_changes) <= 0:
+                continue
+            account_storage = accounts[address] if address in accounts else execution_context.read_account_storage(address)
+            account_array = MAM.parse_array(account_storage, execution_context)
+            account_asset_storage, account_asset_index = MAM.get_app_data_from_array(app_instance_id, account_array, execution_context)
+            account_asset_storage = Assets.update_balances(app_instance_id, account_asset_storage, account_changes, tokens_info, execution_context)
+            if len(account_asset_storage) > 0:
+                MAM.set_to_array(account_asset_storage, account_array, account_asset_index, execution_context)
+            elif account_asset_index >= 0:
+                account_array.pop(account_asset_index)
+            account_storage = MAM.account_array_to_bytes(account_array, execution_context)
+            execution_context.write_account_storage(address, account_storage)
+            accounts[address] = account_storage
+
+    @staticmethod
+    def update_balances(app_instance_id: int, account_app_storage: bytes, changes: Dict[str, int], tokens_info: dict, execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
+        """
+        Apply several fungible balance changes {symbol: change} to the asset entry of an account with a single parse/serialize
+        :return: the new asset entry, empty if the account does not hold any token anymore
+        """
+        balances = {}
+        for symbol, token in Assets.get_account_tokens(account_app_storage, execution_context).items():
+            balances[symbol] = token[2]
+        for symbol, change in changes.items():
+            execution_context.op(4)
+            if symbol not in tokens_info:
+                raise Exception("Symbol {} not found".format(symbol))
+            if tokens_info[symbol][1] != Assets.TYPE_FUNGIBLE:
+                raise Exception("Not implemented")
+            balance = balances.get(symbol, 0) + change
+            if balance < 0:
+                raise Exception("Invalid amount")
+            balances[symbol] = balance
+
+        account_tokens = []
+        for symbol in sorted(balances):
+            execution_context.op(3)
+            if balances[symbol] > 0:
+                account_tokens.append(symbol.encode(STR_ENCODING) + int(Assets.TYPE_FUNGIBLE).to_bytes(1, INT_ENCODING) + MAM.pack_int(balances[symbol]))
+        if len(account_tokens) <= 0:
+            return bytes(0)
+        array_storage = MAM.array_to_bytes(account_tokens, execution_context)
+        return app_instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(len(array_storage)) + array_storage
+
     @staticmethod
     def update_balance(app_instance_id: int, account_app_storage: bytes, symbol: Union[str, bytes], token_type: int, change_amount: int,  execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
         if type(symbol) == str:
@@ -401,7 +560,7 @@ class Assets(ApplicationInstance):
         data = None
         execution_context.op(3)
 
-        account_tokens = MAM.parse_array(account_app_storage[APP_INSTANCE_ID_LENGTH+DATA_LENGTH:]) if len(account_app_storage) > 0 else []
+        account_tokens = MAM.parse_array(account_app_storage[MAM.read_length(account_app_storage, APP_INSTANCE_ID_LENGTH)[1]:]) if len(account_app_storage) > 0 else []
         for i in range(len(account_tokens)):
             account_token_storage = account_tokens[i]
             account_token_type = account_token_storage[Assets.SYMBOL_LENGTH]
@@ -410,8 +569,7 @@ class Assets(ApplicationInstance):
                 offset = Assets.SYMBOL_LENGTH + 1
                 if account_token_type == Assets.TYPE_FUNGIBLE:
                     execution_context.op(5)
-                    l = int.from_bytes(account_token_storage[offset:offset+DATA_LENGTH], INT_ENCODING)
-                    offset += DATA_LENGTH
+                    l, offset = MAM.read_length(account_token_storage, offset)
                     execution_context.op(2)
                     balance = int.from_bytes(account_token_storage[offset:offset+l], INT_ENCODING)
                     balance += change_amount
@@ -449,27 +607,60 @@ class Assets(ApplicationInstance):
                 # create an entry for asset application
                 execution_context.op(3)
                 app_storage = MAM.account_array_to_bytes([data])
-                return app_instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + len(app_storage).to_bytes(DATA_LENGTH, INT_ENCODING) + app_storage
+                return app_instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(len(app_storage)) + app_storage
 
         execution_context.op(7)
         array_storage = MAM.array_to_bytes(account_tokens, execution_context)
-        return account_app_storage[:APP_INSTANCE_ID_LENGTH] + len(array_storage).to_bytes(DATA_LENGTH, INT_ENCODING) + array_storage
+        return account_app_storage[:APP_INSTANCE_ID_LENGTH] + MAM.pack_length(len(array_storage)) + array_storage
 
 
 class AMM(ApplicationInstance):
     """
     https://docs.uniswap.org/contracts/v2/concepts/core-concepts/pools
+    An AMM instance holds many pools, one per ordered token pair (token A < token B).
+
     Internal storage:
-    token A symbol + tokenA type + token B symbol + token B type + K length + K + Assets app id
-    + fee bps + LP supply length + LP supply + Sum bnum_i length + S bnu,_i
+    app id -> pool count length + pool count
+    (app id, 'P' + token A symbol + token B symbol) -> pool
+    (app id, 'I' + pool index) -> token A symbol + token B symbol
+    The max storage of the instance bounds the total of these entries, it leaves room for MAX_POOLS pools
+
+    Pool:
+    token A symbol + tokenA type + token B symbol + token B type + Assets app id + K length + K
+    + fee bps + LP supply length + LP supply
+    + acc fee A per LP length + acc fee A per LP + acc fee B per LP length + acc fee B per LP
     + token A reserve length + token A reserve + token B reserve length + token B reserve
 
+    Account storage:
+    app id + [(token A symbol + token B symbol + LP length + LP + fee debt A length + fee debt A + fee debt B length + fee debt B), ...]
+
+    Swap fees are not added to the reserves. They are distributed to the LP holders with the MasterChef algorithm:
+    each swap increases the accumulated fee per LP share and each LP holder records a fee debt (LP x accumulated fee per LP)
+    when its position changes. The pending fees of a LP holder are LP x accumulated fee per LP - fee debt.
+    https://github.com/pancakeswap/pancake-farm/blob/master/contracts/MasterChef.sol#L229
     """
+    TEMPLATE_TYPE = APP_TEMPLATE_TYPE_AMM
+
+    ACC_FEE_PRECISION = 10 ** 12
+    POOL_KEY_PREFIX = b'P'
+    POOL_INDEX_KEY_PREFIX = b'I'
+    POOL_INDEX_LENGTH = 4
+    MAX_POOLS = 256
+    POOL_MAX_STORAGE = 256  # bytes of app storage budgeted for a pool and its index entry
+
+    FUNCTIONS = {
+        1: Function('create', SYMBOL, INT, SYMBOL, INT, U16, APP_ID),  # create(token_a, amount_a, token_b, amount_b. fee_bps, assets_app_id)
+        2: Function('set_fee', U16),  # set_fee(fee_bps)
+        3: Function('add_liquidity', SYMBOL, SYMBOL, INT, INT),  # add_liquidity(token_a, token_b, amount_a, max_amount_b)
+        4: Function('withdraw_liquidity', SYMBOL, SYMBOL),  # withdraw_liquidity(token_a, token_b)
+        5: Function('swap', SYMBOL, SYMBOL, INT, INT),  # swap(token_in, token_out, amount_in, min_amount_out)
+        6: Function('claim_fees', SYMBOL, SYMBOL),  # claim_fees(token_a, token_b)
+    }
 
     def __init__(self):
         self.instance_address = None
         self.instance_id = None
-        self.max_storage = 128
+        self.max_storage = AMM.MAX_POOLS * AMM.POOL_MAX_STORAGE
 
     def init(self, instance_id: int, instance_address: bytes) -> 'ApplicationInstance':
         self.instance_id = instance_id
@@ -485,389 +676,426 @@ class AMM(ApplicationInstance):
     def get_max_storage(self) -> int:
         return self.max_storage
 
-    def execute(self, caller: bytes, function_selector: int, function_param: bytes, execution_context: ExecutionContext):
-
-        if function_selector == 1:  # create(token_a, amount_a, token_b, amount_b. fee_bps, assets_app_id)
-            # TODO: this method is called on a governance event only
-            offset = 0
-            token_a = function_param[offset:offset+Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
-            offset += Assets.SYMBOL_LENGTH
-            l = int.from_bytes(function_param[offset:offset+DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            token_a_amount = int.from_bytes(function_param[offset:offset+l], INT_ENCODING)
-            offset += l
-            token_b = function_param[offset:offset + Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
-            offset += Assets.SYMBOL_LENGTH
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            token_b_amount = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
-            offset += l
-            fee_bps = int.from_bytes(function_param[offset:offset+2], INT_ENCODING)
-            offset += 2
-            if fee_bps > 10_000:
-                raise Exception("Invalid fee amount")
-            assets_app_id = int.from_bytes(function_param[offset:offset+APP_INSTANCE_ID_LENGTH], INT_ENCODING)
-
-            # transfer seed token amount from caller to app
-            assets_app = MAM.INSTANCE.id_to_app[assets_app_id]
-            assets_app.execute(caller, 3, MAM.array_to_bytes([
-                token_a.encode(STR_ENCODING) + MAM.pack_int(token_a_amount) + self.instance_address,
-                token_b.encode(STR_ENCODING) + MAM.pack_int(token_b_amount) + self.instance_address,
-            ]), execution_context)
-
-            app_account_storage = execution_context.read_account_storage(self.instance_address)
-            app_account_array = MAM.parse_array(app_account_storage, execution_context)
-            app_account_assets_storage, app_account_assets_index = MAM.get_app_data_from_array(assets_app_id, app_account_array, execution_context)
-            app_tokens = Assets.get_account_tokens(app_account_assets_storage, execution_context)
-            if app_tokens[token_a][1] != Assets.TYPE_FUNGIBLE or app_tokens[token_b][1] != Assets.TYPE_FUNGIBLE:
-                raise Exception("Invalid token type")
-            if app_tokens[token_a][2] < token_a_amount or app_tokens[token_b][2] < token_b_amount:
-                raise Exception("Should never happen")
-            token_a_amount = app_tokens[token_a][2]
-            token_b_amount = app_tokens[token_b][2]
-            k = token_a_amount * token_b_amount
-
-            # If the provider is minting a new pool, the number of liquidity tokens they will receive will equals sqrt(x * y)
-            lp_amount = int(math.sqrt(k))
-
-            # credit lp to caller
-            caller_storage = execution_context.read_account_storage(caller)
-            caller_array = MAM.parse_array(caller_storage, execution_context)
-            caller_array.append(self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
-                                + MAM.INSTANCE.blockchain.bnum.to_bytes(BNUM_LENGTH, INT_ENCODING)
-                                + MAM.pack_int(lp_amount)
-                                )
-            caller_storage = MAM.account_array_to_bytes(caller_array)
-            execution_context.write_account_storage(caller_storage, caller_storage)
-
-            app_storage = token_a.encode(STR_ENCODING) + int(app_tokens[token_a][1]).to_bytes(1, INT_ENCODING) \
-                + token_b.encode(STR_ENCODING) + int(app_tokens[token_b][1]).to_bytes(1, INT_ENCODING) \
-                + assets_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) \
-                + MAM.pack_int(k) \
-                + fee_bps.to_bytes(2, INT_ENCODING) \
-                + MAM.pack_int(lp_amount) \
-                + MAM.pack_int(0) \
-                + MAM.pack_int(token_a_amount) \
-                + MAM.pack_int(token_b_amount)
-            execution_context.write_app_storage(self.instance_id, app_storage)
-        elif function_selector == 2:  # set_fee(fee_bps)
-            raise Exception("Not implemented")
-        elif function_selector == 3:  # add_liquidity(amount_a, max_amount_b)
-            offset = 0
-            l = int.from_bytes(function_param[offset:offset+DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            token_a_amount = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            token_b_max_amount = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
-            offset += l
-
-            app_storage = execution_context.read_app_storage(self.instance_id)
-            offset = 0
-            token_a = app_storage[offset:offset + Assets.SYMBOL_LENGTH]
-            offset += Assets.SYMBOL_LENGTH
-            token_a_type = app_storage[offset]
-            offset += 1
-            token_b = app_storage[offset:offset + Assets.SYMBOL_LENGTH]
-            offset += Assets.SYMBOL_LENGTH
-            token_b_type = app_storage[offset]
-
-            caller_storage = execution_context.read_account_storage(caller)
-            caller_array = MAM.parse_array(caller_storage, execution_context)
-            caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
-            if caller_amm_index >= 0:
-                # withdraw first to reset bnum
-                self.execute(caller, 4, bytes(0), execution_context)
-
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            k = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            assets_app_id = int.from_bytes(app_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
-            offset += APP_INSTANCE_ID_LENGTH
-            fee_bps = int.from_bytes(app_storage[offset:offset + 2], INT_ENCODING)
-            offset += 2
-
-            app_storage_lp_offset = offset
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            total_lp = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            sum_bnum_i = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            token_a_reserve = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            token_b_reserve = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-
-            app_account_storage = execution_context.read_account_storage(self.instance_id)
-            app_account_array = MAM.parse_array(app_account_storage, execution_context)
-            app_account_assets_storage, app_account_assets_index = MAM.get_app_data_from_array(assets_app_id, app_account_array, execution_context)
-            app_tokens = Assets.get_account_tokens(app_account_assets_storage, execution_context)
-
-            token_a_balance = app_tokens[token_a][2]
-            token_b_balance = app_tokens[token_b][2]
-            if token_a_balance < token_a_reserve:
-                raise Exception("Bad debt token A")
-            if token_b_balance < token_b_reserve:
-                raise Exception("Bad debt token B")
-
-            token_b_amount = int(token_a_amount * token_b_reserve * DECIMAL_SCALE / token_a_reserve / DECIMAL_SCALE)
-
-            if token_b_amount > token_b_max_amount:
-                raise Exception("Token B amount limit breached")
-
-            # transfer token_a and token_b from caller to app
-            assets_app = MAM.INSTANCE.id_to_app[assets_app_id]
-            assets_app.execute(caller, 3, MAM.array_to_bytes([
-                token_a.encode(STR_ENCODING) + MAM.pack_int(token_a_amount) + self.instance_address,
-                token_b.encode(STR_ENCODING) + MAM.pack_int(token_b_amount) + self.instance_address,
-            ]), execution_context)
-
-            # https://github.com/Uniswap/v2-core/blob/master/contracts/UniswapV2Pair.sol#L110
-
-            # updating LPs
-            new_total_lp = int(total_lp * (token_a_reserve + token_a_amount) * DECIMAL_SCALE / token_a_reserve / DECIMAL_SCALE)
-            caller_lp = new_total_lp - total_lp
-            total_lp = new_total_lp
-            sum_bnum_i += MAM.INSTANCE.blockchain.bnum
-            token_a_reserve = token_a_reserve + token_a_amount
-            token_b_reserve = token_b_reserve + token_b_amount
-
-            # saving app storage
-            app_storage = app_storage[:app_storage_lp_offset] + MAM.pack_int(total_lp) + MAM.pack_int(sum_bnum_i) \
-                          + MAM.pack_int(token_a_reserve) + MAM.pack_int(token_b_reserve)
-            execution_context.write_app_storage(self.instance_id, app_storage)
+    def create(self, caller: bytes, execution_context: ExecutionContext, token_a: str, token_a_amount: int, token_b: str, token_b_amount: int, fee_bps: int, assets_app_id: int):
+        # TODO: this method is called on a governance event only
+        if fee_bps > 10_000:
+            raise Exception("Invalid fee amount")
 
-            # crediting lp_token to caller
-            caller_storage = execution_context.read_account_storage(caller)
-            caller_array = MAM.parse_array(caller_storage, execution_context)
-            caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+        execution_context.op(3)
+        if token_a == token_b:
+            raise Exception("Invalid token pair")
+        if token_a > token_b:
+            token_a, token_a_amount, token_b, token_b_amount = token_b, token_b_amount, token_a, token_a_amount
+        pair = (token_a + token_b).encode(STR_ENCODING)
+        pool_key = AMM.pool_storage_key(self.instance_id, pair)
+        if len(execution_context.read_app_storage(pool_key)) > 0:
+            raise Exception("Pool {}/{} already exists".format(token_a, token_b))
+
+        # transfer seed token amount from caller to app
+        assets_app = MAM.INSTANCE.id_to_app[assets_app_id]
+        assets_app.execute(caller, 3, MAM.array_to_bytes([
+            token_a.encode(STR_ENCODING) + MAM.pack_int(token_a_amount) + self.instance_address,
+            token_b.encode(STR_ENCODING) + MAM.pack_int(token_b_amount) + self.instance_address,
+        ]), execution_context)
+
+        # the app account holds the reserves and unclaimed fees of every pool sharing the same tokens
+        app_account_storage = execution_context.read_account_storage(self.instance_address)
+        app_account_array = MAM.parse_array(app_account_storage, execution_context)
+        app_account_assets_storage, app_account_assets_index = MAM.get_app_data_from_array(assets_app_id, app_account_array, execution_context)
+        app_tokens = Assets.get_account_tokens(app_account_assets_storage, execution_context)
+        if app_tokens[token_a][1] != Assets.TYPE_FUNGIBLE or app_tokens[token_b][1] != Assets.TYPE_FUNGIBLE:
+            raise Exception("Invalid token type")
+        k = token_a_amount * token_b_amount
+
+        # If the provider is minting a new pool, the number of liquidity tokens they will receive will equals sqrt(x * y)
+        lp_amount = math.isqrt(k)
+        if lp_amount <= 0:
+            raise Exception("Not enough liquidity provided")
+
+        # credit lp to caller
+        caller_storage = execution_context.read_account_storage(caller)
+        caller_array = MAM.parse_array(caller_storage, execution_context)
+        caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+        caller_positions = AMM.parse_app_account_storage(caller_amm_storage, execution_context)
+        caller_positions[pair] = (lp_amount, 0, 0)
+        MAM.set_to_array(AMM.app_account_storage_to_bytes(self.instance_id, caller_positions, execution_context), caller_array, caller_amm_index, execution_context)
+        caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
+        execution_context.write_account_storage(caller, caller_storage)
+
+        pool = {
+            'token_a': token_a,
+            'token_a_type': app_tokens[token_a][1],
+            'token_b': token_b,
+            'token_b_type': app_tokens[token_b][1],
+            'assets_app_id': assets_app_id,
+            'k': k,
+            'fee_bps': fee_bps,
+            'total_lp': lp_amount,
+            'acc_fee_a': 0,
+            'acc_fee_b': 0,
+            'token_a_reserve': token_a_amount,
+            'token_b_reserve': token_b_amount,
+        }
+        execution_context.write_app_storage(pool_key, AMM.pool_to_bytes(pool, execution_context))
+
+        # append the pair to the pool index
+        pool_count = AMM.get_pool_count(execution_context.read_app_storage(self.instance_id), execution_context)
+        execution_context.write_app_storage(AMM.pool_index_storage_key(self.instance_id, pool_count), pair)
+        execution_context.write_app_storage(self.instance_id, MAM.pack_int(pool_count + 1))
+        execution_context.emit(self.instance_id, [b'PoolCreated', pair], [caller], MAM.pack_int(lp_amount))
+
+        return 0
+
+    def set_fee(self, caller: bytes, execution_context: ExecutionContext, fee_bps: int):
+        raise Exception("Not implemented")
+
+    def add_liquidity(self, caller: bytes, execution_context: ExecutionContext, token_a: str, token_b: str, token_a_amount: int, token_b_max_amount: int):
+        if token_a_amount <= 0:
+            raise Exception("Invalid amount")
+
+        pair, pool_key, pool = self.read_pool(token_a, token_b, execution_context)
+        AMM.check_bad_debt(self.instance_address, pool, execution_context)
+
+        # amounts are expressed in the caller's token order, reserves in the pool's
+        side_in, side_other = ('a', 'b') if token_a == pool['token_a'] else ('b', 'a')
+        token_b_amount = token_a_amount * pool['token_' + side_other + '_reserve'] // pool['token_' + side_in + '_reserve']
+        if token_b_amount > token_b_max_amount:
+            raise Exception("Token B amount limit breached")
+
+        caller_storage = execution_context.read_account_storage(caller)
+        caller_array = MAM.parse_array(caller_storage, execution_context)
+        caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+        caller_positions = AMM.parse_app_account_storage(caller_amm_storage, execution_context)
+        caller_lp, caller_fee_debt_a, caller_fee_debt_b = caller_positions.get(pair, (0, 0, 0))
+
+        # harvest pending fees so the fee debt can be reset on the new LP amount
+        caller_fee_a, caller_fee_b = AMM.pending_fees(pool, caller_lp, caller_fee_debt_a, caller_fee_debt_b, execution_context)
+
+        # https://github.com/Uniswap/v2-core/blob/master/contracts/UniswapV2Pair.sol#L110
+        caller_lp_amount = pool['total_lp'] * token_a_amount // pool['token_' + side_in + '_reserve']
+        if caller_lp_amount <= 0:
+            raise Exception("Not enough liquidity provided")
+        caller_lp += caller_lp_amount
+        pool['total_lp'] += caller_lp_amount
+        pool['token_' + side_in + '_reserve'] += token_a_amount
+        pool['token_' + side_other + '_reserve'] += token_b_amount
+        pool['k'] = pool['token_a_reserve'] * pool['token_b_reserve']
+        execution_context.write_app_storage(pool_key, AMM.pool_to_bytes(pool, execution_context))
+
+        # transfer token_a and token_b from caller to app and pending fees from app to caller
+        assets_app = MAM.INSTANCE.id_to_app[pool['assets_app_id']]
+        assets_app.execute(caller, 3, MAM.array_to_bytes([
+            token_a.encode(STR_ENCODING) + MAM.pack_int(token_a_amount) + self.instance_address,
+            token_b.encode(STR_ENCODING) + MAM.pack_int(token_b_amount) + self.instance_address,
+        ]), execution_context)
+        assets_app.execute(self.instance_address, 3, MAM.array_to_bytes([
+            pool['token_a'].encode(STR_ENCODING) + MAM.pack_int(caller_fee_a) + caller,
+            pool['token_b'].encode(STR_ENCODING) + MAM.pack_int(caller_fee_b) + caller,
+        ]), execution_context)
+
+        # crediting lp_token to caller
+        caller_storage = execution_context.read_account_storage(caller)
+        caller_array = MAM.parse_array(caller_storage, execution_context)
+        caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+        caller_positions = AMM.parse_app_account_storage(caller_amm_storage, execution_context)
+        caller_positions[pair] = (caller_lp,
+                                  caller_lp * pool['acc_fee_a'] // AMM.ACC_FEE_PRECISION,
+                                  caller_lp * pool['acc_fee_b'] // AMM.ACC_FEE_PRECISION)
+        MAM.set_to_array(AMM.app_account_storage_to_bytes(self.instance_id, caller_positions, execution_context), caller_array, caller_amm_index, execution_context)
+        caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
+        execution_context.write_account_storage(caller, caller_storage)
+        execution_context.emit(self.instance_id, [b'LiquidityAdded', pair], [caller], MAM.pack_int(caller_lp_amount))
+
+        return 0
+
+    def withdraw_liquidity(self, caller: bytes, execution_context: ExecutionContext, token_a: str, token_b: str):
+        pair, pool_key, pool = self.read_pool(token_a, token_b, execution_context)
+        AMM.check_bad_debt(self.instance_address, pool, execution_context)
+
+        caller_storage = execution_context.read_account_storage(caller)
+        caller_array = MAM.parse_array(caller_storage, execution_context)
+        caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+        caller_positions = AMM.parse_app_account_storage(caller_amm_storage, execution_context)
+        if pair not in caller_positions:
+            raise Exception("Caller has no LP")
+
+        caller_lp, caller_fee_debt_a, caller_fee_debt_b = caller_positions.pop(pair)
+        caller_fee_a, caller_fee_b = AMM.pending_fees(pool, caller_lp, caller_fee_debt_a, caller_fee_debt_b, execution_context)
+
+        # https://github.com/Uniswap/v2-core/blob/master/contracts/UniswapV2Pair.sol#L134
+        caller_token_a_liquidity = pool['token_a_reserve'] * caller_lp // pool['total_lp']
+        caller_token_b_liquidity = pool['token_b_reserve'] * caller_lp // pool['total_lp']
+
+        pool['token_a_reserve'] -= caller_token_a_liquidity
+        pool['token_b_reserve'] -= caller_token_b_liquidity
+        pool['total_lp'] -= caller_lp
+        pool['k'] = pool['token_a_reserve'] * pool['token_b_reserve']
+
+        # delete the position from caller storage
+        if len(caller_positions) > 0:
+            caller_array[caller_amm_index] = AMM.app_account_storage_to_bytes(self.instance_id, caller_positions, execution_context)
+        else:
+            caller_array.pop(caller_amm_index)
+        caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
+        execution_context.write_account_storage(caller, caller_storage)
+
+        # transfer liquidity + fee to caller
+        assets_app = MAM.INSTANCE.id_to_app[pool['assets_app_id']]
+        assets_app.execute(self.instance_address, 3, MAM.array_to_bytes([
+            pool['token_a'].encode(STR_ENCODING) + MAM.pack_int(caller_token_a_liquidity + caller_fee_a) + caller,
+            pool['token_b'].encode(STR_ENCODING) + MAM.pack_int(caller_token_b_liquidity + caller_fee_b) + caller,
+        ]), execution_context)
+
+        # update app storage
+        execution_context.write_app_storage(pool_key, AMM.pool_to_bytes(pool, execution_context))
+        execution_context.emit(self.instance_id, [b'LiquidityRemoved', pair], [caller], MAM.pack_int(caller_lp))
+
+        return 0
+
+    def swap(self, caller: bytes, execution_context: ExecutionContext, token_in: str, token_out: str, amount_in: int, min_amount_out: int):
+        pair, pool_key, pool = self.read_pool(token_in, token_out, execution_context)
+        if pool['total_lp'] <= 0:
+            raise Exception("Empty pool")
+        AMM.check_bad_debt(self.instance_address, pool, execution_context)
+
+        side_in, side_out = ('a', 'b') if token_in == pool['token_a'] else ('b', 'a')
+        token_in_reserve = pool['token_' + side_in + '_reserve']
+        token_out_reserve = pool['token_' + side_out + '_reserve']
+        k = pool['k']
+
+        net_amount_in = int(amount_in - amount_in * pool['fee_bps'] * DECIMAL_SCALE / 10000 / DECIMAL_SCALE)
+        amount_out = int(token_out_reserve - k / (token_in_reserve + net_amount_in))
+        if amount_out < min_amount_out:
+            raise Exception("Not enough output")
+
+        # the fee stays in the app account, outside of the reserve, and is owed to the LP holders
+        execution_context.op(6)
+        pool['token_' + side_in + '_reserve'] = token_in_reserve + net_amount_in
+        pool['token_' + side_out + '_reserve'] = token_out_reserve - amount_out
+        pool['acc_fee_' + side_in] += (amount_in - net_amount_in) * AMM.ACC_FEE_PRECISION // pool['total_lp']
+        execution_context.write_app_storage(pool_key, AMM.pool_to_bytes(pool, execution_context))
+
+        assets_app = MAM.INSTANCE.id_to_app[pool['assets_app_id']]
+        # transfer token in from caller to app
+        assets_app.execute(caller, 3, MAM.array_to_bytes([
+            token_in.encode(STR_ENCODING) + MAM.pack_int(amount_in) + self.instance_address,
+        ]), execution_context)
+        # transfer token out from app to caller
+        assets_app.execute(self.instance_address, 3, MAM.array_to_bytes([
+            token_out.encode(STR_ENCODING) + MAM.pack_int(amount_out) + caller,
+        ]), execution_context)
+
+        execution_context.emit(self.instance_id, [b'Swap', pair], [caller], token_in.encode(STR_ENCODING) + MAM.pack_int(amount_in) + MAM.pack_int(amount_out))
+
+        #TODO: readjust k for rounding error ?
+
+        return 0
+
+    def claim_fees(self, caller: bytes, execution_context: ExecutionContext, token_a: str, token_b: str):
+        pair, pool_key, pool = self.read_pool(token_a, token_b, execution_context)
+
+        caller_storage = execution_context.read_account_storage(caller)
+        caller_array = MAM.parse_array(caller_storage, execution_context)
+        caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+        caller_positions = AMM.parse_app_account_storage(caller_amm_storage, execution_context)
+        if pair not in caller_positions:
+            raise Exception("Caller has no LP")
+
+        caller_lp, caller_fee_debt_a, caller_fee_debt_b = caller_positions[pair]
+        caller_fee_a, caller_fee_b = AMM.pending_fees(pool, caller_lp, caller_fee_debt_a, caller_fee_debt_b, execution_context)
+
+        caller_positions[pair] = (caller_lp, caller_fee_debt_a + caller_fee_a, caller_fee_debt_b + caller_fee_b)
+        caller_array[caller_amm_index] = AMM.app_account_storage_to_bytes(self.instance_id, caller_positions, execution_context)
+        caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
+        execution_context.write_account_storage(caller, caller_storage)
+
+        assets_app = MAM.INSTANCE.id_to_app[pool['assets_app_id']]
+        assets_app.execute(self.instance_address, 3, MAM.array_to_bytes([
+            pool['token_a'].encode(STR_ENCODING) + MAM.pack_int(caller_fee_a) + caller,
+            pool['token_b'].encode(STR_ENCODING) + MAM.pack_int(caller_fee_b) + caller,
+        ]), execution_context)
+        execution_context.emit(self.instance_id, [b'FeesClaimed', pair], [caller], MAM.pack_int(caller_fee_a) + MAM.pack_int(caller_fee_b))
+
+        return 0
+
+    def read_pool(self, token_a: str, token_b: str, execution_context: ExecutionContext) -> (bytes, tuple, dict):
+        execution_context.op(3)
+        if token_a > token_b:
+            token_a, token_b = token_b, token_a
+        pair = (token_a + token_b).encode(STR_ENCODING)
+        pool_key = AMM.pool_storage_key(self.instance_id, pair)
+        pool = AMM.parse_pool(execution_context.read_app_storage(pool_key), execution_context)
+        return pair, pool_key, pool
 
-            if caller_amm_index < 0:
-                caller_array.append(self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.INSTANCE.blockchain.bnum.to_bytes(BNUM_LENGTH, INT_ENCODING) + MAM.pack_int(caller_lp))
-            else:
-                raise Exception("LP already exists for caller")
+    @staticmethod
+    def pool_storage_key(app_instance_id: int, pair: bytes) -> tuple:
+        return app_instance_id, AMM.POOL_KEY_PREFIX + pair
 
-            caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
-            execution_context.write_account_storage(caller_storage, caller_storage)
+    @staticmethod
+    def pool_index_storage_key(app_instance_id: int, index: int) -> tuple:
+        return app_instance_id, AMM.POOL_INDEX_KEY_PREFIX + index.to_bytes(AMM.POOL_INDEX_LENGTH, INT_ENCODING)
 
+    @staticmethod
+    def get_pool_count(app_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> int:
+        execution_context.op(3)
+        if len(app_storage) <= 0:
             return 0
-        elif function_selector == 4:  # withdraw_liquidity()
+        return MAM.unpack_int(app_storage, execution_context)
 
-            app_storage = execution_context.read_app_storage(self.instance_id)
-            offset = 0
-            token_a = app_storage[offset:offset + Assets.SYMBOL_LENGTH]
-            offset += Assets.SYMBOL_LENGTH
-            token_a_type = app_storage[offset]
-            offset += 1
-            token_b = app_storage[offset:offset + Assets.SYMBOL_LENGTH]
-            offset += Assets.SYMBOL_LENGTH
-            token_b_type = app_storage[offset]
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            k = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            assets_app_id = int.from_bytes(app_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
-            offset += APP_INSTANCE_ID_LENGTH
-            fee_bps = int.from_bytes(app_storage[offset:offset + 2], INT_ENCODING)
-            offset += 2
-            app_storage_lp_offset = offset
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            total_lp = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            sum_bnum_i = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            token_a_reserve = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            token_b_reserve = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-
-            app_account_storage = execution_context.read_account_storage(self.instance_id)
-            app_account_array = MAM.parse_array(app_account_storage, execution_context)
-            app_account_assets_storage, app_account_assets_index = MAM.get_app_data_from_array(assets_app_id, app_account_array, execution_context)
-            app_tokens = Assets.get_account_tokens(app_account_assets_storage, execution_context)
-
-            token_a_balance = app_tokens[token_a][2]
-            token_b_balance = app_tokens[token_b][2]
-            if token_a_balance < token_a_reserve:
-                raise Exception("Bad debt token A")
-            if token_b_balance < token_b_reserve:
-                raise Exception("Bad debt token B")
-
-            token_a_fee = token_a_balance - token_a_reserve
-            token_b_fee = token_b_balance - token_b_reserve
-
-            caller_storage = execution_context.read_account_storage(caller)
-            caller_array = MAM.parse_array(caller_storage, execution_context)
-            caller_amm_storage, caller_amm_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
-            if caller_amm_index < 0:
-                raise Exception("Caller has no LP")
-
-            caller_bnum, caller_lp = AMM.parse_app_account_storage(caller_amm_storage, execution_context)
-
-            # https://github.com/Uniswap/v2-core/blob/master/contracts/UniswapV2Pair.sol#L134
-            caller_token_a_liquidity = int(token_a_reserve * caller_lp * DATA_LENGTH / total_lp / DECIMAL_SCALE)
-            caller_token_b_liquidity = int(token_b_reserve * caller_lp * DATA_LENGTH / total_lp / DECIMAL_SCALE)
-
-            # fee is proportional to LP share x time spent
-            # TODO: only consider LP ?
-            caller_token_a_fee = int(MAM.INSTANCE.blockchain.bnum - caller_bnum) * caller_lp * token_a_fee * DECIMAL_SCALE / sum_bnum_i / total_lp / DECIMAL_SCALE
-            caller_token_b_fee = int(MAM.INSTANCE.blockchain.bnum - caller_bnum) * caller_lp * token_b_fee * DECIMAL_SCALE / sum_bnum_i / total_lp / DECIMAL_SCALE
-
-            token_a_reserve -= caller_token_a_liquidity
-            token_b_reserve -= caller_token_b_liquidity
-            total_lp -= caller_lp
-            sum_bnum_i -= caller_bnum
-
-            if token_a_balance - caller_token_a_liquidity - caller_token_a_fee < token_a_reserve:
-                raise Exception("Would be bad debt token A")
-            if token_b_balance - caller_token_b_liquidity - caller_token_b_fee < token_b_reserve:
-                raise Exception("Would be bad debt token B")
-
-            # transfer liquidity + fee to caller
-            caller_token_a_total = caller_token_a_liquidity + caller_token_a_fee
-            caller_token_b_total = caller_token_b_liquidity + caller_token_b_fee
-            assets_app = MAM.INSTANCE.id_to_app[assets_app_id]
-            assets_app.execute(self.instance_address, 3, MAM.array_to_bytes([
-                token_a.encode(STR_ENCODING) + MAM.pack_int(caller_token_a_total) + caller,
-                token_b.encode(STR_ENCODING) + MAM.pack_int(caller_token_b_total) + caller,
-            ]), execution_context)
-
-            # delete AMM entry from caller storage
-            caller_array.pop(caller_amm_index)
-            caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
-            execution_context.write_account_storage(caller_storage, caller_storage)
-
-            # update app account storage
-            app_account_assets_storage = Assets.update_balance(assets_app_id, app_account_assets_storage, token_a, token_a_type, -caller_token_a_total, execution_context)
-            app_account_assets_storage = Assets.update_balance(assets_app_id, app_account_assets_storage, token_b, token_b_type, -caller_token_b_total, execution_context)
-            app_account_array[app_account_assets_index] = app_account_assets_storage
-            app_account_storage = MAM.account_array_to_bytes(app_account_array, execution_context)
-
-            # update app storage
-            app_storage = app_storage[:app_storage_lp_offset] \
-                + MAM.pack_int(total_lp) + MAM.pack_int(sum_bnum_i) + MAM.pack_int(token_a_reserve) + MAM.pack_int(token_b_reserve)
-            execution_context.write_app_storage(self.instance_id, app_storage)
-        elif function_selector == 5:  # swap(a_to_b, amount_in, min_amount_out)
-            a_to_b = function_param[0] > 0
-            offset = 1
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            amount_in = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            min_amount_out = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
+    @staticmethod
+    def list_pools(app_instance_id: int, app_storage: Storage) -> List[dict]:
+        """
+        Read-only helper for wallets: walk the pool index of an AMM instance
+        """
+        pools = []
+        for i in range(AMM.get_pool_count(app_storage.read(app_instance_id))):
+            pair = app_storage.read(AMM.pool_index_storage_key(app_instance_id, i))
+            pools.append(AMM.parse_pool(app_storage.read(AMM.pool_storage_key(app_instance_id, pair))))
+        return pools
 
-            app_storage = execution_context.read_app_storage(self.instance_id)
-            offset = 0
-            token_a = app_storage[offset:offset + Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
-            offset += Assets.SYMBOL_LENGTH
-            token_a_type = app_storage[offset]
-            offset += 1
-            token_b = app_storage[offset:offset + Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
-            offset += Assets.SYMBOL_LENGTH
-            token_b_type = app_storage[offset]
-            offset += 1
-            assets_app_id = int.from_bytes(app_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
-            offset += APP_INSTANCE_ID_LENGTH
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            k = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
+    @staticmethod
+    def parse_pool(storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> dict:
+        if len(storage) <= 0:
+            raise Exception("Pool not found")
+        pool = {}
+        execution_context.op(4)
+        offset = 0
+        pool['token_a'] = storage[offset:offset + Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
+        offset += Assets.SYMBOL_LENGTH
+        pool['token_a_type'] = storage[offset]
+        offset += 1
+        pool['token_b'] = storage[offset:offset + Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
+        offset += Assets.SYMBOL_LENGTH
+        pool['token_b_type'] = storage[offset]
+        offset += 1
+        execution_context.op(4)
+        pool['assets_app_id'] = int.from_bytes(storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
+        offset += APP_INSTANCE_ID_LENGTH
+        execution_context.op(8)
+        l, offset = MAM.read_length(storage, offset)
+        pool['k'] = int.from_bytes(storage[offset:offset + l], INT_ENCODING)
+        offset += l
+        execution_context.op(4)
+        pool['fee_bps'] = int.from_bytes(storage[offset:offset + 2], INT_ENCODING)
+        offset += 2
+        for field in ('total_lp', 'acc_fee_a', 'acc_fee_b', 'token_a_reserve', 'token_b_reserve'):
+            execution_context.op(8)
+            l, offset = MAM.read_length(storage, offset)
+            pool[field] = int.from_bytes(storage[offset:offset + l], INT_ENCODING)
             offset += l
+        return pool
 
-            fee_bps = int.from_bytes(app_storage[offset:offset + 2], INT_ENCODING)
-            offset += 2
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            total_lp = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            sum_bnum_i = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            token_a_reserve = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            token_b_reserve = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
+    @staticmethod
+    def pool_to_bytes(pool: dict, execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
+        execution_context.op(20)
+        return pool['token_a'].encode(STR_ENCODING) + int(pool['token_a_type']).to_bytes(1, INT_ENCODING) \
+            + pool['token_b'].encode(STR_ENCODING) + int(pool['token_b_type']).to_bytes(1, INT_ENCODING) \
+            + pool['assets_app_id'].to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) \
+            + MAM.pack_int(pool['k']) \
+            + pool['fee_bps'].to_bytes(2, INT_ENCODING) \
+            + MAM.pack_int(pool['total_lp']) \
+            + MAM.pack_int(pool['acc_fee_a']) \
+            + MAM.pack_int(pool['acc_fee_b']) \
+            + MAM.pack_int(pool['token_a_reserve']) \
+            + MAM.pack_int(pool['token_b_reserve'])
 
-            app_account_storage = execution_context.read_account_storage(self.instance_address)
-            app_account_array = MAM.parse_array(app_account_storage, execution_context)
-            app_account_assets_storage, app_account_assets_index = MAM.get_app_data_from_array(assets_app_id, app_account_array, execution_context)
-            app_tokens = Assets.get_account_tokens(app_account_assets_storage, execution_context)
-
-            token_a_balance = app_tokens[token_a][2]
-            token_b_balance = app_tokens[token_b][2]
-            if token_a_balance < token_a_reserve:
-                raise Exception("Bad debt token A")
-            if token_b_balance < token_b_reserve:
-                raise Exception("Bad debt token B")
-
-            token_in = token_a
-            token_in_reserve = token_a_reserve
-            token_out = token_b
-            token_out_reserve = token_b_reserve
-            if not a_to_b:
-                token_in = token_b
-                token_in_reserve = token_b_reserve
-                token_out = token_a
-                token_out_reserve = token_a_reserve
-            net_amount_in = int(amount_in - amount_in * fee_bps * DECIMAL_SCALE / 10000 / DECIMAL_SCALE)
-            amount_out = int(token_out_reserve - k / (token_in_reserve + net_amount_in))
-            if amount_out < min_amount_out:
-                raise Exception("Not enough output")
-
-            assets_app = MAM.INSTANCE.id_to_app[assets_app_id]
-            # transfer token in from caller to app
-            assets_app.execute(caller, 3, MAM.array_to_bytes([
-                token_in.encode(STR_ENCODING) + MAM.pack_int(amount_in) + self.instance_address,
-            ]), execution_context)
-            # transfer token out from app to caller
-            assets_app.execute(self.instance_address, 3, MAM.array_to_bytes([
-                token_out.encode(STR_ENCODING) + MAM.pack_int(amount_out) + caller,
-            ]), execution_context)
-
-            #TODO: readjust k for rounding error ?
+    @staticmethod
+    def check_bad_debt(app_address: bytes, pool: dict, execution_context: ExecutionContext):
+        app_account_storage = execution_context.read_account_storage(app_address)
+        app_account_array = MAM.parse_array(app_account_storage, execution_context)
+        app_account_assets_storage, app_account_assets_index = MAM.get_app_data_from_array(pool['assets_app_id'], app_account_array, execution_context)
+        app_tokens = Assets.get_account_tokens(app_account_assets_storage, execution_context)
 
-            return 0
-        else:
-            raise Exception("No such method")
+        execution_context.op(4)
+        if app_tokens[pool['token_a']][2] < pool['token_a_reserve']:
+            raise Exception("Bad debt token A")
+        if app_tokens[pool['token_b']][2] < pool['token_b_reserve']:
+            raise Exception("Bad debt token B")
 
     @staticmethod
-    def parse_app_account_storage(storage, execution_context: ExecutionContext = ExecutionContext.no_op()):
-        execution_context.op(4)
-        offset = APP_INSTANCE_ID_LENGTH
-        bnum = int.from_bytes(storage[offset:offset + BNUM_LENGTH], INT_ENCODING)
-        offset += BNUM_LENGTH
-        execution_context.op(6)
-        l = int.from_bytes(storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-        offset += DATA_LENGTH
+    def pending_fees(pool: dict, lp: int, fee_debt_a: int, fee_debt_b: int, execution_context: ExecutionContext = ExecutionContext.no_op()) -> (int, int):
         execution_context.op(8)
-        lp = int.from_bytes(storage[offset:offset + l], INT_ENCODING)
-        return bnum, lp
+        fee_a = lp * pool['acc_fee_a'] // AMM.ACC_FEE_PRECISION - fee_debt_a
+        fee_b = lp * pool['acc_fee_b'] // AMM.ACC_FEE_PRECISION - fee_debt_b
+        return fee_a, fee_b
+
+    @staticmethod
+    def parse_app_account_storage(storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> dict:
+        """
+        :return: {pair: (lp, fee debt A, fee debt B)}
+        """
+        execution_context.op(3)
+        positions = {}
+        if len(storage) <= APP_INSTANCE_ID_LENGTH:
+            return positions
+        for position in MAM.parse_array(storage[APP_INSTANCE_ID_LENGTH:], execution_context):
+            execution_context.op(4)
+            pair = position[:2 * Assets.SYMBOL_LENGTH]
+            offset = 2 * Assets.SYMBOL_LENGTH
+            values = []
+            for i in range(3):
+                execution_context.op(6)
+                l, offset = MAM.read_length(position, offset)
+                execution_context.op(8)
+                values.append(int.from_bytes(position[offset:offset + l], INT_ENCODING))
+                offset += l
+            positions[pair] = tuple(values)
+        return positions
+
+    @staticmethod
+    def app_account_storage_to_bytes(app_instance_id: int, positions: dict, execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
+        array = []
+        for pair in sorted(positions):
+            execution_context.op(8)
+            lp, fee_debt_a, fee_debt_b = positions[pair]
+            array.append(pair + MAM.pack_int(lp) + MAM.pack_int(fee_debt_a) + MAM.pack_int(fee_debt_b))
+        return app_instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.array_to_bytes(array, execution_context)
 
 
 class MarketPlace(ApplicationInstance):
+    """
+    Internal storage:
+    app id -> offer fee length + offer fee + match fee length + match fee + Assets app id + next offer id length + next offer id
+    (app id, 'O' + offer id) -> seller + counterparty + goods length + [(symbol, value), ...] + price length + [(symbol, value), ...]
+    (app id, 'Q') -> batch queue length + batch queue length
+    (app id, 'Q' + queue index) -> buyer + offer id
+    The max storage of the instance bounds the total of these entries, it leaves room for MAX_OFFERS offers and MAX_QUEUED_MATCHES queued matches
+
+    Batch matches submitted during a block are cleared together at the end of the block: net transfers are computed per
+    account so that each account is read and written once whatever the number of matches it is involved in.
+
+    Offers live in app storage rather than in the seller's account so that match and cancel are a single lookup.
+    Live offers are indexed by the node in an OrderBook for best offer queries
+    """
+    TEMPLATE_TYPE = APP_TEMPLATE_TYPE_MARKETPLACE
+
+    OFFER_KEY_PREFIX = b'O'
+    OFFER_ID_LENGTH = 8
+    BATCH_QUEUE_KEY_PREFIX = b'Q'
+    BATCH_QUEUE_INDEX_LENGTH = 4
+    MAX_OFFERS = 65536
+    OFFER_MAX_STORAGE = 128  # bytes of app storage budgeted for an offer
+    MAX_QUEUED_MATCHES = 4096
+    QUEUED_MATCH_MAX_STORAGE = 32  # bytes of app storage budgeted for a queued match, the header and the queue length come out of it
+
+    FUNCTIONS = {
+        1: Function('create', INT, INT, APP_ID),  # create(offer_fee_mcm, match_fee_mcm, assets_app_id)
+        2: Function('list', Sized(Array()), Sized(Array()), Optional(ADDRESS, bytes(12))),  # list(my_goods=[(symbol, value)], my_price=[(symbol, value)], counterparty)
+        3: Function('match', INT),  # match(offer_id)
+        4: Function('cancel', INT),  # cancel(offer_id)
+        5: Function('batch_match', INT),  # batch_match(offer_id), cleared at the end of the block
+    }
 
     def __init__(self):
         self.instance_address = None
         self.instance_id = None
-        self.max_storage = 1024
+        self.max_storage = MarketPlace.MAX_OFFERS * MarketPlace.OFFER_MAX_STORAGE + MarketPlace.MAX_QUEUED_MATCHES * MarketPlace.QUEUED_MATCH_MAX_STORAGE
+        self.order_book = OrderBook()
 
     def init(self, instance_id: int, instance_address: bytes) -> 'ApplicationInstance':
         self.instance_id = instance_id
         self.instance_address = instance_address
+        MAM.INSTANCE.app_storage.add_listener(self.on_app_storage_write)
         return self
 
     def get_instance_address(self) -> bytes:
@@ -879,172 +1107,287 @@ class MarketPlace(ApplicationInstance):
     def get_max_storage(self) -> int:
         return self.max_storage
 
-    def execute(self, caller: bytes, function_selector: int, function_param: bytes, execution_context: ExecutionContext):
-        if function_selector == 1:  # create(offer_fee_mcm, match_fee_mcm, assets_app_id)
-            offset = 0
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            offer_fee_mcm = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            match_fee_mcm = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
-            offset += l
-            assets_app_id = int.from_bytes(function_param[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
+    def create(self, caller: bytes, execution_context: ExecutionContext, offer_fee_mcm: int, match_fee_mcm: int, assets_app_id: int):
+        app_storage = MAM.pack_int(offer_fee_mcm) + MAM.pack_int(match_fee_mcm) + assets_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_int(0)
+        execution_context.write_app_storage(self.instance_id, app_storage)
 
-            app_storage = MAM.pack_int(offer_fee_mcm) + MAM.pack_int(match_fee_mcm) + assets_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_int(0)
-            execution_context.write_app_storage(self.instance_id, app_storage)
+        return 0
 
-            return 0
-        elif function_selector == 2:  # list(my_goods=[(symbol, value)], my_price=[(symbol, value)], counterparty)
-            offset = 0
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            caller_goods = MAM.parse_array(function_param[offset:offset+l])
-            offset += l
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            caller_price = MAM.parse_array(function_param[offset:offset + l])
-            offset += l
-            counterparty = function_param[offset:offset+12]
+    def list(self, caller: bytes, execution_context: ExecutionContext, caller_goods: list, caller_price: list, counterparty: bytes):
+        offer_fee_mcm, match_fee_mcm, assets_app_id, offer_id = MarketPlace.parse_app_storage(execution_context.read_app_storage(self.instance_id), execution_context)
 
-            offset = 0
-            app_storage = execution_context.read_app_storage(self.instance_id)
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            offer_fee_mcm = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            match_fee_mcm = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            assets_app_id = int.from_bytes(app_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
-            offset += APP_INSTANCE_ID_LENGTH
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            total = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-
-            #TODO: transfer fee to stacker and treasury
-
-            # Transfer offset asset to app account
-            transfer_payload = []
-            for e in caller_goods:
-                transfer_payload.append(e+self.instance_address)
-            assets = MAM.INSTANCE.id_to_app[assets_app_id]
-            assets.execute(caller, 3, MAM.array_to_bytes(transfer_payload), execution_context)
-
-            caller_goods_storage = MAM.array_to_bytes(caller_goods, execution_context)
-            caller_price_storage = MAM.array_to_bytes(caller_price, execution_context)
-            caller_payload = MAM.array_to_bytes([
-                MAM.pack_int(total) + len(caller_goods_storage).to_bytes(DATA_LENGTH, INT_ENCODING) + caller_goods_storage
-                + len(caller_price_storage).to_bytes(DATA_LENGTH, INT_ENCODING) + caller_price_storage
-            ])
-
-            caller_storage = execution_context.read_account_storage(caller)
-            caller_array = MAM.parse_array(caller_storage, execution_context)
-            caller_mp_storage, caller_mp_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
-
-            if caller_mp_index < 0:
-                caller_array.append(self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)+caller_payload)
-            else:
-                caller_mp_array = MAM.parse_array(caller_mp_storage, execution_context)
-                caller_mp_array.append(caller_payload)
-                caller_array[caller_mp_index] = self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.array_to_bytes(caller_mp_array, execution_context)
+        #TODO: transfer fee to stacker and treasury
 
-            caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
-            execution_context.write_account_storage(caller, caller_storage)
+        # Transfer offset asset to app account
+        transfer_payload = []
+        for e in caller_goods:
+            transfer_payload.append(e+self.instance_address)
+        assets = MAM.INSTANCE.id_to_app[assets_app_id]
+        assets.execute(caller, 3, MAM.array_to_bytes(transfer_payload), execution_context)
 
-            return 0
-        elif function_selector == 3: # match(user_address, listing_id)
-            offset = 0
-            seller_address = function_param[offset:offset+12]
-            offset += 12
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            offer_id = int.from_bytes(function_param[offset:offset + l], INT_ENCODING)
+        caller_goods_storage = MAM.array_to_bytes(caller_goods, execution_context)
+        caller_price_storage = MAM.array_to_bytes(caller_price, execution_context)
+        offer_storage = caller + counterparty \
+            + MAM.pack_length(len(caller_goods_storage)) + caller_goods_storage \
+            + MAM.pack_length(len(caller_price_storage)) + caller_price_storage
+        execution_context.write_app_storage(MarketPlace.offer_storage_key(self.instance_id, offer_id), offer_storage)
 
-            offset = 0
-            app_storage = execution_context.read_app_storage(self.instance_id)
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            offer_fee_mcm = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            match_fee_mcm = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-            offset += l
-            assets_app_id = int.from_bytes(app_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
-            offset += APP_INSTANCE_ID_LENGTH
-            l = int.from_bytes(app_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            total = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
-
-            seller_storage = execution_context.read_account_storage(seller_address)
-            seller_array = MAM.parse_array(seller_storage, execution_context)
-            seller_mp_storage, seller_mp_index = MAM.get_app_data_from_array(self.instance_id, seller_array, execution_context)
-            if seller_mp_index < 0:
-                raise Exception("Offer id not found")
-
-            offer_goods = None
-            offer_price = None
-            offer_counterparty = None
-
-            for e in MAM.parse_array(seller_mp_storage[APP_INSTANCE_ID_LENGTH:], execution_context):
-                offset = 0
-                l = int.from_bytes(e[offset:offset + DATA_LENGTH], INT_ENCODING)
-                offset += DATA_LENGTH
-                _id = int.from_bytes(e[offset:offset+l], INT_ENCODING)
-                if _id == offer_id:
-                    offset += l
-                    l = int.from_bytes(e[offset:offset + DATA_LENGTH], INT_ENCODING)
-                    offset += DATA_LENGTH
-                    offer_goods = MAM.parse_array(e[offset:offset+l])
-                    offset += l
-
-                    l = int.from_bytes(e[offset:offset + DATA_LENGTH], INT_ENCODING)
-                    offset += DATA_LENGTH
-                    offer_price = MAM.parse_array(e[offset:offset+l])
-                    offset += l
-                    offer_counterparty = e[offset:offset+12]
-
-                if offer_goods is None:
-                    raise Exception("Offer not found")
-                if offer_counterparty == bytes(12) and offer_counterparty != caller:
-                    raise Exception("Private sale")
-
-                assets = MAM.INSTANCE.id_to_app[assets_app_id]
-
-                # Transfer price asset from caller to offer user
-                transfer_price = []
-                for e in offer_price:
-                    transfer_price.append(e+seller_address)
-
-                assets.execute(caller, 3, MAM.array_to_bytes(transfer_price), execution_context)
-
-                # Transfer offer asset from app account to caller
-                transfer_offer = []
-                for e in offer_goods:
-                    transfer_offer.append(e + caller)
-
-                assets.execute(self.instance_address, 3, MAM.array_to_bytes(transfer_offer), execution_context)
-
-                return 0
-        elif function_selector == 4: # cancel(offer_id)
-            raise Exception("Not implemented")
-        else:
-            raise Exception("No such method")
+        app_storage = MAM.pack_int(offer_fee_mcm) + MAM.pack_int(match_fee_mcm) + assets_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_int(offer_id + 1)
+        execution_context.write_app_storage(self.instance_id, app_storage)
+        execution_context.emit(self.instance_id, [b'OfferListed'], [caller], MAM.pack_int(offer_id))
+
+        return 0
+
+    def match(self, caller: bytes, execution_context: ExecutionContext, offer_id: int):
+        offer_fee_mcm, match_fee_mcm, assets_app_id, next_offer_id = MarketPlace.parse_app_storage(execution_context.read_app_storage(self.instance_id), execution_context)
+
+        offer_key = MarketPlace.offer_storage_key(self.instance_id, offer_id)
+        offer_storage = execution_context.read_app_storage(offer_key)
+        if len(offer_storage) <= 0:
+            raise Exception("Offer not found")
+        seller_address, offer_counterparty, offer_goods, offer_price = MarketPlace.parse_offer(offer_storage, execution_context)
+        if offer_counterparty != bytes(12) and offer_counterparty != caller:
+            raise Exception("Private sale")
+
+        # delete offer
+        execution_context.write_app_storage(offer_key, bytes(0))
+
+        assets = MAM.INSTANCE.id_to_app[assets_app_id]
+
+        # Transfer price asset from caller to offer user
+        transfer_price = []
+        for e in offer_price:
+            transfer_price.append(e+seller_address)
+
+        assets.execute(caller, 3, MAM.array_to_bytes(transfer_price), execution_context)
+
+        # Transfer offer asset from app account to caller
+        transfer_offer = []
+        for e in offer_goods:
+            transfer_offer.append(e + caller)
+
+        assets.execute(self.instance_address, 3, MAM.array_to_bytes(transfer_offer), execution_context)
+        execution_context.emit(self.instance_id, [b'OfferMatched'], [caller, seller_address], MAM.pack_int(offer_id))
+
+        return 0
+
+    def cancel(self, caller: bytes, execution_context: ExecutionContext, offer_id: int):
+        offer_fee_mcm, match_fee_mcm, assets_app_id, next_offer_id = MarketPlace.parse_app_storage(execution_context.read_app_storage(self.instance_id), execution_context)
+
+        offer_key = MarketPlace.offer_storage_key(self.instance_id, offer_id)
+        offer_storage = execution_context.read_app_storage(offer_key)
+        if len(offer_storage) <= 0:
+            raise Exception("Offer not found")
+        seller_address, offer_counterparty, offer_goods, offer_price = MarketPlace.parse_offer(offer_storage, execution_context)
+        if seller_address != caller:
+            raise Exception("Only the seller can cancel an offer")
+
+        # delete offer
+        execution_context.write_app_storage(offer_key, bytes(0))
+
+        # Return offer asset from app account to seller
+        transfer_offer = []
+        for e in offer_goods:
+            transfer_offer.append(e + caller)
+
+        assets = MAM.INSTANCE.id_to_app[assets_app_id]
+        assets.execute(self.instance_address, 3, MAM.array_to_bytes(transfer_offer), execution_context)
+        execution_context.emit(self.instance_id, [b'OfferCancelled'], [caller], MAM.pack_int(offer_id))
+
+        return 0
+
+    def batch_match(self, caller: bytes, execution_context: ExecutionContext, offer_id: int):
+        offer_storage = execution_context.read_app_storage(MarketPlace.offer_storage_key(self.instance_id, offer_id))
+        if len(offer_storage) <= 0:
+            raise Exception("Offer not found")
+        seller_address, offer_counterparty, offer_goods, offer_price = MarketPlace.parse_offer(offer_storage, execution_context)
+        if offer_counterparty != bytes(12) and offer_counterparty != caller:
+            raise Exception("Private sale")
+
+        queue_length_key = MarketPlace.batch_queue_storage_key(self.instance_id)
+        queue_length = MAM.unpack_int(execution_context.read_app_storage(queue_length_key), execution_context)
+        execution_context.write_app_storage(MarketPlace.batch_queue_storage_key(self.instance_id, queue_length), caller + offer_id.to_bytes(MarketPlace.OFFER_ID_LENGTH, INT_ENCODING))
+        execution_context.write_app_storage(queue_length_key, MAM.pack_int(queue_length + 1))
+
+        return 0
+
+    def end_block(self, execution_context: ExecutionContext):
+        """
+        Clear the batch queue. Each queued match is checked on its own and skipped if invalid, and the queue is emptied
+        even if the settlement of the matches fails, so that a bad entry cannot block the queue
+        """
+        queue_length_key = MarketPlace.batch_queue_storage_key(self.instance_id)
+        queue_length = MAM.unpack_int(execution_context.read_app_storage(queue_length_key), execution_context)
+        if queue_length <= 0:
+            return
+        queue_entries = []
+        for i in range(queue_length):
+            queue_key = MarketPlace.batch_queue_storage_key(self.instance_id, i)
+            queue_entries.append(execution_context.read_app_storage(queue_key))
+            execution_context.write_app_storage(queue_key, bytes(0))
+        execution_context.write_app_storage(queue_length_key, MAM.pack_int(0))
+
+        offer_fee_mcm, match_fee_mcm, assets_app_id, next_offer_id = MarketPlace.parse_app_storage(execution_context.read_app_storage(self.instance_id), execution_context)
+        tokens_info = Assets.app_array_to_tokens_info(MAM.parse_array(execution_context.read_app_storage(assets_app_id), execution_context))
+
+        accounts = {}  # address -> account storage, read once
+        balances = {}  # address -> {symbol: balance} running balance of the buyers
+        changes = {}  # address -> {symbol: net change}
+        matches = {}  # offer id -> (buyer, seller)
+
+        # first come, first served: a match is skipped if its offer is already matched, if the buyer cannot pay or if it is invalid
+        for queue_entry in queue_entries:
+            try:
+                buyer = queue_entry[:12]
+                offer_id = int.from_bytes(queue_entry[12:12 + MarketPlace.OFFER_ID_LENGTH], INT_ENCODING)
+                if offer_id in matches:
+                    continue
+                offer_storage = execution_context.read_app_storage(MarketPlace.offer_storage_key(self.instance_id, offer_id))
+                if len(offer_storage) <= 0:
+                    continue
+                seller_address, offer_counterparty, offer_goods, offer_price = MarketPlace.parse_offer(offer_storage, execution_context)
+                price = [MarketPlace.parse_asset_amount(e) for e in offer_price]
+                goods = [MarketPlace.parse_asset_amount(e) for e in offer_goods]
+                for symbol, amount in price + goods:
+                    if symbol not in tokens_info or tokens_info[symbol][1] != Assets.TYPE_FUNGIBLE:
+                        raise Exception("Symbol {} cannot be settled".format(symbol))
+
+                if buyer not in balances:
+                    buyer_storage = execution_context.read_account_storage(buyer)
+                    buyer_array = MAM.parse_array(buyer_storage, execution_context)
+                    buyer_assets_storage, buyer_assets_index = MAM.get_app_data_from_array(assets_app_id, buyer_array, execution_context)
+                    buyer_balances = {symbol: token[2] for symbol, token in Assets.get_account_tokens(buyer_assets_storage, execution_context).items()}
+                    for symbol, change in changes.get(buyer, {}).items():
+                        buyer_balances[symbol] = buyer_balances.get(symbol, 0) + change
+                    accounts[buyer] = buyer_storage
+                    balances[buyer] = buyer_balances
+            except:
+                continue
+            if any(balances[buyer].get(symbol, 0) < amount for symbol, amount in price):
+                continue
+
+            for symbol, amount in price:
+                balances[buyer][symbol] -= amount
+                changes.setdefault(buyer, {})[symbol] = changes.get(buyer, {}).get(symbol, 0) - amount
+                changes.setdefault(seller_address, {})[symbol] = changes.get(seller_address, {}).get(symbol, 0) + amount
+                if seller_address in balances:
+                    balances[seller_address][symbol] = balances[seller_address].get(symbol, 0) + amount
+            for symbol, amount in goods:
+                changes.setdefault(buyer, {})[symbol] = changes.get(buyer, {}).get(symbol, 0) + amount
+                changes.setdefault(self.instance_address, {})[symbol] = changes.get(self.instance_address, {}).get(symbol, 0) - amount
+                balances[buyer][symbol] = balances[buyer].get(symbol, 0) + amount
+            matches[offer_id] = (buyer, seller_address)
+
+        # the matches are settled together: if the settlement fails, they are all dropped but the queue is still cleared
+        account_storage_buffer = dict(execution_context.account_storage_buffer)
+        try:
+            Assets.apply_balance_changes(assets_app_id, changes, tokens_info, execution_context, accounts)
+        except:
+            execution_context.account_storage_buffer = account_storage_buffer
+            return
+        for offer_id, (buyer, seller_address) in matches.items():
+            execution_context.write_app_storage(MarketPlace.offer_storage_key(self.instance_id, offer_id), bytes(0))
+            execution_context.emit(self.instance_id, [b'OfferMatched'], [buyer, seller_address], MAM.pack_int(offer_id))
+
+    def on_app_storage_write(self, key, old_value: bytes, new_value: bytes):
+        if type(key) != tuple or key[0] != self.instance_id or key[1][:1] != MarketPlace.OFFER_KEY_PREFIX:
+            return
+        offer_id = int.from_bytes(key[1][1:], INT_ENCODING)
+        self.order_book.remove(offer_id)
+        if len(new_value) <= 0:
+            return
+        seller_address, counterparty, goods, price = MarketPlace.parse_offer(new_value)
+        if len(goods) != 1 or len(price) != 1:
+            return
+        goods_symbol, goods_amount = MarketPlace.parse_asset_amount(goods[0])
+        price_symbol, price_amount = MarketPlace.parse_asset_amount(price[0])
+        self.order_book.add(offer_id, goods_symbol, goods_amount, price_symbol, price_amount)
+
+    @staticmethod
+    def offer_storage_key(app_instance_id: int, offer_id: int) -> tuple:
+        return app_instance_id, MarketPlace.OFFER_KEY_PREFIX + offer_id.to_bytes(MarketPlace.OFFER_ID_LENGTH, INT_ENCODING)
+
+    @staticmethod
+    def batch_queue_storage_key(app_instance_id: int, index: int = None) -> tuple:
+        if index is None:
+            return app_instance_id, MarketPlace.BATCH_QUEUE_KEY_PREFIX
+        return app_instance_id, MarketPlace.BATCH_QUEUE_KEY_PREFIX + index.to_bytes(MarketPlace.BATCH_QUEUE_INDEX_LENGTH, INT_ENCODING)
+
+    @staticmethod
+    def parse_app_storage(app_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> (int, int, int, int):
+        """
+        :return: (offer fee, match fee, Assets app id, next offer id)
+        """
+        if len(app_storage) <= 0:
+            raise Exception("Marketplace not created")
+        offset = 0
+        execution_context.op(8)
+        l, offset = MAM.read_length(app_storage, offset)
+        offer_fee_mcm = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
+        offset += l
+        execution_context.op(8)
+        l, offset = MAM.read_length(app_storage, offset)
+        match_fee_mcm = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
+        offset += l
+        execution_context.op(4)
+        assets_app_id = int.from_bytes(app_storage[offset:offset + APP_INSTANCE_ID_LENGTH], INT_ENCODING)
+        offset += APP_INSTANCE_ID_LENGTH
+        execution_context.op(8)
+        l, offset = MAM.read_length(app_storage, offset)
+        next_offer_id = int.from_bytes(app_storage[offset:offset + l], INT_ENCODING)
+        return offer_fee_mcm, match_fee_mcm, assets_app_id, next_offer_id
+
+    @staticmethod
+    def parse_offer(offer_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()) -> (bytes, bytes, list, list):
+        """
+        :return: (seller, counterparty, [(symbol, value), ...], [(symbol, value), ...])
+        """
+        execution_context.op(4)
+        offset = 0
+        seller_address = offer_storage[offset:offset + 12]
+        offset += 12
+        counterparty = offer_storage[offset:offset + 12]
+        offset += 12
+        execution_context.op(4)
+        l, offset = MAM.read_length(offer_storage, offset)
+        goods = MAM.parse_array(offer_storage[offset:offset + l], execution_context)
+        offset += l
+        execution_context.op(4)
+        l, offset = MAM.read_length(offer_storage, offset)
+        price = MAM.parse_array(offer_storage[offset:offset + l], execution_context)
+        return seller_address, counterparty, goods, price
+
+    @staticmethod
+    def parse_asset_amount(entry: bytes) -> (str, int):
+        symbol = entry[:Assets.SYMBOL_LENGTH].decode(STR_ENCODING)
+        offset = Assets.SYMBOL_LENGTH
+        l, offset = MAM.read_length(entry, offset)
+        return symbol, int.from_bytes(entry[offset:offset + l], INT_ENCODING)
 
 
 class Chat(ApplicationInstance):
+    """
+    Account storage:
+    app id + recipient length + recipient + message length + message
+
+    Only the last message of each sender is stored. The node indexes the senders per recipient in an Inbox
+    """
+    TEMPLATE_TYPE = APP_TEMPLATE_TYPE_CHAT
+
+    FUNCTIONS = {
+        1: Function('send', BYTES, BYTES),  # send(recipient, msg)
+    }
 
     def __init__(self):
         self.instance_address = None
         self.instance_id = None
         self.max_storage = 1024
+        self.inbox = Inbox()
 
     def init(self, instance_id: int, instance_address: bytes) -> 'ApplicationInstance':
         self.instance_id = instance_id
         self.instance_address = instance_address
+        MAM.INSTANCE.account_storage.add_listener(self.on_account_storage_write)
         return self
 
     def get_instance_address(self) -> bytes:
@@ -1056,61 +1399,187 @@ class Chat(ApplicationInstance):
     def get_max_storage(self) -> int:
         return self.max_storage
 
-    def execute(self, caller: bytes, function_selector: int, function_param: bytes, execution_context: ExecutionContext):
-
-        if function_selector == 1:  # send(recipient, msg)
-            offset = 0
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            recipient = function_param[offset:offset + l]
-            offset += l
-            l = int.from_bytes(function_param[offset:offset + DATA_LENGTH], INT_ENCODING)
-            offset += DATA_LENGTH
-            msg = function_param[offset:offset + l]
-            offset += l
-
-            caller_storage = execution_context.read_account_storage(caller)
-            caller_array = MAM.parse_array(caller_storage, execution_context)
-            caller_app_storage, caller_app_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
-
-            caller_app_storage = self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + function_param
-            MAM.set_to_array(caller_app_storage, caller_array, caller_app_index, execution_context)
-            caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
-            execution_context.write_account_storage(caller, caller_storage)
-
-            return 0
-        else:
-            raise Exception("No such method")
+    def send(self, caller: bytes, execution_context: ExecutionContext, recipient: bytes, msg: bytes):
+        caller_storage = execution_context.read_account_storage(caller)
+        caller_array = MAM.parse_array(caller_storage, execution_context)
+        caller_app_storage, caller_app_index = MAM.get_app_data_from_array(self.instance_id, caller_array, execution_context)
+
+        caller_app_storage = self.instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + Chat.FUNCTIONS[1].encode(recipient, msg)
+        MAM.set_to_array(caller_app_storage, caller_array, caller_app_index, execution_context)
+        caller_storage = MAM.account_array_to_bytes(caller_array, execution_context)
+        execution_context.write_account_storage(caller, caller_storage)
+        execution_context.emit(self.instance_id, [b'MessageSent'], [caller], recipient)
+
+        return 0
+
+    def on_account_storage_write(self, address: bytes, old_value: bytes, new_value: bytes):
+        old_entry, old_index = MAM.get_app_data_from_array(self.instance_id, MAM.parse_array(old_value))
+        new_entry, new_index = MAM.get_app_data_from_array(self.instance_id, MAM.parse_array(new_value))
+        if old_entry == new_entry:
+            return
+        if old_index >= 0:
+            self.inbox.remove(Chat.parse_entry(old_entry[APP_INSTANCE_ID_LENGTH:])[0], address)
+        if new_index >= 0:
+            self.inbox.add(Chat.parse_entry(new_entry[APP_INSTANCE_ID_LENGTH:])[0], address)
+
+    def read_inbox(self, recipient: bytes, start: int = 0, count: int = None) -> List[tuple]:
+        """
+        Read-only helper: page through the messages sent to the recipient, most recent first
+        :return: [(sender, message), ...]
+        """
+        messages = []
+        for sender in self.inbox.senders(recipient, start, count):
+            sender_array = MAM.parse_array(MAM.INSTANCE.account_storage.read(sender))
+            sender_entry, sender_index = MAM.get_app_data_from_array(self.instance_id, sender_array)
+            messages.append((sender, Chat.parse_entry(sender_entry[APP_INSTANCE_ID_LENGTH:])[1]))
+        return messages
 
     @staticmethod
-    def decode_entry( entry_storage: bytes) -> str:
+    def parse_entry(entry_storage: bytes) -> (bytes, bytes):
+        """
+        :return: (recipient, message)
+        """
         offset = 0
-        l = int.from_bytes(entry_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-        offset += DATA_LENGTH
+        l, offset = MAM.read_length(entry_storage, offset)
         recipient = entry_storage[offset:offset + l]
         offset += l
-        l = int.from_bytes(entry_storage[offset:offset + DATA_LENGTH], INT_ENCODING)
-        offset += DATA_LENGTH
+        l, offset = MAM.read_length(entry_storage, offset)
         msg = entry_storage[offset:offset + l]
+        return recipient, msg
+
+    @staticmethod
+    def decode_entry( entry_storage: bytes) -> str:
+        recipient, msg = Chat.parse_entry(entry_storage)
         return '@{}:{}'.format(recipient.decode(STR_ENCODING), msg.decode(STR_ENCODING))
 
 
+class AppRegistry:
+    """
+    Registry of the app instances: instance id -> template type. This is the part of the registry that is persisted.
+    App objects are only created on first use so that a node holding many instances only pays for the ones in use.
+    An app object created over an existing state (e.g. restored from a snapshot) rebuilds its node side indexes
+    by replaying to its own listeners the keys the instance owns, as indexed by the StorageSizeIndex of the MAM
+
+    Indexed by instance id, registry.addresses is the same registry indexed by instance address
+    """
+
+    def __init__(self):
+        self.template_types: Dict[int, int] = {}
+        self.instances: Dict[int, ApplicationInstance] = {}
+        self.addresses = AppAddressRegistry(self)
+
+    def __len__(self):
+        return len(self.template_types)
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.template_types)
+
+    def __contains__(self, app_id: int):
+        return app_id in self.template_types
+
+    def __getitem__(self, app_id: int) -> ApplicationInstance:
+        app = self.instances.get(app_id)
+        if app is None:
+            if app_id not in self.template_types:
+                raise KeyError(app_id)
+            app = self.instantiate(app_id, replay=True)
+        return app
+
+    def add(self, app_id: int, template_type: int, app: ApplicationInstance = None):
+        self.template_types[app_id] = template_type
+        if app is not None:
+            self.instances[app_id] = app
+
+    def remove(self, app_id: int):
+        """
+        Unregister an instance, the storage listeners of its app object are removed
+        """
+        del self.template_types[app_id]
+        app = self.instances.pop(app_id, None)
+        if app is not None:
+            for storage in (MAM.INSTANCE.app_storage, MAM.INSTANCE.account_storage):
+                storage.listeners = [listener for listener in storage.listeners if getattr(listener, '__self__', None) is not app]
+
+    def instantiate(self, app_id: int, replay: bool) -> ApplicationInstance:
+        mam = MAM.INSTANCE
+        app_listeners = len(mam.app_storage.listeners)
+        account_listeners = len(mam.account_storage.listeners)
+        app = MAM.app_class(self.template_types[app_id])().init(app_id, MAM.instance_address(app_id))
+        self.instances[app_id] = app
+        if replay:
+            mam.app_storage.replay_keys(list(mam.storage_sizes.app_storage_keys(app_id)), mam.app_storage.listeners[app_listeners:])
+            mam.account_storage.replay_keys(list(mam.storage_sizes.app_account_addresses(app_id)), mam.account_storage.listeners[account_listeners:])
+        return app
+
+    def app_class(self, app_id: int) -> type:
+        app = self.instances.get(app_id)
+        return type(app) if app is not None else MAM.app_class(self.template_types[app_id])
+
+
+class AppAddressRegistry:
+    """
+    View of an AppRegistry by instance address. Instance addresses are derived from the instance ids
+    """
+
+    def __init__(self, registry: AppRegistry):
+        self.registry = registry
+
+    @staticmethod
+    def instance_id(address: bytes) -> int:
+        """
+        :return: the id of the instance at address or -1 if address is not an instance address
+        """
+        if len(address) != len(INSTANCE_ADDRESS_PREFIX) + INSTANCE_ADDRESS_ID_LENGTH or address[:len(INSTANCE_ADDRESS_PREFIX)] != INSTANCE_ADDRESS_PREFIX:
+            return -1
+        return int.from_bytes(address[len(INSTANCE_ADDRESS_PREFIX):], INT_ENCODING)
+
+    def __contains__(self, address: bytes):
+        app_id = AppAddressRegistry.instance_id(address)
+        return app_id != MCM_APP_ID and app_id in self.registry
+
+    def __getitem__(self, address: bytes) -> ApplicationInstance:
+        if address not in self:
+            raise KeyError(address)
+        return self.registry[AppAddressRegistry.instance_id(address)]
+
+
 class MAM:
 
     INSTANCE: Union['MAM', None] = None
 
-    def __init__(self):
+    # storage encoding, see Encoding
+    int_byte_size = staticmethod(Encoding.int_byte_size)
+    pack_int = staticmethod(Encoding.pack_int)
+    unpack_int = staticmethod(Encoding.unpack_int)
+    pack_length = staticmethod(Encoding.pack_length)
+    read_length = staticmethod(Encoding.read_length)
+    read_array_size = staticmethod(Encoding.read_array_size)
+    parse_array = staticmethod(Encoding.parse_array)
+    array_to_bytes = staticmethod(Encoding.array_to_bytes)
+
+    def __init__(self, app_storage: Storage = None, account_storage: Storage = None):
         self.app_templates: List[ApplicationTemplate] = []
-        self.address_to_app: Dict[bytes, ApplicationInstance] = {}
-        self.id_to_app: Dict[int, ApplicationInstance] = {}
-        self.app_storage = Storage()
-        self.account_storage = Storage()
+        self.id_to_app = AppRegistry()
+        self.address_to_app = self.id_to_app.addresses
+        self.app_storage = Storage() if app_storage is None else app_storage
+        self.account_storage = Storage() if account_storage is None else account_storage
 
         self.add_app_template(ApplicationTemplate(APP_TEMPLATE_TYPE_MCM))
-        self.id_to_app[MCM_APP_ID] = MCM()
+        self.id_to_app.add(MCM_APP_ID, APP_TEMPLATE_TYPE_MCM, MCM())
 
         self.next_instance_id = 1
         self.blockchain = Blockchain()
+        self.state_root = StateRoot()  # hash of the state, maintained by the storage listeners
+        self.event_log = EventLog()
+        self.rent_engine = None  # RentEngine charging storage rent on neo genesis blocks, disabled if None
+        self.write_ahead_log = None  # WriteAheadLog logging the writes of every mined block, disabled if None
+        self.undo_log = None  # UndoLog keeping the prior values written by the last blocks to roll them back, disabled if None
+        self.storage_sizes = StorageSizeIndex()
+        self.balance_ledger = BalanceLedger()
+        self.write_stats = WriteStats()  # write amplification of every persisted execution context
+        self.last_write_stats = WriteStats()  # write amplification of the last persisted execution context
+        self.app_storage.add_listener(self.on_app_storage_write)
+        self.account_storage.add_listener(self.on_account_storage_write)
 
         if MAM.INSTANCE is not None:
             raise Exception("Multiple MAM instance are not allowed")
@@ -1123,36 +1592,74 @@ class MAM:
         self.app_templates.append(app_template)
 
     @staticmethod
-    def new_app(app_template: 'ApplicationTemplate') -> ApplicationInstance:
-        if app_template.type == APP_TEMPLATE_TYPE_ASSETS:
-            return Assets()
-        elif app_template.type == APP_TEMPLATE_TYPE_AMM:
-            return AMM()
-        elif app_template.type == APP_TEMPLATE_TYPE_MARKETPLACE:
-            return MarketPlace()
-        elif app_template.type == APP_TEMPLATE_TYPE_CHAT:
-            return Chat()
+    def app_class(app_template_type: int) -> type:
+        if app_template_type == APP_TEMPLATE_TYPE_ASSETS:
+            return Assets
+        elif app_template_type == APP_TEMPLATE_TYPE_AMM:
+            return AMM
+        elif app_template_type == APP_TEMPLATE_TYPE_MARKETPLACE:
+            return MarketPlace
+        elif app_template_type == APP_TEMPLATE_TYPE_CHAT:
+            return Chat
         else:
-            raise Exception("Unknown Application Template type {}".format(app_template.type))
-
-    def create_instance(self, app_template_type: int):
-        app_template = None
-        for at in self.app_templates:
-            if at.type == app_template_type:
-                app_template = at
-                break
-        if app_template is None:
             raise Exception("Unknown Application Template type {}".format(app_template_type))
 
-        app_instance = MAM.new_app(app_template).init(self.next_instance_id, bytes.fromhex("00000000000000000000") + self.next_instance_id.to_bytes(2, INT_ENCODING))
+    @staticmethod
+    def new_app(app_template: 'ApplicationTemplate') -> ApplicationInstance:
+        return MAM.app_class(app_template.type)()
+
+    @staticmethod
+    def instance_address(instance_id: int) -> bytes:
+        return INSTANCE_ADDRESS_PREFIX + instance_id.to_bytes(INSTANCE_ADDRESS_ID_LENGTH, INT_ENCODING)
+
+    def create_instance(self, app_template_type: int):
+        app_id = self.next_instance_id
+        self.register_instance(app_template_type, app_id)
         self.next_instance_id += 1
+        app_instance = self.id_to_app.instantiate(app_id, replay=False)
         self.account_storage.write(app_instance.get_instance_address(), bytes(0))
-        self.id_to_app[app_instance.get_instance_id()] = app_instance
-        self.address_to_app[app_instance.get_instance_address()] = app_instance
 
         return app_instance.get_instance_id()
 
-    def call(self, dry_run: bool, caller_address: bytes, max_gas: Union[int, None], app_id: int, function_selector: int, function_parameters:  bytes):
+    def register_instance(self, app_template_type: int, instance_id: int):
+        """
+        Register an instance of an app template under the given instance id. The app object is created on first use.
+        Used to create new instances and to restore them from a snapshot
+        """
+        if all(at.type != app_template_type for at in self.app_templates):
+            raise Exception("Unknown Application Template type {}".format(app_template_type))
+        MAM.app_class(app_template_type)  # the MCM template cannot be instantiated
+        self.id_to_app.add(instance_id, app_template_type)
+
+    def mine_block(self) -> Dict[int, str]:
+        """
+        Run the end of block processing of every app instance then move to the next block.
+        Storage rent is charged when the next block is a neo genesis block, before the trailer is built so that the state root,
+        the undo journal and the log record of the block all include it
+        :return: {app id: error} for the app instances whose end of block processing failed. Their changes are discarded
+        """
+        errors = {}
+        for app_id in sorted(self.id_to_app):
+            if self.id_to_app.app_class(app_id).end_block is ApplicationInstance.end_block:
+                continue  # no end of block processing, the app object is not needed
+            exec_ctx = ExecutionContext(None, self.app_storage, self.account_storage, balance_ledger=self.balance_ledger)
+            try:
+                self.id_to_app[app_id].end_block(exec_ctx)
+                self.persists(exec_ctx)
+                self.event_log.add_events(self.blockchain.bnum, exec_ctx.events)
+            except:
+                errors[app_id] = traceback.format_exc()
+        if self.rent_engine is not None and self.rent_engine.is_rent_block(self.blockchain.bnum + 1):
+            self.rent_engine.collect(self.account_storage, self.storage_sizes, self.balance_ledger, self.address_to_app)
+        self.blockchain.mine_block(self.state_root.digest())
+        if self.undo_log is not None:
+            self.undo_log.seal()
+        if self.write_ahead_log is not None:
+            self.write_ahead_log.commit()
+        return errors
+
+    def call(self, dry_run: bool, caller_address: bytes, max_gas: Union[int, None], app_id: int, function_selector: int, function_parameters:  bytes,
+             next_public_key_hash: bytes = None):
         """
 
         :param dry_run: to estimate the gas cost of a transaction without persisting change on chain. This is equivalent to EVM 'estimate_gas' function
@@ -1161,103 +1668,206 @@ class MAM:
         :param app_id:
         :param function_selector:
         :param function_parameters:
-        :return:
+        :param next_public_key_hash: hash of the public key signing the next transaction of the caller, for a signed transaction (MIP12B1)
+        :return: (gas used, gas cost, error, events)
         """
         if app_id not in self.id_to_app:
             raise Exception("Application id {} not found".format(app_id))
         if not dry_run and max_gas is None:
             raise Exception("Must specify max_gas when not dry run")
         app = self.id_to_app[app_id]
-        exec_ctx = ExecutionContext(max_gas, self.app_storage, self.account_storage)
+        exec_ctx = ExecutionContext(max_gas, self.app_storage, self.account_storage, balance_ledger=self.balance_ledger)
 
         try:
-            caller_storage = self.account_storage.read(caller_address)
-            caller_array = MAM.parse_array(caller_storage)
-            caller_mcm_app_storage, caller_mcm_app_index = MAM.get_app_data_from_array(MCM_APP_ID, caller_array)
-            balance = MCM.get_balance(caller_mcm_app_storage)
+            balance = exec_ctx.read_balance(caller_address, update_gas=False)
             if not dry_run and balance < max_gas * GAS_PRICE:
                 raise Exception("Not enough balance for gas (max gas cost = {})".format(max_gas * GAS_PRICE))  # a wetrun without balance should not even make it to the MAM
             if max_gas is not None:
                 # substract max_gas cost from caller balance before executing to insure gas cost is funded
-                caller_mcm_app_storage = MCM.subtract_from_balance(caller_mcm_app_storage, max_gas * GAS_PRICE)
-                caller_array[caller_mcm_app_index] = caller_mcm_app_storage
-                caller_storage = MAM.account_array_to_bytes(caller_array)
-                exec_ctx.write_account_storage(caller_address, caller_storage, update_gas=False)
+                exec_ctx.write_balance(caller_address, balance - max_gas * GAS_PRICE, update_gas=False)
+            if next_public_key_hash is not None:
+                exec_ctx.write_app_storage(MCM.public_key_hash_storage_key(caller_address), next_public_key_hash)
             try:
                 app.execute(caller_address, function_selector, function_parameters, exec_ctx)
             finally:
                 if max_gas is not None:
                     # credit max_gas cost back
-                    caller_storage = exec_ctx.read_account_storage(caller_address, update_gas=False)
-                    caller_array = MAM.parse_array(caller_storage)
-                    caller_mcm_app_storage, caller_mcm_app_index = MAM.get_app_data_from_array(MCM_APP_ID, caller_array)
-                    caller_mcm_app_storage = MCM.add_to_balance(caller_mcm_app_storage, max_gas * GAS_PRICE)
-                    caller_array[caller_mcm_app_index] = caller_mcm_app_storage
-                    caller_storage = MAM.array_to_bytes(caller_array)
-                    exec_ctx.write_account_storage(caller_address, caller_storage, update_gas=False)
+                    exec_ctx.write_balance(caller_address, exec_ctx.read_balance(caller_address, update_gas=False) + max_gas * GAS_PRICE, update_gas=False)
 
-            if len(self.app_storage.read(app_id)) > app.get_max_storage():
-                raise Exception("App storage overflow")
+            # the app storage of each instance written by the call must fit its max storage: the running size of the instance plus the size delta of the call
+            size_deltas = {}
+            for key, value in exec_ctx.app_storage_buffer.items():
+                owner = MAM.get_app_storage_owner(key)
+                if owner != MCM_APP_ID:  # the MCM storage only holds the fixed size public key hashes of the signing addresses
+                    size_deltas[owner] = size_deltas.get(owner, 0) + len(value) - len(self.app_storage.read(key))
+            for owner, size_delta in size_deltas.items():
+                if size_delta > 0 and self.storage_sizes.app_size(owner) + size_delta > self.id_to_app[owner].get_max_storage():
+                    raise Exception("App storage overflow")
 
 
         except:
-            # In case of error, the miner collect all the gas available
+            # In case of error, the miner collect all the gas available and the changes of the transaction are discarded
             if max_gas is not None: # not a dry run
                 exec_ctx.total_gas = max_gas
             exec_ctx.error = traceback.format_exc()
+            exec_ctx.events = []
+            exec_ctx.app_storage_buffer = {}
+            exec_ctx.account_storage_buffer = {}
+            exec_ctx.balance_buffer = {}
+            if next_public_key_hash is not None:
+                # the key pair is used up even if the transaction failed, the write is covered by the gas collected
+                exec_ctx.app_storage_buffer[MCM.public_key_hash_storage_key(caller_address)] = next_public_key_hash
 
         gas_used = exec_ctx.total_gas
         gas_cost = gas_used * GAS_PRICE
 
         if not dry_run:
-            caller_storage = exec_ctx.read_account_storage(caller_address, update_gas=False)
-            caller_array = MAM.parse_array(caller_storage)
-            caller_mcm_app_storage, caller_mcm_app_index = MAM.get_app_data_from_array(MCM_APP_ID, caller_array)
-            balance = MCM.get_balance(caller_mcm_app_storage)
-            caller_mcm_app_storage = MCM.set_balance(caller_mcm_app_storage, max(0, balance - gas_cost))
-            caller_array[caller_mcm_app_index] = caller_mcm_app_storage
-            caller_storage = MAM.array_to_bytes(caller_array)
-            exec_ctx.write_account_storage(caller_address, caller_storage, update_gas=False)
+            balance = exec_ctx.read_balance(caller_address, update_gas=False)
+            exec_ctx.write_balance(caller_address, max(0, balance - gas_cost), update_gas=False)
             # flush storage buffer
-            exec_ctx.persists()
+            self.persists(exec_ctx)
+            self.event_log.add_events(self.blockchain.bnum, exec_ctx.events)
+            self.blockchain.add_transaction(MAM.transaction_hash(caller_address, app_id, function_selector, function_parameters))
 
         # recompute the hash of account storage that have been charged
         for addr, data in exec_ctx.account_storage_buffer.items():
             pass #TODO: compute storage hash of each changed account
 
-        return gas_used, gas_cost, exec_ctx.error
+        return gas_used, gas_cost, exec_ctx.error, exec_ctx.events
+
+    def call_transaction(self, transaction: Transaction, public_key_hash: Union[bytes, None]):
+        """
+        Execute a signed transaction (MIP12B1). The signature must be checked beforehand by a SignatureVerifier
+        :param transaction:
+        :param public_key_hash: hash of the public key recovered from the signature, None if the envelope is malformed
+        :return: (gas used, gas cost, error, events)
+        """
+        key = MCM.public_key_hash_storage_key(transaction.caller)
+        registered = self.app_storage.read(key)
+        if len(registered) <= 0:
+            registered = transaction.caller  # first transaction of the address: the address is the beginning of the public key hash
+        if public_key_hash is None or public_key_hash[:len(registered)] != registered:
+            raise Exception("Invalid signature for {}".format(transaction.caller.hex()))
+        return self.call(False, transaction.caller, transaction.max_gas, transaction.app_id, transaction.function_selector, transaction.function_parameters,
+                         transaction.next_public_key_hash)
+
+    def call_transactions(self, envelopes: List[bytes], verifier: SignatureVerifier, batch_size: int = VERIFY_BATCH_SIZE) -> list:
+        """
+        Verify and execute signed transactions in order. The signatures of a batch are verified while the previous batch executes.
+        An envelope that is malformed, badly signed or replayed, or that calls an unknown app, is rejected without being charged
+        :return: [(gas used, gas cost, error, events), ...]
+        """
+        batches = [envelopes[i:i + batch_size] for i in range(0, len(envelopes), batch_size)]
+        results = []
+        pending = verifier.submit(batches[0]) if len(batches) > 0 else None
+        for i, batch in enumerate(batches):
+            public_key_hashes = verifier.collect(pending)
+            if i + 1 < len(batches):
+                pending = verifier.submit(batches[i + 1])
+            for envelope, public_key_hash in zip(batch, public_key_hashes):
+                try:
+                    results.append(self.call_transaction(Transaction.from_bytes(envelope), public_key_hash))
+                except:
+                    results.append((0, 0, traceback.format_exc(), []))
+        return results
 
     @staticmethod
-    def parse_array(array_storage: bytes, execution_context: ExecutionContext = ExecutionContext.no_op()):
-        execution_context.op(3)
-        if len(array_storage) <= 0:
-            return []
-        execution_context.op(1)
-        entries = []
-        execution_context.op(2)
-        size = array_storage[0]  # max 255
-        execution_context.op(2)
-        offset = 1
-        for i in range(size):
-            execution_context.op(1)
-            execution_context.op(5)
-            l = int.from_bytes(array_storage[offset:offset+DATA_LENGTH], INT_ENCODING)
-            execution_context.op(6)
-            entries.append(array_storage[offset+DATA_LENGTH:offset+DATA_LENGTH+l])
-            execution_context.op(3)
-            offset += DATA_LENGTH + l
-        return entries
+    def transaction_hash(caller_address: bytes, app_id: int, function_selector: int, function_parameters: bytes) -> bytes:
+        return hashlib.sha256(caller_address + app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + function_selector.to_bytes(FUNCTION_SELECTOR_LENGTH, INT_ENCODING)
+                              + function_parameters).digest()
+
+    def reindex(self, chunk_size: int = REPLAY_CHUNK_SIZE):
+        """
+        Rebuild the node side indexes of the MAM (storage sizes and keys owned by each instance, balance ledger and state root) from the current state.
+        The indexes of an app instance are rebuilt from the keys it owns when its app object is created
+        """
+        self.app_storage.replay(chunk_size, [self.on_app_storage_write])
+        self.account_storage.replay(chunk_size, [self.on_account_storage_write])
+
+    def reindex_app_storage_sizes(self, chunk_size: int = REPLAY_CHUNK_SIZE):
+        """
+        Rebuild only the sizes and keys of the app storage owned by each instance, which is what the max storage check of a call needs.
+        Enough for a MAM that only dry runs calls
+        """
+        self.app_storage.replay(chunk_size, [self.on_app_storage_size_write])
+
+    def on_app_storage_write(self, key: Union[int, tuple], old_value: bytes, new_value: bytes):
+        self.state_root.update(MAM.encode_storage_key(key), old_value, new_value)
+        self.on_app_storage_size_write(key, old_value, new_value)
+
+    def on_app_storage_size_write(self, key: Union[int, tuple], old_value: bytes, new_value: bytes):
+        self.storage_sizes.update_app_storage(MAM.get_app_storage_owner(key), key, len(old_value), len(new_value))
+
+    def on_account_storage_write(self, address: bytes, old_value: bytes, new_value: bytes):
+        self.state_root.update(MAM.encode_storage_key(address), old_value, new_value)
+        app_sizes = {}
+        for entry in MAM.parse_array(new_value):
+            app_sizes[int.from_bytes(entry[:APP_INSTANCE_ID_LENGTH], INT_ENCODING)] = len(entry)
+        self.storage_sizes.update_account(address, len(new_value), app_sizes)
+        balance = MCM.get_account_balance(new_value)
+        if balance is not None or address in self.balance_ledger:
+            self.balance_ledger.set(address, 0 if balance is None else balance)
+
+    def persists(self, execution_context: ExecutionContext):
+        """
+        Settle the buffered balances in the ledger in bulk (gas escrow, refund and charge, transfers), derive the MCM entries
+        of the account storages from them then flush the execution context.
+        Balances of addresses without account storage are dropped: there is no account to settle them in, and patching an
+        empty storage would create a phantom account blocking the creation of the address.
+        Its write amplification is kept in last_write_stats and added to write_stats
+        """
+        account_storages = {}
+        for address in execution_context.balance_buffer:
+            account_storage = execution_context.read_account_storage(address, update_gas=False)
+            if len(account_storage) > 0:
+                account_storages[address] = account_storage
+        addresses = list(account_storages)
+        credits = ([], [])
+        debits = ([], [])
+        for address, old_balance in zip(addresses, self.balance_ledger.get_many(addresses)):
+            delta = execution_context.balance_buffer[address] - old_balance
+            if delta != 0:
+                settlement = credits if delta > 0 else debits
+                settlement[0].append(address)
+                settlement[1].append(abs(delta))
+        self.balance_ledger.credit_many(*credits)
+        self.balance_ledger.debit_many(*debits)
+        for address, account_storage in account_storages.items():
+            balance = execution_context.balance_buffer[address]
+            execution_context.write_account_storage(address, MCM.patch_account_balance(account_storage, balance), update_gas=False)
+        execution_context.balance_buffer = {}
+        self.last_write_stats = execution_context.persists()
+        self.write_stats.add(self.last_write_stats)
 
     @staticmethod
-    def array_to_bytes(array: list, execution_context: ExecutionContext = ExecutionContext.no_op()) -> bytes:
-        execution_context.op(2)
-        if len(array) > 255:
-            raise Exception("Array is too large")
-        buffer = len(array).to_bytes(1, INT_ENCODING)
-        for e in array:
-            if len(e) > 0:
-                buffer += len(e).to_bytes(DATA_LENGTH, INT_ENCODING) + e
-        return bytes(buffer)
+    def get_app_storage_owner(key: Union[int, tuple]) -> int:
+        """
+        App storage is keyed by app id, or by (app id, sub key) for apps using several storage entries
+        """
+        return key if type(key) == int else key[0]
+
+    @staticmethod
+    def encode_storage_key(key: Union[int, tuple, bytes]) -> bytes:
+        """
+        Storage key as bytes (snapshots, logs, state root): key type(1) + app id(4) + sub key or key type(1) + address
+        """
+        if type(key) == int:
+            return bytes([KEY_TYPE_APP]) + key.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
+        elif type(key) == tuple:
+            return bytes([KEY_TYPE_APP_SUB_KEY]) + key[0].to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + key[1]
+        else:
+            return bytes([KEY_TYPE_ACCOUNT]) + key
+
+    @staticmethod
+    def decode_storage_key(data: bytes) -> Union[int, tuple, bytes]:
+        if data[0] == KEY_TYPE_APP:
+            return int.from_bytes(data[1:], INT_ENCODING)
+        elif data[0] == KEY_TYPE_APP_SUB_KEY:
+            return int.from_bytes(data[1:1 + APP_INSTANCE_ID_LENGTH], INT_ENCODING), data[1 + APP_INSTANCE_ID_LENGTH:]
+        elif data[0] == KEY_TYPE_ACCOUNT:
+            return data[1:]
+        else:
+            raise Exception("Unknown storage key type {}".format(data[0]))
 
     @staticmethod
     def set_to_array(value: bytes, array: list, index: int, execution_context: ExecutionContext = ExecutionContext.no_op()):
@@ -1286,18 +1896,3 @@ class MAM:
             if int.from_bytes(app_storage[:APP_INSTANCE_ID_LENGTH], INT_ENCODING) == app_instance_id:
                 return app_storage, i
         return bytes(0), -1
-
-    @staticmethod
-    def int_byte_size(value: int):
-        b = (value.bit_length() + 7) // 8
-        if b > (1 << (11 << DATA_LENGTH)) - 1:
-            raise Exception("Overflow")
-        return b
-
-    @staticmethod
-    def pack_int(value: int) -> bytes:
-        assert type(value) == int
-        l = MAM.int_byte_size(value)
-        return l.to_bytes(DATA_LENGTH, INT_ENCODING) + value.to_bytes(l, INT_ENCODING)
-
-
@@ -0,0 +1,76 @@
+from array import array
+from typing import Container, Dict, List, Tuple
+
+from poc_implementation.mip12.storage import Storage
+from poc_implementation.mip12.indexes import StorageSizeIndex
+from poc_implementation.mip12.ledger import BalanceLedger
+from poc_implementation.mip12.mochimo_application_machine import MCM
+
+NEO_GENESIS_INTERVAL = 256
+RENT_PER_BYTE = 1
+CHUNK_SIZE = 4096
+
+
+class RentEngine:
+    """
+    Storage rent (MIP12E1). On every neo genesis block, each account is charged RENT_PER_BYTE nMCM per byte of account storage.
+    Rent is debited from the MCM balance of the account (capped at the balance) and burnt.
+    Addresses owned by app instances are not charged
+
+    The rent due by each account is kept in a fixed width column indexed by address slot. On each pass only the accounts
+    whose size changed since the previous pass (the dirty set of the StorageSizeIndex) get their rent recomputed.
+    The debits are then applied to the BalanceLedger in chunks of chunk_size accounts and the MCM entries of the debited accounts are refreshed
+    """
+
+    def __init__(self, rent_per_byte: int = RENT_PER_BYTE, chunk_size: int = CHUNK_SIZE):
+        self.rent_per_byte = rent_per_byte
+        self.chunk_size = chunk_size
+        self.slots: Dict[bytes, int] = {}
+        self.addresses: List[bytes] = []
+        self.rents = array('Q')
+
+    @staticmethod
+    def is_rent_block(bnum: int) -> bool:
+        return bnum > 0 and bnum % NEO_GENESIS_INTERVAL == 0
+
+    def rent_due(self, storage_sizes: StorageSizeIndex, address: bytes) -> int:
+        return storage_sizes.account_size(address) * self.rent_per_byte
+
+    def refresh(self, storage_sizes: StorageSizeIndex, excluded_addresses: Container[bytes]):
+        """
+        Recompute the rent due by the accounts whose size changed since the previous refresh
+        """
+        for address in storage_sizes.take_dirty():
+            rent = 0 if address in excluded_addresses else self.rent_due(storage_sizes, address)
+            slot = self.slots.get(address)
+            if slot is None:
+                if rent <= 0:
+                    continue
+                slot = len(self.addresses)
+                self.slots[address] = slot
+                self.addresses.append(address)
+                self.rents.append(rent)
+            else:
+                self.rents[slot] = rent
+
+    def collect(self, account_storage: Storage, storage_sizes: StorageSizeIndex, balance_ledger: BalanceLedger, excluded_addresses: Container[bytes]) -> Tuple[int, int]:
+        """
+        Charge the rent of every account
+        :return: (number of accounts debited, total amount burnt)
+        """
+        self.refresh(storage_sizes, excluded_addresses)
+        charged = 0
+        burnt = 0
+        for start in range(0, len(self.addresses), self.chunk_size):
+            slots = [slot for slot in range(start, min(start + self.chunk_size, len(self.addresses)))
+                     if self.rents[slot] > 0 and self.addresses[slot] in balance_ledger]
+            addresses = [self.addresses[slot] for slot in slots]
+            debits = balance_ledger.debit_many(addresses, (self.rents[slot] for slot in slots))
+
+            for address, debit in zip(addresses, debits):
+                if debit <= 0:
+                    continue
+                account_storage.write(address, MCM.patch_account_balance(account_storage.read(address), balance_ledger.get(address)))
+                charged += 1
+                burnt += debit
+        return charged, burnt
@@ -0,0 +1,350 @@
+import itertools
+import multiprocessing
+import traceback
+from multiprocessing.connection import Connection
+from typing import Dict, Iterator, List, Tuple, Union
+
+from poc_implementation.mip12.mochimo_application_machine import MAM, MCM, MCM_APP_ID
+from poc_implementation.mip12.storage import Storage
+
+SHARD_PREFIX_LENGTH = 2  # bytes of the address prefix mapped to a shard
+SHARD_INT_ENCODING = 'big'
+
+COMMAND_READ = 0
+COMMAND_APPLY = 1
+COMMAND_CALL = 2
+COMMAND_PREPARE = 3
+COMMAND_EXECUTE = 4
+COMMAND_COMMIT = 5
+COMMAND_ABORT = 6
+COMMAND_ITEMS = 7
+COMMAND_SIZE = 8
+COMMAND_CLOSE = 9
+
+
+class Shard:
+    """
+    State of a shard process: a MAM over the accounts of the shard, which executes the MCM transactions routed to the shard,
+    and the keys locked by the prepared cross shard transactions. A command touching a locked key is refused
+    """
+
+    def __init__(self):
+        MAM.INSTANCE = None  # a forked shard process inherits the MAM of the node
+        self.mam = MAM(Storage(), Storage())
+        self.storage = self.mam.account_storage
+        self.locks: Dict[bytes, int] = {}  # key -> id of the prepared transaction that locks it
+        self.prepared: Dict[int, List[bytes]] = {}  # id of a prepared transaction -> keys it locks
+        self.writes: Dict[bytes, List[bytes]] = {}  # key -> [old value, new value] of the call being executed
+        self.recording = False
+        self.storage.add_listener(self.on_write)
+
+    def on_write(self, key: bytes, old_value: bytes, new_value: bytes):
+        if self.recording:
+            self.writes.setdefault(key, [old_value, new_value])[1] = new_value
+
+    def locked(self, keys) -> bool:
+        return any(key in self.locks for key in keys)
+
+    def call(self, transaction: Tuple[bytes, int, int, bytes]) -> Tuple[tuple, Dict[bytes, List[bytes]]]:
+        """
+        Execute an MCM transaction on the MAM of the shard. The chain and the events are kept by the coordinator
+        :param transaction: (caller address, max gas, function selector, function parameters)
+        :return: ((gas used, gas cost, error, events), {key: [old value, new value]})
+        """
+        caller, max_gas, function_selector, function_parameters = transaction
+        self.writes = {}
+        self.recording = True
+        try:
+            result = self.mam.call(False, caller, max_gas, MCM_APP_ID, function_selector, function_parameters)
+        except:
+            result = (0, 0, traceback.format_exc(), [])
+        finally:
+            self.recording = False
+        self.mam.blockchain.tx_hashes = []
+        self.mam.event_log.truncate(0)
+        return result, self.writes
+
+    def execute(self, tx_id: int, transaction: Tuple[bytes, int, int, bytes], remote_values: Dict[bytes, bytes]) -> Tuple[Union[tuple, None], Union[Dict[bytes, bytes], str]]:
+        """
+        Execute a prepared cross shard transaction with the values of its keys owned by the other shards, sent by the coordinator.
+        The remote values are written for the time of the call, then the keys written are restored: the writes are applied
+        by the commit of every shard involved
+        :return: ((gas used, gas cost, error, events), {key: new value}) or (None, error) if the call wrote a key it did not declare
+        """
+        self.storage.write_batch([(key, value, [(0, len(value))]) for key, value in remote_values.items()])
+        result, writes = self.call(transaction)
+        restored = {key: old_value for key, (old_value, new_value) in writes.items()}
+        restored.update({key: bytes(0) for key in remote_values})
+        self.storage.write_batch([(key, value, [(0, len(value))]) for key, value in restored.items()])
+        undeclared = [key for key in writes if key not in remote_values and self.locks.get(key) != tx_id]
+        if len(undeclared) > 0:
+            return None, "Transaction {} wrote undeclared keys {}".format(tx_id, [key.hex() for key in undeclared])
+        return result, {key: new_value for key, (old_value, new_value) in writes.items()}
+
+    def unlock(self, tx_id: int):
+        for key in self.prepared.pop(tx_id, []):
+            del self.locks[key]
+
+    def serve(self, connection: Connection):
+        while True:
+            command, tx_id, payload = connection.recv()
+            if command == COMMAND_READ:
+                connection.send([self.storage.read(key) for key in payload])
+            elif command == COMMAND_APPLY:
+                if self.locked(key for key, value, ranges in payload):
+                    connection.send(None)
+                    continue
+                old_values = [self.storage.read(key) for key, value, ranges in payload]
+                self.storage.write_batch(payload)
+                connection.send(old_values)
+            elif command == COMMAND_CALL:
+                caller, max_gas, function_selector, function_parameters = payload
+                if self.locked(MCM.accessed_addresses(caller, function_selector, function_parameters)):
+                    connection.send(None)
+                    continue
+                result, writes = self.call(payload)
+                connection.send((result, [(key, old_value, new_value) for key, (old_value, new_value) in writes.items()]))
+            elif command == COMMAND_PREPARE:
+                if self.locked(payload):
+                    connection.send(None)
+                    continue
+                for key in payload:
+                    self.locks[key] = tx_id
+                self.prepared[tx_id] = payload
+                connection.send([self.storage.read(key) for key in payload])
+            elif command == COMMAND_EXECUTE:
+                transaction, remote_values = payload
+                connection.send(self.execute(tx_id, transaction, remote_values))
+            elif command == COMMAND_COMMIT:
+                self.storage.write_batch(payload)
+                self.unlock(tx_id)
+                connection.send(None)
+            elif command == COMMAND_ABORT:
+                self.unlock(tx_id)
+                connection.send(None)
+            elif command == COMMAND_ITEMS:
+                connection.send([(key, value) for key, value in self.storage.items() if len(value) > 0])
+            elif command == COMMAND_SIZE:
+                values = [value for value in self.storage.db.values() if len(value) > 0]
+                connection.send((len(values), sum(len(value) for value in values)))
+            elif command == COMMAND_CLOSE:
+                connection.send(None)
+                return
+
+
+def serve_shard(connection: Connection):
+    """
+    Loop of a shard process: answers the commands of the coordinator
+    """
+    Shard().serve(connection)
+
+
+class ShardedStorage(Storage):
+    """
+    Account storage partitioned by address prefix across shard_count processes, each owning the Storage of its shard.
+    Reads are routed to the shard owning the address. A write batch is applied in one message when it touches a single shard,
+    with a two phase commit otherwise: every shard involved locks the keys it will write and votes with their old values,
+    then all commit or all abort. The listeners are called with the old values returned by the shards.
+
+    Transactions are executed by the shard processes themselves, through a ShardCoordinator
+    """
+
+    def __init__(self, shard_count: int):
+        super().__init__()
+        self.shard_count = shard_count
+        self.connections: List[Connection] = []
+        self.processes: List[multiprocessing.Process] = []
+        for i in range(shard_count):
+            connection, shard_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=serve_shard, args=(shard_connection,), daemon=True)
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.tx_ids = itertools.count(1)
+        self.reads = 0
+        self.single_shard_batches = 0
+        self.cross_shard_batches = 0
+        self.aborts = 0
+
+    def shard(self, address: bytes) -> int:
+        return int.from_bytes(address[:SHARD_PREFIX_LENGTH], SHARD_INT_ENCODING) * self.shard_count >> (8 * SHARD_PREFIX_LENGTH)
+
+    def send(self, shard: int, command: int, payload=None, tx_id: int = 0):
+        self.connections[shard].send((command, tx_id, payload))
+
+    def receive(self, shard: int):
+        return self.connections[shard].recv()
+
+    def request(self, shard: int, command: int, payload=None, tx_id: int = 0):
+        self.send(shard, command, payload, tx_id)
+        return self.receive(shard)
+
+    def prepare(self, tx_id: int, shard_keys: Dict[int, List[bytes]]) -> Union[Dict[bytes, bytes], None]:
+        """
+        First phase of a cross shard transaction: lock its keys on every shard involved
+        :return: {key: value} of the locked keys or None if a shard voted no, the transaction is then aborted on every shard
+        """
+        for shard, keys in shard_keys.items():
+            self.send(shard, COMMAND_PREPARE, keys, tx_id)
+        votes = {shard: self.receive(shard) for shard in shard_keys}
+        if any(values is None for values in votes.values()):
+            self.aborts += 1
+            for shard in shard_keys:
+                self.request(shard, COMMAND_ABORT, None, tx_id)
+            return None
+        return {key: value for shard, keys in shard_keys.items() for key, value in zip(keys, votes[shard])}
+
+    def commit(self, tx_id: int, shard_keys: Dict[int, List[bytes]], writes: Dict[bytes, bytes]):
+        """
+        Second phase of a cross shard transaction: every shard involved applies its part of the writes and releases its locks
+        """
+        for shard, keys in shard_keys.items():
+            self.send(shard, COMMAND_COMMIT, [(key, writes[key], [(0, len(writes[key]))]) for key in keys if key in writes], tx_id)
+        for shard in shard_keys:
+            self.receive(shard)
+
+    def abort(self, tx_id: int, shard_keys: Dict[int, List[bytes]]):
+        self.aborts += 1
+        for shard in shard_keys:
+            self.request(shard, COMMAND_ABORT, None, tx_id)
+
+    def notify(self, writes: List[Tuple[bytes, bytes, bytes]]):
+        """
+        Call the listeners with the (key, old value, new value) of writes applied by the shards
+        """
+        for key, old_value, new_value in writes:
+            for listener in self.listeners:
+                listener(key, old_value, new_value)
+
+    def read(self, key: bytes) -> bytes:
+        self.reads += 1
+        return self.request(self.shard(key), COMMAND_READ, [key])[0]
+
+    def write(self, key: bytes, value):
+        self.write_batch([(key, value, [(0, len(value))])])
+
+    def write_ranges(self, key: bytes, value, ranges: List[Tuple[int, int]]):
+        self.write_batch([(key, value, ranges)])
+
+    def write_batch(self, writes: List[Tuple[bytes, bytes, List[Tuple[int, int]]]]):
+        shard_writes: Dict[int, list] = {}
+        for write in writes:
+            shard_writes.setdefault(self.shard(write[0]), []).append(write)
+        old_values = {}
+        if len(shard_writes) == 1:
+            self.single_shard_batches += 1
+            shard, batch = next(iter(shard_writes.items()))
+            values = self.request(shard, COMMAND_APPLY, batch)
+            if values is None:
+                self.aborts += 1
+                raise Exception("Shard {} is locked by another transaction".format(shard))
+            old_values.update(zip((key for key, value, ranges in batch), values))
+        elif len(shard_writes) > 1:
+            self.cross_shard_batches += 1
+            tx_id = next(self.tx_ids)
+            shard_keys = {shard: [key for key, value, ranges in batch] for shard, batch in shard_writes.items()}
+            old_values = self.prepare(tx_id, shard_keys)
+            if old_values is None:
+                raise Exception("Cross shard transaction {} aborted".format(tx_id))
+            self.commit(tx_id, shard_keys, {key: value for key, value, ranges in writes})
+        self.notify([(key, old_values[key], value) for key, value, ranges in writes])
+
+    def items(self) -> Iterator[Tuple[bytes, bytes]]:
+        for shard in range(self.shard_count):
+            yield from self.request(shard, COMMAND_ITEMS)
+
+    def sizes(self) -> List[Tuple[int, int]]:
+        """
+        :return: [(key count, bytes of values), ...] of each shard
+        """
+        return [self.request(shard, COMMAND_SIZE) for shard in range(self.shard_count)]
+
+    def close(self):
+        for shard, process in enumerate(self.processes):
+            self.request(shard, COMMAND_CLOSE)
+            process.join()
+        self.connections = []
+        self.processes = []
+
+
+class ShardCoordinator:
+    """
+    Runs MCM transactions on the shard processes of a ShardedStorage, the account storage of the MAM of the node.
+    The accounts a transaction touches are known from its parameters (MCM.accessed_addresses):
+
+    - a transaction whose accounts all live in one shard is sent to that shard, which executes it on its own MAM.
+      It is not waited for: the transactions of different shards run in parallel, those of a shard run in order
+    - a cross shard transaction runs a two phase commit: every shard involved locks the keys of the transaction and votes
+      with their values, the shard of the caller executes the transaction with the values of the other shards, then every
+      shard commits its part of the writes. If a shard votes no, or the execution writes a key it did not declare, all abort
+
+    Before a cross shard transaction, the transactions in flight on its shards are collected so that its reads follow them.
+    The write sets returned by the shards are passed to the listeners of the ShardedStorage, in the order of the transactions
+    of each key, so the MAM of the node keeps its ledger, state root and indexes. Its chain and event log record the transactions.
+    Only MCM transactions are sharded: app storage is not partitioned and other apps run on the MAM of the node
+    """
+
+    def __init__(self, mam: MAM, storage: ShardedStorage):
+        self.mam = mam
+        self.storage = storage
+        self.single_shard_transactions = 0
+        self.cross_shard_transactions = 0
+
+    def call_transactions(self, transactions: List[Tuple[bytes, int, int, bytes]]) -> List[Tuple[int, int, Union[str, None], list]]:
+        """
+        :param transactions: [(caller address, max gas, function selector, function parameters), ...] of MCM calls
+        :return: (gas used, gas cost, error, events) of each transaction, error is None if the transaction succeeded
+        """
+        results = [None] * len(transactions)
+        in_flight: Dict[int, List[int]] = {}  # shard -> indexes of the transactions sent to the shard and not collected yet
+        for i, (caller, max_gas, function_selector, function_parameters) in enumerate(transactions):
+            shard_keys: Dict[int, List[bytes]] = {}
+            for address in MCM.accessed_addresses(caller, function_selector, function_parameters):
+                shard_keys.setdefault(self.storage.shard(address), []).append(address)
+            if len(shard_keys) == 1:
+                shard = next(iter(shard_keys))
+                self.storage.send(shard, COMMAND_CALL, transactions[i])
+                in_flight.setdefault(shard, []).append(i)
+                self.single_shard_transactions += 1
+                continue
+            for shard in shard_keys:
+                self.collect(shard, in_flight, transactions, results)
+            results[i] = self.call_cross_shard(transactions[i], shard_keys)
+            self.cross_shard_transactions += 1
+        for shard in list(in_flight):
+            self.collect(shard, in_flight, transactions, results)
+        return results
+
+    def collect(self, shard: int, in_flight: Dict[int, List[int]], transactions: list, results: list):
+        """
+        Collect the results of the transactions sent to a shard
+        """
+        for i in in_flight.pop(shard, []):
+            reply = self.storage.receive(shard)
+            if reply is None:
+                results[i] = (0, 0, "Shard {} is locked by another transaction".format(shard), [])
+                continue
+            results[i], writes = reply
+            self.storage.notify(writes)
+            self.record(transactions[i], results[i])
+
+    def call_cross_shard(self, transaction: Tuple[bytes, int, int, bytes], shard_keys: Dict[int, List[bytes]]) -> Tuple[int, int, Union[str, None], list]:
+        tx_id = next(self.storage.tx_ids)
+        values = self.storage.prepare(tx_id, shard_keys)
+        if values is None:
+            return 0, 0, "Cross shard transaction {} aborted".format(tx_id), []
+        home = self.storage.shard(transaction[0])
+        remote_values = {key: value for key, value in values.items() if self.storage.shard(key) != home}
+        result, writes = self.storage.request(home, COMMAND_EXECUTE, (transaction, remote_values), tx_id)
+        if result is None:
+            self.storage.abort(tx_id, shard_keys)
+            return 0, 0, writes, []
+        self.storage.commit(tx_id, shard_keys, writes)
+        self.storage.notify([(key, values[key], value) for key, value in writes.items()])
+        self.record(transaction, result)
+        return result
+
+    def record(self, transaction: Tuple[bytes, int, int, bytes], result: Tuple[int, int, Union[str, None], list]):
+        caller, max_gas, function_selector, function_parameters = transaction
+        self.mam.event_log.add_events(self.mam.blockchain.bnum, result[3])
+        self.mam.blockchain.add_transaction(MAM.transaction_hash(caller, MCM_APP_ID, function_selector, function_parameters))
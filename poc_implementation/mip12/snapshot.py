@@ -0,0 +1,278 @@
+import os
+import bisect
+import hashlib
+import mmap
+from array import array
+from typing import Dict, Iterator, List, Set, Tuple, Union
+
+from poc_implementation.mip12.storage import Storage, CachedStorage, FilteredStorage
+from poc_implementation.mip12.bloom import BloomFilter, BLOOM_CAPACITY
+from poc_implementation.mip12.ledger import MappedBalanceLedger, ADDRESS_LENGTH, BALANCE_LENGTH
+from poc_implementation.mip12.application import ApplicationTemplate
+from poc_implementation.mip12.mochimo_application_machine import MAM, APP_TEMPLATE_TYPE_MCM, MCM_APP_ID, APP_INSTANCE_ID_LENGTH, INT_ENCODING
+
+SNAPSHOT_MAGIC = b'MIP12SNP'
+SNAPSHOT_VERSION = 1
+CHUNK_SIZE = 256  # entries per chunk
+BLOOM_FILE_SUFFIX = '.bloom'  # bloom filter of the account addresses saved next to the snapshot
+
+SECTION_APP_STORAGE = 0
+SECTION_ACCOUNT_STORAGE = 1
+
+BNUM_LENGTH = 8
+OFFSET_LENGTH = 8
+COUNT_LENGTH = 4
+KEY_LENGTH_LENGTH = 2
+VALUE_LENGTH_LENGTH = 4
+CHECKSUM_LENGTH = 32
+FOOTER_LENGTH = OFFSET_LENGTH + CHECKSUM_LENGTH + len(SNAPSHOT_MAGIC)
+
+
+class Snapshot:
+    """
+    Chunked and checksummed snapshot of the MAM state, to start a node without replaying every transaction.
+
+    Header:
+    magic + version(1) + bnum(8) + next instance id(4) + template count(4) + [template type(4), ...]
+    + instance count(4) + [instance id(4) + template type(4), ...]
+
+    Then the chunks of app storage and account storage. Keys are encoded with MAM.encode_storage_key and sorted, each chunk holds up to chunk_size entries:
+    [key length(2) + key + value length(4) + value, ...]
+
+    Then the balance ledger (sorted addresses column then balances column, 8 bytes aligned), the directory:
+    chunk count(4) + ledger offset(8) + ledger count(4) + ledger checksum(32)
+    + [section(1) + offset(8) + length(4) + entry count(4) + checksum(32) + first key length(2) + first key, ...]
+    and the footer: directory offset(8) + checksum of header and directory(32) + magic
+
+    A loaded snapshot is mapped in memory: the header and the directory are parsed eagerly, a chunk is only read
+    and checked against its checksum when a key it holds is read. The ledger columns are used in place
+    """
+
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)  # private mapping so that the ledger column can be updated in place
+        mm = self.mm
+        if len(mm) < len(SNAPSHOT_MAGIC) + FOOTER_LENGTH or mm[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC or mm[-len(SNAPSHOT_MAGIC):] != SNAPSHOT_MAGIC:
+            raise Exception("Not a snapshot {}".format(path))
+
+        offset = len(SNAPSHOT_MAGIC)
+        if mm[offset] != SNAPSHOT_VERSION:
+            raise Exception("Unsupported snapshot version {}".format(mm[offset]))
+        offset += 1
+        self.bnum, offset = Snapshot.read_int(mm, offset, BNUM_LENGTH)
+        self.next_instance_id, offset = Snapshot.read_int(mm, offset, APP_INSTANCE_ID_LENGTH)
+        count, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+        self.template_types: List[int] = []
+        for i in range(count):
+            template_type, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+            self.template_types.append(template_type)
+        count, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+        self.instances: List[Tuple[int, int]] = []
+        for i in range(count):
+            instance_id, offset = Snapshot.read_int(mm, offset, APP_INSTANCE_ID_LENGTH)
+            template_type, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+            self.instances.append((instance_id, template_type))
+        header_end = offset
+
+        footer = len(mm) - FOOTER_LENGTH
+        directory_offset, offset = Snapshot.read_int(mm, footer, OFFSET_LENGTH)
+        self.checksum = mm[offset:offset + CHECKSUM_LENGTH]
+        if hashlib.sha256(mm[:header_end] + mm[directory_offset:footer]).digest() != self.checksum:
+            raise Exception("Corrupted snapshot header {}".format(path))
+
+        offset = directory_offset
+        count, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+        self.ledger_offset, offset = Snapshot.read_int(mm, offset, OFFSET_LENGTH)
+        self.ledger_count, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+        self.ledger_checksum = mm[offset:offset + CHECKSUM_LENGTH]
+        offset += CHECKSUM_LENGTH
+        self.chunks: List[Tuple[int, int, int, int, bytes]] = []  # (section, offset, length, entry count, checksum)
+        self.section_chunks: Dict[int, List[int]] = {SECTION_APP_STORAGE: [], SECTION_ACCOUNT_STORAGE: []}
+        self.section_first_keys: Dict[int, List[bytes]] = {SECTION_APP_STORAGE: [], SECTION_ACCOUNT_STORAGE: []}
+        for i in range(count):
+            section = mm[offset]
+            offset += 1
+            chunk_offset, offset = Snapshot.read_int(mm, offset, OFFSET_LENGTH)
+            chunk_length, offset = Snapshot.read_int(mm, offset, VALUE_LENGTH_LENGTH)
+            entry_count, offset = Snapshot.read_int(mm, offset, COUNT_LENGTH)
+            checksum = mm[offset:offset + CHECKSUM_LENGTH]
+            offset += CHECKSUM_LENGTH
+            l, offset = Snapshot.read_int(mm, offset, KEY_LENGTH_LENGTH)
+            self.section_chunks[section].append(len(self.chunks))
+            self.section_first_keys[section].append(mm[offset:offset + l])
+            offset += l
+            self.chunks.append((section, chunk_offset, chunk_length, entry_count, checksum))
+
+        self.verified_chunks: Set[int] = set()
+
+    @staticmethod
+    def read_int(data: Union[bytes, mmap.mmap], offset: int, length: int) -> (int, int):
+        return int.from_bytes(data[offset:offset + length], INT_ENCODING), offset + length
+
+    def entries(self, index: int) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        :return: the (encoded key, value) of the chunk, in key order
+        """
+        section, chunk_offset, chunk_length, entry_count, checksum = self.chunks[index]
+        if index not in self.verified_chunks:
+            if hashlib.sha256(self.mm[chunk_offset:chunk_offset + chunk_length]).digest() != checksum:
+                raise Exception("Corrupted snapshot chunk {}".format(index))
+            self.verified_chunks.add(index)
+        offset = chunk_offset
+        for i in range(entry_count):
+            l, offset = Snapshot.read_int(self.mm, offset, KEY_LENGTH_LENGTH)
+            key = self.mm[offset:offset + l]
+            offset += l
+            l, offset = Snapshot.read_int(self.mm, offset, VALUE_LENGTH_LENGTH)
+            yield key, self.mm[offset:offset + l]
+            offset += l
+
+    def read(self, section: int, key) -> bytes:
+        encoded_key = MAM.encode_storage_key(key)
+        i = bisect.bisect_right(self.section_first_keys[section], encoded_key) - 1
+        if i < 0:
+            return bytes(0)
+        for entry_key, value in self.entries(self.section_chunks[section][i]):
+            if entry_key == encoded_key:
+                return value
+            if entry_key > encoded_key:
+                break
+        return bytes(0)
+
+    def items(self, section: int) -> Iterator[Tuple[object, bytes]]:
+        for index in self.section_chunks[section]:
+            for key, value in self.entries(index):
+                yield MAM.decode_storage_key(key), value
+
+    def verify(self):
+        """
+        Check every chunk against its checksum. Chunks are otherwise checked when they are first read
+        """
+        for index in range(len(self.chunks)):
+            for entry in self.entries(index):
+                pass
+
+    def balance_ledger(self) -> MappedBalanceLedger:
+        addresses_length = self.ledger_count * ADDRESS_LENGTH
+        balances_offset = Snapshot.align(self.ledger_offset + addresses_length)
+        balances_length = self.ledger_count * BALANCE_LENGTH
+        checksum = hashlib.sha256(self.mm[self.ledger_offset:self.ledger_offset + addresses_length])
+        checksum.update(self.mm[balances_offset:balances_offset + balances_length])
+        if checksum.digest() != self.ledger_checksum:
+            raise Exception("Corrupted snapshot balance ledger")
+        view = memoryview(self.mm)
+        return MappedBalanceLedger(view[self.ledger_offset:self.ledger_offset + addresses_length], view[balances_offset:balances_offset + balances_length].cast('Q'))
+
+    @staticmethod
+    def align(offset: int) -> int:
+        return (offset + BALANCE_LENGTH - 1) // BALANCE_LENGTH * BALANCE_LENGTH
+
+    @staticmethod
+    def save(mam: MAM, path: str, chunk_size: int = CHUNK_SIZE):
+        """
+        Write the state of the MAM to path. The snapshot is written to a temporary file then renamed so that a crash never leaves a partial snapshot.
+        A bloom filter of the account addresses is written next to it, prefixed with the checksum of the snapshot header,
+        so that a loaded snapshot answers reads of unknown addresses without a chunk lookup
+        """
+        header = SNAPSHOT_MAGIC + bytes([SNAPSHOT_VERSION]) + mam.blockchain.bnum.to_bytes(BNUM_LENGTH, INT_ENCODING) \
+            + mam.next_instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
+        header += len(mam.app_templates).to_bytes(COUNT_LENGTH, INT_ENCODING) + b''.join(at.type.to_bytes(COUNT_LENGTH, INT_ENCODING) for at in mam.app_templates)
+        instances = [(app_id, template_type) for app_id, template_type in sorted(mam.id_to_app.template_types.items()) if app_id != MCM_APP_ID]
+        header += len(instances).to_bytes(COUNT_LENGTH, INT_ENCODING) \
+            + b''.join(app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + template_type.to_bytes(COUNT_LENGTH, INT_ENCODING) for app_id, template_type in instances)
+
+        directory = bytes(0)
+        chunk_count = 0
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            offset = len(header)
+            for section, storage in [(SECTION_APP_STORAGE, mam.app_storage), (SECTION_ACCOUNT_STORAGE, mam.account_storage)]:
+                keys = sorted((MAM.encode_storage_key(key), key) for chunk in storage.scan(chunk_size) for key, value in chunk if len(value) > 0)
+                for start in range(0, len(keys), chunk_size):
+                    entries = keys[start:start + chunk_size]
+                    payload = bytearray()
+                    for encoded_key, key in entries:
+                        value = storage.read(key)
+                        payload += len(encoded_key).to_bytes(KEY_LENGTH_LENGTH, INT_ENCODING) + encoded_key + len(value).to_bytes(VALUE_LENGTH_LENGTH, INT_ENCODING) + value
+                    f.write(payload)
+                    first_key = entries[0][0]
+                    directory += bytes([section]) + offset.to_bytes(OFFSET_LENGTH, INT_ENCODING) + len(payload).to_bytes(VALUE_LENGTH_LENGTH, INT_ENCODING) \
+                        + len(entries).to_bytes(COUNT_LENGTH, INT_ENCODING) + hashlib.sha256(payload).digest() \
+                        + len(first_key).to_bytes(KEY_LENGTH_LENGTH, INT_ENCODING) + first_key
+                    offset += len(payload)
+                    chunk_count += 1
+                if section == SECTION_ACCOUNT_STORAGE:
+                    accounts = [key for encoded_key, key in keys]
+
+            ledger = sorted(mam.balance_ledger.items())
+            addresses = b''.join(address for address, balance in ledger)
+            balances = bytes(array('Q', (balance for address, balance in ledger)))
+            padding = bytes(Snapshot.align(offset + len(addresses)) - offset - len(addresses))
+            f.write(addresses + padding + balances)
+            directory = chunk_count.to_bytes(COUNT_LENGTH, INT_ENCODING) + offset.to_bytes(OFFSET_LENGTH, INT_ENCODING) \
+                + len(ledger).to_bytes(COUNT_LENGTH, INT_ENCODING) + hashlib.sha256(addresses + balances).digest() + directory
+            offset += len(addresses) + len(padding) + len(balances)
+
+            f.write(directory)
+            checksum = hashlib.sha256(header + directory).digest()
+            f.write(offset.to_bytes(OFFSET_LENGTH, INT_ENCODING) + checksum + SNAPSHOT_MAGIC)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(path + BLOOM_FILE_SUFFIX, 'wb') as f:
+            f.write(checksum + BloomFilter.build(accounts, max(BLOOM_CAPACITY, 2 * len(accounts))).to_bytes())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str, reindex: bool = True) -> MAM:
+        """
+        Start a MAM from a snapshot. State reads and balances are served from the mapped snapshot right away.
+        The node side indexes (storage sizes, order books, inboxes, holders) are rebuilt with a pass over the state
+        unless reindex is False, in which case MAM.reindex must be called before they are queried, before rent is charged
+        and before an app object whose indexes are needed is created
+        """
+        snapshot = Snapshot(path)
+        account_storage = SnapshotStorage(snapshot, SECTION_ACCOUNT_STORAGE)
+        if os.path.exists(path + BLOOM_FILE_SUFFIX):
+            with open(path + BLOOM_FILE_SUFFIX, 'rb') as f:
+                data = f.read()
+            if data[:CHECKSUM_LENGTH] == snapshot.checksum:  # a filter left by a crash while another snapshot was saved is ignored
+                account_storage = FilteredStorage(account_storage, BloomFilter.from_bytes(data[CHECKSUM_LENGTH:]))
+        mam = MAM(CachedStorage(SnapshotStorage(snapshot, SECTION_APP_STORAGE)), CachedStorage(account_storage))
+        for template_type in snapshot.template_types:
+            if template_type != APP_TEMPLATE_TYPE_MCM:
+                mam.add_app_template(ApplicationTemplate(_type=template_type))
+        for instance_id, template_type in snapshot.instances:
+            mam.register_instance(template_type, instance_id)
+        mam.next_instance_id = snapshot.next_instance_id
+        mam.blockchain.bnum = snapshot.bnum
+        mam.balance_ledger = snapshot.balance_ledger()
+        if reindex:
+            mam.reindex()
+        return mam
+
+
+class SnapshotStorage(Storage):
+    """
+    Storage backed by a section of a snapshot. Keys written since the snapshot was loaded live in db, the others are read
+    from the snapshot on demand. Snapshot reads go through a chunk, a snapshot storage is meant to be used behind a CachedStorage
+    """
+
+    def __init__(self, snapshot: Snapshot, section: int):
+        super().__init__()
+        self.snapshot = snapshot
+        self.section = section
+
+    def read(self, key) -> bytes:
+        if key in self.db:
+            return self.db[key]
+        return self.snapshot.read(self.section, key)
+
+    def items(self) -> Iterator[Tuple[object, bytes]]:
+        written = list(self.db)
+        written_keys = set(written)
+        for key, value in self.snapshot.items(self.section):
+            if key not in written_keys:
+                yield key, self.db.get(key, value)
+        for key in written:
+            yield key, self.db[key]
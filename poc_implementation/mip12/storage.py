@@ -1,9 +1,22 @@
+import itertools
+from collections import OrderedDict
+from typing import Callable, Iterator, List, Tuple, Union
+
+from poc_implementation.mip12.bloom import BloomFilter, BLOOM_CAPACITY
+
+DIFF_BLOCK_SIZE = 32  # values are compared by blocks of this size before the changed ranges are narrowed down to the byte
+CACHE_CAPACITY = 16 * 1024 * 1024  # bytes of values kept by a ReadCache
+CACHE_ENTRY_OVERHEAD = 64  # bytes accounted for the key and bookkeeping of a cached value
+
+
 class Storage:
     """
     A key-value database. ETH Go uses LevelDB
+    Listeners are called with (key, old value, new value) on every write. They are used to maintain node side indexes
     """
     def __init__(self):
         self.db = {}
+        self.listeners: List[Callable[[object, bytes, bytes], None]] = []
 
     def read(self, key) -> bytes:
         if key not in self.db:
@@ -11,4 +24,248 @@ class Storage:
         return self.db[key]
 
     def write(self, key, value):
+        old_value = self.read(key) if len(self.listeners) > 0 else None
         self.db[key] = value
+        for listener in self.listeners:
+            listener(key, old_value, value)
+
+    def write_ranges(self, key, value, ranges: List[Tuple[int, int]]):
+        """
+        Write a value of which only the given [start, end) ranges differ from the stored value. A backend able to patch values in place
+        only has to write the ranges, as Storage.apply_ranges does: a range ending at len(value) also sets the length of the stored value,
+        so a value that shrinks ends with such a range, possibly empty. The value is rewritten by default
+        """
+        self.write(key, value)
+
+    def write_batch(self, writes: List[Tuple[object, bytes, List[Tuple[int, int]]]]):
+        """
+        Write the [(key, value, changed ranges), ...] of an execution context. A backend spread over several stores
+        (e.g. shards) sends each store its part of the batch at once, the writes are applied one by one by default
+        """
+        for key, value, ranges in writes:
+            self.write_ranges(key, value, ranges)
+
+    @staticmethod
+    def changed_ranges(old_value: bytes, new_value: bytes, block_size: int = DIFF_BLOCK_SIZE) -> List[Tuple[int, int]]:
+        """
+        :return: the [start, end) ranges of new_value that differ from old_value, bytes appended to old_value are a changed range
+        and a new_value shorter than old_value ends with a range ending at its length (the empty range (len(new_value), len(new_value)) if needed).
+        Differences are found block by block and the ends of each range are narrowed down to the byte
+        """
+        ranges = []
+        length = min(len(old_value), len(new_value))
+        for start in range(0, length, block_size):
+            end = min(start + block_size, length)
+            if old_value[start:end] == new_value[start:end]:
+                continue
+            while old_value[start] == new_value[start]:
+                start += 1
+            while old_value[end - 1] == new_value[end - 1]:
+                end -= 1
+            if len(ranges) > 0 and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+        if len(new_value) > length:
+            if len(ranges) > 0 and ranges[-1][1] == length:
+                ranges[-1] = (ranges[-1][0], len(new_value))
+            else:
+                ranges.append((length, len(new_value)))
+        elif len(old_value) > length and (len(ranges) <= 0 or ranges[-1][1] != length):
+            ranges.append((length, length))  # truncation
+        return ranges
+
+    @staticmethod
+    def apply_ranges(stored_value: bytes, value: bytes, ranges: List[Tuple[int, int]]) -> bytes:
+        """
+        Patch a stored value with the ranges of value, as a backend patching values in place would
+        :return: the patched value
+        """
+        patched = bytearray(stored_value)
+        for start, end in ranges:
+            patched[start:end] = value[start:end]
+            if end == len(value):
+                del patched[end:]
+        return bytes(patched)
+
+    def add_listener(self, listener: Callable[[object, bytes, bytes], None]):
+        self.listeners.append(listener)
+
+    def items(self) -> Iterator[Tuple[object, bytes]]:
+        return iter(self.db.items())
+
+    def scan(self, chunk_size: int) -> Iterator[List[Tuple[object, bytes]]]:
+        """
+        Iterate over the whole database in chunks of at most chunk_size (key, value) pairs so that a full pass runs in bounded memory
+        Values of existing keys can be overwritten between two chunks, new keys must not be added
+        """
+        items = self.items()
+        while True:
+            chunk = list(itertools.islice(items, chunk_size))
+            if len(chunk) <= 0:
+                return
+            yield chunk
+
+    def replay(self, chunk_size: int, listeners: List[Callable[[object, bytes, bytes], None]] = None):
+        """
+        Call the listeners (all of them by default) with (key, empty value, value) for every key, as if the database was written from scratch.
+        Used to rebuild the node side indexes of a state that was not built by running transactions
+        """
+        if listeners is None:
+            listeners = self.listeners
+        for chunk in self.scan(chunk_size):
+            for key, value in chunk:
+                for listener in listeners:
+                    listener(key, bytes(0), value)
+
+    def replay_keys(self, keys: List[object], listeners: List[Callable[[object, bytes, bytes], None]] = None):
+        """
+        Replay only the given keys, read one by one. Used to rebuild the indexes of a part of the state whose keys are known
+        """
+        if listeners is None:
+            listeners = self.listeners
+        for key in keys:
+            value = self.read(key)
+            for listener in listeners:
+                listener(key, bytes(0), value)
+
+
+class ReadCache:
+    """
+    LRU cache of storage values bounded in bytes: a value costs its length plus CACHE_ENTRY_OVERHEAD.
+    Counts hits, misses and evictions
+    """
+
+    def __init__(self, capacity: int = CACHE_CAPACITY):
+        self.capacity = capacity
+        self.size = 0
+        self.values: 'OrderedDict[object, bytes]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.values)
+
+    def get(self, key) -> Union[bytes, None]:
+        value = self.values.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.values.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value: bytes):
+        self.invalidate(key)
+        cost = len(value) + CACHE_ENTRY_OVERHEAD
+        if cost > self.capacity:
+            return
+        self.values[key] = value
+        self.size += cost
+        while self.size > self.capacity:
+            key, value = self.values.popitem(last=False)
+            self.size -= len(value) + CACHE_ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def invalidate(self, key):
+        value = self.values.pop(key, None)
+        if value is not None:
+            self.size -= len(value) + CACHE_ENTRY_OVERHEAD
+
+    def hit_rate(self) -> float:
+        return self.hits / max(1, self.hits + self.misses)
+
+    def __repr__(self):
+        return "{} values ({} bytes), {} hits, {} misses ({:.1%} hit rate), {} evictions".format(len(self.values), self.size, self.hits, self.misses, self.hit_rate(), self.evictions)
+
+
+class CachedStorage(Storage):
+    """
+    Read cache in front of a storage backend (e.g. a disk backed store) so that the keys read by every transaction
+    (pool accounts, app storages, exchange wallets) are not fetched from the backend again on each call.
+    Writes go through to the backend and refresh the cached value, listeners are registered on the CachedStorage
+    """
+
+    def __init__(self, backend: Storage, capacity: int = CACHE_CAPACITY):
+        super().__init__()
+        self.backend = backend
+        self.cache = ReadCache(capacity)
+
+    def read(self, key) -> bytes:
+        value = self.cache.get(key)
+        if value is None:
+            value = self.backend.read(key)
+            self.cache.put(key, value)
+        return value
+
+    def write(self, key, value):
+        self.write_ranges(key, value, [(0, len(value))])
+
+    def write_ranges(self, key, value, ranges: List[Tuple[int, int]]):
+        self.write_batch([(key, value, ranges)])
+
+    def write_batch(self, writes: List[Tuple[object, bytes, List[Tuple[int, int]]]]):
+        old_values = [self.read(key) for key, value, ranges in writes] if len(self.listeners) > 0 else None
+        self.backend.write_batch(writes)
+        for key, value, ranges in writes:
+            self.cache.put(key, value)
+        if old_values is not None:
+            for (key, value, ranges), old_value in zip(writes, old_values):
+                for listener in self.listeners:
+                    listener(key, old_value, value)
+
+    def items(self) -> Iterator[Tuple[object, bytes]]:
+        return self.backend.items()
+
+
+class FilteredStorage(Storage):
+    """
+    Bloom filter of the existing keys in front of a storage backend, for storages keyed by bytes (account storage).
+    Reads of keys the filter has never seen (account creation, transfers to fresh addresses) return an empty value without
+    reaching the backend. The filter is updated on every write and rebuilt from the backend with twice the capacity when it is full.
+    Counts the reads skipped and the false positives
+    """
+
+    def __init__(self, backend: Storage, bloom_filter: BloomFilter = None):
+        super().__init__()
+        self.backend = backend
+        self.filter = BloomFilter.build((key for key, value in backend.items() if len(value) > 0), BLOOM_CAPACITY) if bloom_filter is None else bloom_filter
+        self.reads = 0
+        self.skipped_reads = 0
+        self.false_positives = 0
+
+    def read(self, key: bytes) -> bytes:
+        self.reads += 1
+        if not self.filter.might_contain(key):
+            self.skipped_reads += 1
+            return bytes(0)
+        value = self.backend.read(key)
+        if len(value) <= 0:
+            self.false_positives += 1
+        return value
+
+    def write(self, key: bytes, value):
+        self.write_ranges(key, value, [(0, len(value))])
+
+    def write_ranges(self, key: bytes, value, ranges: List[Tuple[int, int]]):
+        self.write_batch([(key, value, ranges)])
+
+    def write_batch(self, writes: List[Tuple[bytes, bytes, List[Tuple[int, int]]]]):
+        old_values = [self.read(key) for key, value, ranges in writes] if len(self.listeners) > 0 else None
+        self.backend.write_batch(writes)
+        for key, value, ranges in writes:
+            if len(value) > 0:
+                self.filter.add(key)
+        if self.filter.is_full():
+            self.filter = BloomFilter.build((key for key, value in self.backend.items() if len(value) > 0), self.filter.capacity * 2, self.filter.false_positive_rate)
+        if old_values is not None:
+            for (key, value, ranges), old_value in zip(writes, old_values):
+                for listener in self.listeners:
+                    listener(key, old_value, value)
+
+    def items(self) -> Iterator[Tuple[object, bytes]]:
+        return self.backend.items()
+
+    def __repr__(self):
+        return "{} keys in filter, {} reads, {} skipped, {} false positives".format(self.filter.count, self.reads, self.skipped_reads, self.false_positives)
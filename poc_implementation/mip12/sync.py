@@ -0,0 +1,65 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from poc_implementation.mip12.blockchain import Blockchain, BlockTrailer, TRAILER_LENGTH
+
+SYNC_BATCH_SIZE = 256  # trailers per request
+SYNC_DEPTH = 4  # requests in flight
+PEER_LATENCY = 0.005  # seconds of round trip of the stand-in peer
+
+
+class LocalPeer:
+    """
+    Stand-in for a remote node serving the trailers of its chain. Each request costs a round trip of latency seconds
+    """
+
+    def __init__(self, trailers: List[BlockTrailer], latency: float = PEER_LATENCY):
+        self.trailers = [trailer.to_bytes() for trailer in trailers]
+        self.latency = latency
+        self.requests = 0
+
+    def height(self) -> int:
+        time.sleep(self.latency)
+        return len(self.trailers)
+
+    def get_trailers(self, start: int, count: int) -> bytes:
+        """
+        :return: the concatenated trailers of the blocks start to start + count (excluded)
+        """
+        time.sleep(self.latency)
+        self.requests += 1
+        return b''.join(self.trailers[start:start + count])
+
+
+class TrailerSync:
+    """
+    Headers first sync: download the trailers of the chain of a peer, check their hashes and their links and append them to a blockchain.
+    Trailers are requested by batches of batch_size and depth requests are kept in flight: the next batches download while
+    the current one is validated and stored, so the sync time is bounded by the hashing of the trailers rather than by round trips
+    """
+
+    def __init__(self, peer: LocalPeer, batch_size: int = SYNC_BATCH_SIZE, depth: int = SYNC_DEPTH):
+        self.peer = peer
+        self.batch_size = batch_size
+        self.depth = depth
+
+    def sync(self, blockchain: Blockchain) -> int:
+        """
+        :return: the number of trailers added to the blockchain
+        """
+        height = self.peer.height()
+        starts = list(range(blockchain.bnum, height, self.batch_size))
+        added = 0
+        with ThreadPoolExecutor(self.depth) as executor:
+            pending = [executor.submit(self.peer.get_trailers, start, self.batch_size) for start in starts[:self.depth]]
+            for i, start in enumerate(starts):
+                data = pending[i].result()
+                if i + self.depth < len(starts):
+                    pending.append(executor.submit(self.peer.get_trailers, starts[i + self.depth], self.batch_size))
+                if len(data) % TRAILER_LENGTH != 0 or len(data) <= 0:
+                    raise Exception("Invalid trailers batch from block {}".format(start))
+                for offset in range(0, len(data), TRAILER_LENGTH):
+                    blockchain.add_trailer(BlockTrailer.from_bytes(data[offset:offset + TRAILER_LENGTH]))
+                    added += 1
+        return added
@@ -0,0 +1,186 @@
+import hashlib
+import multiprocessing
+from collections import OrderedDict
+from typing import List, Tuple, Union
+
+from poc_implementation.mip12.wots import WOTS, PUB_SEED_LENGTH, WOTS_SIG_LENGTH
+from poc_implementation.mip12.ledger import ADDRESS_LENGTH
+
+TX_INT_ENCODING = 'big'
+MAX_GAS_LENGTH = 8
+APP_ID_LENGTH = 4
+FUNCTION_SELECTOR_LENGTH = 4
+PUBLIC_KEY_HASH_LENGTH = 32
+PARAMETERS_LENGTH_LENGTH = 4
+KEY_INDEX_LENGTH = 4
+
+VERIFIED_CACHE_SIZE = 100000  # envelope hash -> public key hash of the signatures already verified
+VERIFY_BATCH_SIZE = 256  # transactions verified while the previous batch executes
+VERIFY_CHUNK_SIZE = 16  # transactions sent to a worker at once
+
+
+class Transaction:
+    """
+    Signed transaction envelope (MIP12B1):
+    caller(12) + max gas(8) + app id(4) + function selector(4) + next public key hash(32) + parameters length(4) + parameters
+    + public seed(32) + WOTS signature
+
+    The signature covers the hash of everything before the public seed. WOTS keys are one time keys: every transaction
+    registers the hash of the public key that will sign the next transaction of the caller
+    """
+
+    def __init__(self, caller: bytes, max_gas: int, app_id: int, function_selector: int, function_parameters: bytes, next_public_key_hash: bytes,
+                 pub_seed: bytes = bytes(PUB_SEED_LENGTH), signature: bytes = bytes(0)):
+        self.caller = caller
+        self.max_gas = max_gas
+        self.app_id = app_id
+        self.function_selector = function_selector
+        self.function_parameters = function_parameters
+        self.next_public_key_hash = next_public_key_hash
+        self.pub_seed = pub_seed
+        self.signature = signature
+
+    def body(self) -> bytes:
+        return self.caller + self.max_gas.to_bytes(MAX_GAS_LENGTH, TX_INT_ENCODING) + self.app_id.to_bytes(APP_ID_LENGTH, TX_INT_ENCODING) \
+            + self.function_selector.to_bytes(FUNCTION_SELECTOR_LENGTH, TX_INT_ENCODING) + self.next_public_key_hash \
+            + len(self.function_parameters).to_bytes(PARAMETERS_LENGTH_LENGTH, TX_INT_ENCODING) + self.function_parameters
+
+    def hash(self) -> bytes:
+        return hashlib.sha256(self.body()).digest()
+
+    def to_bytes(self) -> bytes:
+        return self.body() + self.pub_seed + self.signature
+
+    @staticmethod
+    def from_bytes(data: bytes) -> 'Transaction':
+        offset = 0
+        caller = data[offset:offset + ADDRESS_LENGTH]
+        offset += ADDRESS_LENGTH
+        max_gas = int.from_bytes(data[offset:offset + MAX_GAS_LENGTH], TX_INT_ENCODING)
+        offset += MAX_GAS_LENGTH
+        app_id = int.from_bytes(data[offset:offset + APP_ID_LENGTH], TX_INT_ENCODING)
+        offset += APP_ID_LENGTH
+        function_selector = int.from_bytes(data[offset:offset + FUNCTION_SELECTOR_LENGTH], TX_INT_ENCODING)
+        offset += FUNCTION_SELECTOR_LENGTH
+        next_public_key_hash = data[offset:offset + PUBLIC_KEY_HASH_LENGTH]
+        offset += PUBLIC_KEY_HASH_LENGTH
+        l = int.from_bytes(data[offset:offset + PARAMETERS_LENGTH_LENGTH], TX_INT_ENCODING)
+        offset += PARAMETERS_LENGTH_LENGTH
+        function_parameters = data[offset:offset + l]
+        offset += l
+        pub_seed = data[offset:offset + PUB_SEED_LENGTH]
+        offset += PUB_SEED_LENGTH
+        signature = data[offset:]
+        if len(signature) != WOTS_SIG_LENGTH or len(pub_seed) != PUB_SEED_LENGTH or len(function_parameters) != l:
+            raise Exception("Malformed transaction")
+        return Transaction(caller, max_gas, app_id, function_selector, function_parameters, next_public_key_hash, pub_seed, signature)
+
+    def public_key_hash(self) -> bytes:
+        """
+        :return: the hash of the public key recovered from the signature. The signature is valid if it matches the public key hash registered for the caller
+        """
+        return WOTS.public_key_hash(WOTS.public_key_from_signature(self.signature, self.hash(), self.pub_seed), self.pub_seed)
+
+
+def recover_public_key_hash(envelope: bytes) -> Union[bytes, None]:
+    """
+    Worker side of the SignatureVerifier
+    :return: the public key hash recovered from the envelope signature or None if the envelope is malformed
+    """
+    try:
+        return Transaction.from_bytes(envelope).public_key_hash()
+    except Exception:
+        return None
+
+
+class SignatureVerifier:
+    """
+    Recovers the public key hash of transaction envelopes. Hash based signatures are CPU heavy so the recovery runs
+    in a pool of processes (processes=0 recovers in the calling process) and a batch can be submitted while the previous one executes.
+
+    The recovered public key hashes are kept in a LRU cache keyed by the hash of the whole envelope so that a transaction
+    seen by the mempool and then in a block is only verified once
+    """
+
+    def __init__(self, processes: int = None, cache_size: int = VERIFIED_CACHE_SIZE):
+        self.pool = None if processes == 0 else multiprocessing.Pool(processes)
+        self.cache_size = cache_size
+        self.cache: 'OrderedDict[bytes, Union[bytes, None]]' = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def submit(self, envelopes: List[bytes]) -> Tuple[list, list, object]:
+        """
+        Start the verification of the envelopes that are not in the cache
+        :return: a pending verification to pass to collect
+        """
+        results = []
+        missing = []
+        for i, envelope in enumerate(envelopes):
+            envelope_hash = hashlib.sha256(envelope).digest()
+            if envelope_hash in self.cache:
+                self.cache.move_to_end(envelope_hash)
+                results.append(self.cache[envelope_hash])
+                self.hits += 1
+            else:
+                results.append(None)
+                missing.append((i, envelope_hash))
+                self.misses += 1
+        to_verify = [envelopes[i] for i, envelope_hash in missing]
+        if self.pool is None:
+            pending = [recover_public_key_hash(envelope) for envelope in to_verify]
+        else:
+            pending = self.pool.map_async(recover_public_key_hash, to_verify, chunksize=VERIFY_CHUNK_SIZE)
+        return results, missing, pending
+
+    def collect(self, verification: Tuple[list, list, object]) -> List[Union[bytes, None]]:
+        """
+        Wait for a pending verification
+        :return: the public key hash recovered from each envelope, None for the malformed ones
+        """
+        results, missing, pending = verification
+        public_key_hashes = pending if self.pool is None else pending.get()
+        for (i, envelope_hash), public_key_hash in zip(missing, public_key_hashes):
+            results[i] = public_key_hash
+            self.cache[envelope_hash] = public_key_hash
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return results
+
+    def verify(self, envelopes: List[bytes]) -> List[Union[bytes, None]]:
+        return self.collect(self.submit(envelopes))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class Signer:
+    """
+    WOTS key chain of an account. The key pair i is derived from the secret seed and i. Each transaction is signed
+    with the current key pair and registers the hash of the next public key.
+    The address of the account is the beginning of the hash of its first public key
+    """
+
+    def __init__(self, seed: bytes, index: int = 0):
+        self.seed = seed
+        self.pub_seed = hashlib.sha256(b'pub_seed' + seed).digest()
+        self.index = index
+        self.address = self.public_key_hash(0)[:ADDRESS_LENGTH]
+
+    def key_seed(self, index: int) -> bytes:
+        return hashlib.sha256(self.seed + index.to_bytes(KEY_INDEX_LENGTH, TX_INT_ENCODING)).digest()
+
+    def public_key_hash(self, index: int) -> bytes:
+        return WOTS.public_key_hash(WOTS.public_key(self.key_seed(index), self.pub_seed), self.pub_seed)
+
+    def sign(self, max_gas: int, app_id: int, function_selector: int, function_parameters: bytes) -> bytes:
+        """
+        :return: the signed envelope of the transaction. The current key pair is used up
+        """
+        tx = Transaction(self.address, max_gas, app_id, function_selector, function_parameters, self.public_key_hash(self.index + 1), self.pub_seed)
+        tx.signature = WOTS.sign(tx.hash(), self.key_seed(self.index), self.pub_seed)
+        self.index += 1
+        return tx.to_bytes()
@@ -0,0 +1,89 @@
+from collections import deque
+from typing import Deque, Dict
+
+from poc_implementation.mip12.mochimo_application_machine import MAM
+
+FINALITY_DEPTH = 64  # blocks after which a block is final and its undo journal is dropped
+
+
+class UndoJournal:
+    """
+    Prior values of the keys written by a block: the value each key had before its first write of the block.
+    Along with the next instance id and the template count at the start of the block, to unregister what the block created
+    """
+
+    def __init__(self, next_instance_id: int, template_count: int):
+        self.next_instance_id = next_instance_id
+        self.template_count = template_count
+        self.app_storage: Dict[object, bytes] = {}
+        self.account_storage: Dict[bytes, bytes] = {}
+
+    def __len__(self):
+        return len(self.app_storage) + len(self.account_storage)
+
+
+class UndoLog:
+    """
+    Undo journals of the last finality_depth blocks. The prior values are collected by a storage listener, so the writes of
+    the execution contexts, of the end of block processing and of the storage rent are all journaled. The journal of a block
+    is sealed when the block is mined, older journals are dropped: a block deeper than finality_depth cannot be rolled back.
+
+    Rolling back writes the prior values back through the storages, newest block first, so the node side indexes and the
+    state root follow. The cost is proportional to the write sets of the blocks rolled back, not to the size of the state
+    """
+
+    def __init__(self, mam: MAM, finality_depth: int = FINALITY_DEPTH):
+        self.mam = mam
+        self.finality_depth = finality_depth
+        self.journals: Deque[UndoJournal] = deque(maxlen=finality_depth)
+        self.journal = UndoJournal(mam.next_instance_id, len(mam.app_templates))  # journal of the block being built
+        self.recording = True
+        mam.app_storage.add_listener(self.on_app_storage_write)
+        mam.account_storage.add_listener(self.on_account_storage_write)
+        mam.undo_log = self
+
+    def on_app_storage_write(self, key, old_value: bytes, new_value: bytes):
+        if self.recording and key not in self.journal.app_storage:
+            self.journal.app_storage[key] = old_value
+
+    def on_account_storage_write(self, address: bytes, old_value: bytes, new_value: bytes):
+        if self.recording and address not in self.journal.account_storage:
+            self.journal.account_storage[address] = old_value
+
+    def seal(self):
+        """
+        Keep the journal of the block that was just mined and start the one of the next block
+        """
+        self.journals.append(self.journal)
+        self.journal = UndoJournal(self.mam.next_instance_id, len(self.mam.app_templates))
+
+    def rollback(self, count: int) -> int:
+        """
+        Discard the block being built and roll back the last count mined blocks: state, instances, templates, events and trailers.
+        A write ahead log is checkpointed as its records of the blocks rolled back no longer apply
+        :return: the number of keys restored
+        """
+        if count < 0 or count > len(self.journals):
+            raise Exception("Cannot roll back {} blocks, only the last {} blocks can be".format(count, len(self.journals)))
+        mam = self.mam
+        journals = [self.journal] + [self.journals.pop() for i in range(count)]
+        restored = 0
+        self.recording = False
+        try:
+            for journal in journals:
+                mam.app_storage.write_batch([(key, value, [(0, len(value))]) for key, value in journal.app_storage.items()])
+                mam.account_storage.write_batch([(address, value, [(0, len(value))]) for address, value in journal.account_storage.items()])
+                restored += len(journal)
+        finally:
+            self.recording = True
+        oldest = journals[-1]
+        for app_id in [app_id for app_id in mam.id_to_app if app_id >= oldest.next_instance_id]:
+            mam.id_to_app.remove(app_id)
+        mam.next_instance_id = oldest.next_instance_id
+        del mam.app_templates[oldest.template_count:]
+        mam.blockchain.rollback(count)
+        mam.event_log.truncate(mam.blockchain.bnum)
+        self.journal = UndoJournal(mam.next_instance_id, len(mam.app_templates))
+        if mam.write_ahead_log is not None:
+            mam.write_ahead_log.checkpoint()
+        return restored
@@ -0,0 +1,166 @@
+import os
+import hashlib
+from typing import Dict, List, Tuple, Union
+
+from poc_implementation.mip12.application import ApplicationTemplate
+from poc_implementation.mip12.mochimo_application_machine import MAM, APP_INSTANCE_ID_LENGTH, INT_ENCODING
+from poc_implementation.mip12.snapshot import Snapshot, SECTION_APP_STORAGE, SECTION_ACCOUNT_STORAGE, BNUM_LENGTH, COUNT_LENGTH, KEY_LENGTH_LENGTH, VALUE_LENGTH_LENGTH, CHECKSUM_LENGTH
+
+WAL_MAGIC = b'MWAL'
+RECORD_LENGTH_LENGTH = 4
+RECORD_HEADER_LENGTH = len(WAL_MAGIC) + BNUM_LENGTH + RECORD_LENGTH_LENGTH
+CHECKPOINT_INTERVAL = 256  # blocks logged between two snapshots
+
+
+class WriteAheadLog:
+    """
+    Write ahead log of the state writes, grouped by block. The writes of both storages are collected by a storage listener
+    during the block and the whole write set of the block is appended as a single record when the block is mined,
+    with a single fsync (group commit). A crash in the middle of a block loses the block, never half of it.
+
+    Record: magic + bnum(8) + payload length(4) + payload + checksum of everything before(32)
+    Payload: next instance id(4) + template count(4) + [template type(4), ...] + instance count(4) + [instance id(4) + template type(4), ...]
+    + entry count(4) + [section(1) + key length(2) + key + value length(4) + value, ...]
+    The templates and instances are the ones registered during the block, keys are encoded as in a snapshot, bnum is the block number
+    reached once the record is applied.
+
+    The log holds the blocks mined since the last snapshot: on checkpoint a snapshot is written and the log starts over.
+    On recovery the snapshot is loaded, the complete records are replayed and a torn last record is cut off
+    """
+
+    def __init__(self, path: str, mam: MAM, checkpoint_interval: int = CHECKPOINT_INTERVAL):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.checkpoint_interval = checkpoint_interval
+        self.mam = mam
+        self.f = open(path, 'ab')
+        self.writes: Dict[Tuple[int, object], bytes] = {}  # (section, key) -> value written during the block
+        self.template_types = [at.type for at in mam.app_templates]
+        self.instance_ids = set(mam.id_to_app)
+        self.logged_blocks = 0
+        self.fsyncs = 0
+        self.bytes_logged = 0
+        mam.app_storage.add_listener(self.on_app_storage_write)
+        mam.account_storage.add_listener(self.on_account_storage_write)
+        mam.write_ahead_log = self
+
+    def on_app_storage_write(self, key, old_value: bytes, new_value: bytes):
+        self.writes[(SECTION_APP_STORAGE, key)] = new_value
+
+    def on_account_storage_write(self, key, old_value: bytes, new_value: bytes):
+        self.writes[(SECTION_ACCOUNT_STORAGE, key)] = new_value
+
+    def commit(self):
+        """
+        Append the write set of the block that was just mined to the log and make it durable.
+        A snapshot is taken every checkpoint_interval blocks
+        """
+        mam = self.mam
+        templates = [at.type for at in mam.app_templates if at.type not in self.template_types]
+        instances = [(app_id, template_type) for app_id, template_type in sorted(mam.id_to_app.template_types.items()) if app_id not in self.instance_ids]
+        payload = bytearray(mam.next_instance_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING))
+        payload += len(templates).to_bytes(COUNT_LENGTH, INT_ENCODING) + b''.join(t.to_bytes(COUNT_LENGTH, INT_ENCODING) for t in templates)
+        payload += len(instances).to_bytes(COUNT_LENGTH, INT_ENCODING) \
+            + b''.join(app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + template_type.to_bytes(COUNT_LENGTH, INT_ENCODING) for app_id, template_type in instances)
+        payload += len(self.writes).to_bytes(COUNT_LENGTH, INT_ENCODING)
+        for (section, key), value in self.writes.items():
+            encoded_key = MAM.encode_storage_key(key)
+            payload += bytes([section]) + len(encoded_key).to_bytes(KEY_LENGTH_LENGTH, INT_ENCODING) + encoded_key + len(value).to_bytes(VALUE_LENGTH_LENGTH, INT_ENCODING) + value
+        record = WAL_MAGIC + mam.blockchain.bnum.to_bytes(BNUM_LENGTH, INT_ENCODING) + len(payload).to_bytes(RECORD_LENGTH_LENGTH, INT_ENCODING) + payload
+        record += hashlib.sha256(record).digest()
+
+        self.f.write(record)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.fsyncs += 1
+        self.bytes_logged += len(record)
+        self.writes = {}
+        self.template_types.extend(templates)
+        self.instance_ids.update(app_id for app_id, template_type in instances)
+        self.logged_blocks += 1
+        if self.logged_blocks >= self.checkpoint_interval:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """
+        Snapshot the state at the current block and start the log over. Must be called between two blocks.
+        Records of blocks covered by the snapshot are skipped on recovery so a crash between the two steps is harmless.
+        Pending writes, templates and instances are covered by the snapshot as well (e.g. after a rollback)
+        """
+        Snapshot.save(self.mam, self.snapshot_path)
+        self.f.truncate(0)
+        self.writes = {}
+        self.template_types = [at.type for at in self.mam.app_templates]
+        self.instance_ids = set(self.mam.id_to_app)
+        self.logged_blocks = 0
+
+    def close(self):
+        self.f.close()
+
+    @staticmethod
+    def read_records(path: str) -> Tuple[List[Tuple[int, bytes]], int]:
+        """
+        :return: ([(bnum, payload), ...] of the complete records, length of the log up to the end of the last complete record)
+        """
+        records = []
+        if not os.path.exists(path):
+            return records, 0
+        with open(path, 'rb') as f:
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER_LENGTH <= len(data) and data[offset:offset + len(WAL_MAGIC)] == WAL_MAGIC:
+            bnum, o = Snapshot.read_int(data, offset + len(WAL_MAGIC), BNUM_LENGTH)
+            l, o = Snapshot.read_int(data, o, RECORD_LENGTH_LENGTH)
+            end = o + l + CHECKSUM_LENGTH
+            if end > len(data) or hashlib.sha256(data[offset:o + l]).digest() != data[o + l:end]:
+                break  # torn record of a block that was being logged
+            records.append((bnum, data[o:o + l]))
+            offset = end
+        return records, offset
+
+    @staticmethod
+    def apply(mam: MAM, bnum: int, payload: bytes):
+        storages = {SECTION_APP_STORAGE: mam.app_storage, SECTION_ACCOUNT_STORAGE: mam.account_storage}
+        mam.next_instance_id, offset = Snapshot.read_int(payload, 0, APP_INSTANCE_ID_LENGTH)
+        count, offset = Snapshot.read_int(payload, offset, COUNT_LENGTH)
+        for i in range(count):
+            template_type, offset = Snapshot.read_int(payload, offset, COUNT_LENGTH)
+            mam.add_app_template(ApplicationTemplate(_type=template_type))
+        count, offset = Snapshot.read_int(payload, offset, COUNT_LENGTH)
+        for i in range(count):
+            instance_id, offset = Snapshot.read_int(payload, offset, APP_INSTANCE_ID_LENGTH)
+            template_type, offset = Snapshot.read_int(payload, offset, COUNT_LENGTH)
+            mam.register_instance(template_type, instance_id)
+        count, offset = Snapshot.read_int(payload, offset, COUNT_LENGTH)
+        for i in range(count):
+            section = payload[offset]
+            l, offset = Snapshot.read_int(payload, offset + 1, KEY_LENGTH_LENGTH)
+            key = MAM.decode_storage_key(payload[offset:offset + l])
+            l, offset = Snapshot.read_int(payload, offset + l, VALUE_LENGTH_LENGTH)
+            storages[section].write(key, payload[offset:offset + l])
+            offset += l
+        mam.blockchain.bnum = bnum
+
+    @staticmethod
+    def recover(path: str, checkpoint_interval: int = CHECKPOINT_INTERVAL) -> Union['WriteAheadLog', None]:
+        """
+        Restart a node from its last snapshot and log. The blocks completely logged after the snapshot are replayed,
+        a block that was being logged when the node stopped is discarded. MAM.INSTANCE must be None
+        :return: the log of the recovered MAM, None if there is nothing to recover
+        """
+        records, length = WriteAheadLog.read_records(path)
+        snapshot_path = path + '.snapshot'
+        if os.path.exists(snapshot_path):
+            mam = Snapshot.load(snapshot_path)
+        elif len(records) > 0:
+            mam = MAM()
+        else:
+            return None
+        for bnum, payload in records:
+            if bnum > mam.blockchain.bnum:
+                WriteAheadLog.apply(mam, bnum, payload)
+        with open(path, 'ab') as f:
+            f.truncate(length)
+        wal = WriteAheadLog(path, mam, checkpoint_interval)
+        wal.logged_blocks = len(records)
+        return wal
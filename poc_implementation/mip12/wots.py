@@ -0,0 +1,68 @@
+import hashlib
+from typing import List
+
+WOTS_N = 32  # hash length
+WOTS_W = 16  # Winternitz parameter, each chain encodes 4 bits
+WOTS_LOG_W = 4
+WOTS_LEN1 = WOTS_N * 8 // WOTS_LOG_W  # message chains
+WOTS_LEN2 = 3  # checksum chains, the checksum is at most WOTS_LEN1 * (WOTS_W - 1) < WOTS_W ** WOTS_LEN2
+WOTS_LEN = WOTS_LEN1 + WOTS_LEN2
+WOTS_PK_LENGTH = WOTS_LEN * WOTS_N
+WOTS_SIG_LENGTH = WOTS_LEN * WOTS_N
+PUB_SEED_LENGTH = WOTS_N
+CHAIN_INDEX_LENGTH = 2
+CHAIN_STEP_LENGTH = 1
+
+
+class WOTS:
+    """
+    Hash based Winternitz one time signature (MIP12B1), WOTS+ flavor: every hash of a chain is keyed with the public seed,
+    the chain index and the step in the chain.
+    A key pair must sign a single message. The ledger stores a hash of the public key and the public key is recovered from the signature
+    """
+
+    @staticmethod
+    def chain(x: bytes, start: int, steps: int, pub_seed: bytes, chain_index: int) -> bytes:
+        prefix = pub_seed + chain_index.to_bytes(CHAIN_INDEX_LENGTH, 'big')
+        for step in range(start, start + steps):
+            x = hashlib.sha256(prefix + step.to_bytes(CHAIN_STEP_LENGTH, 'big') + x).digest()
+        return x
+
+    @staticmethod
+    def digits(msg_hash: bytes) -> List[int]:
+        """
+        :return: the WOTS_LEN base w digits of the message hash followed by its checksum
+        """
+        digits = []
+        for b in msg_hash:
+            digits.append(b >> WOTS_LOG_W)
+            digits.append(b & (WOTS_W - 1))
+        checksum = sum(WOTS_W - 1 - d for d in digits)
+        for i in reversed(range(WOTS_LEN2)):
+            digits.append((checksum >> (i * WOTS_LOG_W)) & (WOTS_W - 1))
+        return digits
+
+    @staticmethod
+    def secret_key(seed: bytes, chain_index: int) -> bytes:
+        return hashlib.sha256(seed + chain_index.to_bytes(CHAIN_INDEX_LENGTH, 'big')).digest()
+
+    @staticmethod
+    def public_key(seed: bytes, pub_seed: bytes) -> bytes:
+        return b''.join(WOTS.chain(WOTS.secret_key(seed, i), 0, WOTS_W - 1, pub_seed, i) for i in range(WOTS_LEN))
+
+    @staticmethod
+    def sign(msg_hash: bytes, seed: bytes, pub_seed: bytes) -> bytes:
+        return b''.join(WOTS.chain(WOTS.secret_key(seed, i), 0, d, pub_seed, i) for i, d in enumerate(WOTS.digits(msg_hash)))
+
+    @staticmethod
+    def public_key_from_signature(signature: bytes, msg_hash: bytes, pub_seed: bytes) -> bytes:
+        if len(signature) != WOTS_SIG_LENGTH:
+            raise Exception("Invalid WOTS signature length {}".format(len(signature)))
+        return b''.join(WOTS.chain(signature[i * WOTS_N:(i + 1) * WOTS_N], d, WOTS_W - 1 - d, pub_seed, i) for i, d in enumerate(WOTS.digits(msg_hash)))
+
+    @staticmethod
+    def public_key_hash(public_key: bytes, pub_seed: bytes) -> bytes:
+        """
+        Hash of the public key stored by the ledger
+        """
+        return hashlib.sha256(pub_seed + public_key).digest()
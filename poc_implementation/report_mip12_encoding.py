@@ -0,0 +1,78 @@
+"""
+Size report of the storage encodings on a synthetic state.
+Every account holds an MCM balance, 0 to 4 tokens and half of them a chat message
+"""
+import sys
+import time
+import random
+import hashlib
+
+from poc_implementation.mip12.mochimo_application_machine import MAM, MCM, Assets
+from poc_implementation.mip12.mochimo_application_machine import APP_TEMPLATE_TYPE_ASSETS, APP_TEMPLATE_TYPE_CHAT
+from poc_implementation.mip12.mochimo_application_machine import MCM_APP_ID, APP_INSTANCE_ID_LENGTH, INT_ENCODING, STR_ENCODING
+from poc_implementation.mip12.encoding import Encoding, ENCODING_VERSION_FIXED, ENCODING_VERSION_VARINT
+from poc_implementation.mip12.application import ApplicationTemplate
+from poc_implementation.mip12.rent import RentEngine
+
+TOKENS = ['LAMA', 'FIAT', 'GOLD', 'MOON']
+
+
+def build_state(encoding_version: int, account_count: int, seed: int) -> MAM:
+    Encoding.VERSION = encoding_version
+    MAM.INSTANCE = None  # each encoding is measured on its own state
+    mam = MAM()
+    mam.add_app_template(ApplicationTemplate(_type=APP_TEMPLATE_TYPE_ASSETS))
+    assets_app_id = mam.create_instance(APP_TEMPLATE_TYPE_ASSETS)
+    mam.add_app_template(ApplicationTemplate(_type=APP_TEMPLATE_TYPE_CHAT))
+    chat_app_id = mam.create_instance(APP_TEMPLATE_TYPE_CHAT)
+
+    rnd = random.Random(seed)
+    for i in range(account_count):
+        address = i.to_bytes(12, INT_ENCODING)
+        balance = rnd.randint(1, 10 ** rnd.randint(3, 12))
+        account_array = [MCM_APP_ID.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(MCM.BALANCE_LENGTH) + balance.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)]
+
+        assets_entry = bytes(0)
+        for symbol in rnd.sample(TOKENS, rnd.randint(0, len(TOKENS))):
+            assets_entry = Assets.update_balance(assets_app_id, assets_entry, symbol, Assets.TYPE_FUNGIBLE, rnd.randint(1, 10 ** rnd.randint(1, 18)))
+        if len(assets_entry) > 0:
+            account_array.append(assets_entry)
+
+        if rnd.random() < 0.5:
+            recipient = rnd.randint(0, account_count - 1).to_bytes(12, INT_ENCODING)
+            msg = 'gm {}'.format(i).encode(STR_ENCODING)
+            account_array.append(chat_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(len(recipient)) + recipient + MAM.pack_length(len(msg)) + msg)
+
+        mam.account_storage.write(address, MAM.account_array_to_bytes(account_array))
+    return mam
+
+
+def report(encoding_version: int, mam: MAM) -> dict:
+    start = time.perf_counter()
+    h = hashlib.sha256()
+    for address in sorted(mam.account_storage.db):
+        h.update(mam.account_storage.db[address])
+    hash_time = time.perf_counter() - start
+
+    rent_engine = RentEngine()
+    sizes = mam.storage_sizes
+    return {
+        'version': encoding_version,
+        'accounts': len(sizes.account_sizes),
+        'account bytes': sum(sizes.account_sizes.values()),
+        'MCM bytes': sum(app_sizes.get(MCM_APP_ID, 0) for app_sizes in sizes.account_app_sizes.values()),
+        'rent due': sum(rent_engine.rent_due(sizes, address) for address in sizes.account_sizes),
+        'hash ms': round(hash_time * 1000, 2),
+    }
+
+
+if __name__ == "__main__":
+    account_count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rows = [report(v, build_state(v, account_count, 12)) for v in [ENCODING_VERSION_FIXED, ENCODING_VERSION_VARINT]]
+    Encoding.VERSION = ENCODING_VERSION_FIXED
+
+    columns = list(rows[0])
+    print(' | '.join('{:>13}'.format(c) for c in columns))
+    for row in rows:
+        print(' | '.join('{:>13}'.format(row[c]) for c in columns))
+    print('compact / fixed account bytes: {:.1%}'.format(rows[1]['account bytes'] / rows[0]['account bytes']))
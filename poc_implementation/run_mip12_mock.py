@@ -2,74 +2,97 @@ from typing import List
 import sys
 import logging
 import secrets
+import os
+import time
+import tempfile
 
 
 from poc_implementation.mip12.mochimo_application_machine import MAM, Chat
 from poc_implementation.mip12.mochimo_application_machine import APP_TEMPLATE_TYPE_ASSETS, APP_TEMPLATE_TYPE_AMM, APP_TEMPLATE_TYPE_MARKETPLACE, APP_TEMPLATE_TYPE_CHAT
-from poc_implementation.mip12.mochimo_application_machine import MCM, Assets
-from poc_implementation.mip12.mochimo_application_machine import MCM_APP_ID, APP_INSTANCE_ID_LENGTH,  INT_ENCODING, STR_ENCODING, DATA_LENGTH
+from poc_implementation.mip12.mochimo_application_machine import MCM, Assets, AMM, MarketPlace
+from poc_implementation.mip12.mochimo_application_machine import MCM_APP_ID, APP_INSTANCE_ID_LENGTH,  INT_ENCODING, STR_ENCODING
+from poc_implementation.mip12.encoding import Encoding, ENCODING_VERSION_VARINT
 from poc_implementation.mip12.application import ApplicationTemplate
+from poc_implementation.mip12.rent import RentEngine, NEO_GENESIS_INTERVAL
+from poc_implementation.mip12.snapshot import Snapshot, BNUM_LENGTH
+from poc_implementation.mip12.storage import Storage, CachedStorage, FilteredStorage
+from poc_implementation.mip12.sharding import ShardedStorage, ShardCoordinator
+from poc_implementation.mip12.blockchain import Blockchain, StateRoot
+from poc_implementation.mip12.sync import LocalPeer, TrailerSync
+from poc_implementation.mip12.transaction import Signer, SignatureVerifier
+from poc_implementation.mip12.estimation import GasEstimator
+from poc_implementation.mip12.wal import WriteAheadLog, WAL_MAGIC
+from poc_implementation.mip12.undo import UndoLog
 
 
-def payload_send_msg(sender, msg_destination, msg_content):
-    logger.info("Sending msg with address {}".format(account_address_1_str))
-    msg_dst = "@world".encode(STR_ENCODING)
-    msg_content = "Hello !".encode(STR_ENCODING)
-    payload = len(msg_dst).to_bytes(2, INT_ENCODING) + msg_dst + len(msg_content).to_bytes(2, INT_ENCODING) + msg_content
+def payload_create_address(new_address: bytes, amount: int):
+    return MCM.FUNCTIONS[1].encode(new_address, amount)
 
 
-def payload_create_address(new_address: bytes, amount: int):
-    return new_address + amount.to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
+def payload_transfer_mcm(transfers: List[tuple]):
+    return MCM.FUNCTIONS[2].encode([(amount, destination, bytes(0)) for amount, destination in transfers])
 
 
 def payload_create_token(token: bytes, admin: bytes):
-    token_data = MAM.pack_int(0) + MAM.pack_int(18)
-    return token + int(Assets.TYPE_FUNGIBLE).to_bytes(1, INT_ENCODING) + admin + MAM.array_to_bytes([]) + len(token_data).to_bytes(DATA_LENGTH, INT_ENCODING) + token_data
+    return Assets.FUNCTIONS[1].encode(token, Assets.TYPE_FUNGIBLE, admin, [], MAM.pack_int(0) + MAM.pack_int(18))
 
 
 def payload_mint_token(token: bytes, amount: int, destination: bytes):
-    return token + MAM.array_to_bytes([MAM.pack_int(amount) + destination])
+    return Assets.FUNCTIONS[2].encode(token, [(amount, destination)])
+
+
+def payload_bulk_mint(token: bytes, recipients: List[tuple], start: bool):
+    return Assets.FUNCTIONS[6].encode(token, Assets.AIRDROP_FLAG_START if start else 0, recipients)
 
 
 def payload_transfer_token(token: bytes, amount: int, destination: bytes):
-    return MAM.array_to_bytes([token + MAM.pack_int(amount) + destination])
+    return Assets.FUNCTIONS[3].encode([(token, amount, destination)])
 
 
 def payload_create_pool(token_a: bytes, amount_a: int, token_b: bytes, amount_b: int, fee_bps: int):
-    return token_a + MAM.pack_int(amount_a) + token_b + MAM.pack_int(amount_b) + fee_bps.to_bytes(2, INT_ENCODING) + assets_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
+    return AMM.FUNCTIONS[1].encode(token_a, amount_a, token_b, amount_b, fee_bps, assets_app_id)
+
 
+def payload_swap(token_in: bytes, token_out: bytes, amount_in: int, min_amount_out: int):
+    return AMM.FUNCTIONS[5].encode(token_in, token_out, amount_in, min_amount_out)
 
-def payload_swap(a_to_b: bool, amount_in: int, min_amount_out: int):
-    return int(1 if a_to_b else 0).to_bytes(1, INT_ENCODING) + MAM.pack_int(amount_in) + MAM.pack_int(min_amount_out)
+
+def payload_add_liquidity(token_a: bytes, token_b: bytes, amount_a: int, max_amount_b: int):
+    return AMM.FUNCTIONS[3].encode(token_a, token_b, amount_a, max_amount_b)
+
+
+def payload_pool(token_a: bytes, token_b: bytes):
+    return AMM.FUNCTIONS[4].encode(token_a, token_b)
 
 
 def payload_create_marketplace():
-    return MAM.pack_int(0) + MAM.pack_int(0) + assets_app_id.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING)
+    return MarketPlace.FUNCTIONS[1].encode(0, 0, assets_app_id)
 
 
 def payload_list_marketplace(goods_token: bytes, good_amount: int, price_token: bytes, price_amount: int,):
-    goods = MAM.array_to_bytes([goods_token + MAM.pack_int(good_amount)])
-    prices = MAM.array_to_bytes([price_token + MAM.pack_int(price_amount)])
-    return len(goods).to_bytes(DATA_LENGTH, INT_ENCODING) + goods + len(prices).to_bytes(DATA_LENGTH, INT_ENCODING) + prices
+    return MarketPlace.FUNCTIONS[2].encode([goods_token + MAM.pack_int(good_amount)], [price_token + MAM.pack_int(price_amount)], None)
 
 
-def payload_match_marketplace(offer_address: bytes, offer_id: int):
-    return offer_address + MAM.pack_int(offer_id)
+def payload_match_marketplace(offer_id: int):
+    return MarketPlace.FUNCTIONS[3].encode(offer_id)
 
 
 def payload_send_msg(recipient: bytes, msg: bytes):
-    return len(recipient).to_bytes(DATA_LENGTH, INT_ENCODING) + recipient + len(msg).to_bytes(DATA_LENGTH, INT_ENCODING) + msg
+    return Chat.FUNCTIONS[1].encode(recipient, msg)
 
 
 def execute(caller, app_id, function_selector, function_param):
-    expected_gas_used, expected_gas_cost, expected_error = mam.call(True, caller, None, app_id, function_selector, function_param)
+    expected_gas_used, expected_gas_cost, expected_error, expected_events = mam.call(True, caller, None, app_id, function_selector, function_param)
     if expected_error is not None:
         raise Exception("Error on dry run:\t{}".format(expected_error))
     logger.info("Expected gas:\t{} / {} nMCM".format(expected_gas_used, expected_gas_cost))
-    gas_used, gas_cost, error = mam.call(False, caller, expected_gas_used, app_id, function_selector, function_param)
+    gas_used, gas_cost, error, events = mam.call(False, caller, expected_gas_used, app_id, function_selector, function_param)
     if expected_error is not None:
         raise Exception("Error on dry run:\t{}".format(expected_error))
     logger.info("Gas used:\t{} / {} nMCM".format(expected_gas_used, expected_gas_cost))
+    logger.info("Writes:\t{}".format(mam.last_write_stats))
+    for event in events:
+        logger.info("Event:\t{}".format(event))
     assert expected_gas_used == gas_used
 
 
@@ -106,7 +129,11 @@ if __name__ == "__main__":
     logger.setLevel(logging.DEBUG)
     logging.basicConfig(level=logging.INFO, format=log_format, stream=sys.stdout)
 
-    mam = MAM()
+    if '--compact' in sys.argv:
+        Encoding.VERSION = ENCODING_VERSION_VARINT
+    mam = MAM(CachedStorage(Storage()), CachedStorage(FilteredStorage(Storage())))  # the in-memory storages stand for disk backed stores
+    wal_path = os.path.join(tempfile.mkdtemp(), 'mip12.wal')
+    wal = WriteAheadLog(wal_path, mam)
 
     assets_template = ApplicationTemplate(_type=APP_TEMPLATE_TYPE_ASSETS)
     mam.add_app_template(assets_template)
@@ -135,7 +162,7 @@ if __name__ == "__main__":
 
     mam.account_storage.write(account_address_1, 
                               MAM.account_array_to_bytes([
-                                                            MCM_APP_ID.to_bytes(DATA_LENGTH, INT_ENCODING) + int(1_000_000).to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
+                                                            MCM_APP_ID.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(MCM.BALANCE_LENGTH) + int(1_000_000).to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)
                               ]))
 
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
@@ -147,7 +174,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Creating token {} with account {}".format(lama_token.decode(STR_ENCODING), account_address_1_str))
     create_token_payload = payload_create_token(lama_token, account_address_1)
@@ -155,7 +182,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Minting 1337000 {} token to account {}".format(lama_token.decode(STR_ENCODING), account_address_2_str))
     mint_token_payload = payload_mint_token(lama_token, 1337_000, account_address_2)
@@ -163,7 +190,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Transferring 777_000 {} token from {} to {}".format(lama_token.decode(STR_ENCODING), account_address_2_str, account_address_1_str))
     transfer_token_payload = payload_transfer_token(lama_token, 777_000, account_address_1)
@@ -171,7 +198,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Creating token {} with account {}".format(fiat_token.decode(STR_ENCODING), account_address_1_str))
     create_token_payload = payload_create_token(fiat_token, account_address_1)
@@ -179,7 +206,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Minting 102400 {} token to account {}".format(fiat_token.decode(STR_ENCODING), account_address_2_str))
     mint_token_payload = payload_mint_token(fiat_token, 1024_00, account_address_2)
@@ -187,7 +214,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Transferring 51200 {} token from {} to {}".format(fiat_token.decode(STR_ENCODING), account_address_2_str, account_address_1_str))
     transfer_token_payload = payload_transfer_token(fiat_token, 512_00, account_address_1)
@@ -195,23 +222,55 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Creating {} {}/{} {} AMM pool with account {}".format(100_000, lama_token.decode(STR_ENCODING), 100_00, fiat_token.decode(STR_ENCODING), account_address_1_str))
     create_pool_payload = payload_create_pool(lama_token, 100_000, fiat_token, 100_00, 30)
     execute(account_address_1, amm_app_id, 1, create_pool_payload)
+    for pool in AMM.list_pools(amm_app_id, mam.app_storage):
+        logger.info("Pool {}/{}: reserves {}/{}, {} LP".format(pool['token_a'], pool['token_b'], pool['token_a_reserve'], pool['token_b_reserve'], pool['total_lp']))
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Swapping 1000 {} for 9000 {} (minimum) with account {}".format(fiat_token.decode(STR_ENCODING), lama_token.decode(STR_ENCODING), account_address_2_str))
-    swap_payload = payload_swap(False, 10_00, 9000)
+    swap_payload = payload_swap(fiat_token, lama_token, 10_00, 9000)
     execute(account_address_2, amm_app_id, 5, swap_payload)
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
+
+    logger.info("Adding {} {} of liquidity (max {} {}) with account {}".format(10_000, lama_token.decode(STR_ENCODING), 2_000, fiat_token.decode(STR_ENCODING), account_address_2_str))
+    add_liquidity_payload = payload_add_liquidity(lama_token, fiat_token, 10_000, 2_000)
+    execute(account_address_2, amm_app_id, 3, add_liquidity_payload)
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
+
+    mam.mine_block()
+
+    logger.info("Swapping 5000 {} for 400 {} (minimum) with account {}".format(lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING), account_address_1_str))
+    swap_payload = payload_swap(lama_token, fiat_token, 5_000, 400)
+    execute(account_address_1, amm_app_id, 5, swap_payload)
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
+
+    mam.mine_block()
+
+    logger.info("Claiming AMM fees with account {}".format(account_address_1_str))
+    execute(account_address_1, amm_app_id, 6, payload_pool(lama_token, fiat_token))
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
+
+    mam.mine_block()
+
+    logger.info("Withdrawing AMM liquidity with account {}".format(account_address_2_str))
+    execute(account_address_2, amm_app_id, 4, payload_pool(lama_token, fiat_token))
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
+
+    mam.mine_block()
 
     logger.info("Creating marketplace with account {}".format(account_address_1_str))
     create_marketplace_payload = payload_create_marketplace()
@@ -219,7 +278,7 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
     logger.info("Listing offer 1 {} for 1 {} on marketplace with account {}".format(lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING), account_address_2_str))
     list_marketplace_payload = payload_list_marketplace(lama_token, 1, fiat_token, 1)
@@ -227,22 +286,247 @@ if __name__ == "__main__":
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
 
+    best_offer = mam.id_to_app[mp_app_id].order_book.best_offer(lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING))
+    logger.info("Best {}/{} offer: id {}, {} for {}".format(lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING), *best_offer))
     logger.info("Matching offer on marketplace with account {}".format(account_address_1_str))
-    payload_match_marketplace_payload = payload_match_marketplace(account_address_2, 0)
+    payload_match_marketplace_payload = payload_match_marketplace(best_offer[0])
     execute(account_address_1, mp_app_id, 3, payload_match_marketplace_payload)
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
+    mam.mine_block()
+
+    logger.info("Listing offers 10 {} for 3 {} and 10 {} for 2 {} on marketplace with account {}".format(lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING), lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING), account_address_2_str))
+    execute(account_address_2, mp_app_id, 2, payload_list_marketplace(lama_token, 10, fiat_token, 3))
+    execute(account_address_2, mp_app_id, 2, payload_list_marketplace(lama_token, 10, fiat_token, 2))
+    invalid_offer_id = MarketPlace.parse_app_storage(mam.app_storage.read(mp_app_id))[3]
+    logger.info("Listing offer {} of 1 {} for 0 NOPE, a token that does not exist, with account {}".format(invalid_offer_id, lama_token.decode(STR_ENCODING), account_address_2_str))
+    execute(account_address_2, mp_app_id, 2, payload_list_marketplace(lama_token, 1, 'NOPE'.encode(STR_ENCODING), 0))
+
+    mam.mine_block()
+
+    logger.info("Batch matching invalid offer {} with account {}".format(invalid_offer_id, account_address_1_str))
+    execute(account_address_1, mp_app_id, 5, payload_match_marketplace(invalid_offer_id))
+    batch_offer_ids = []
+    for offer_id, goods_amount, price_amount in mam.id_to_app[mp_app_id].order_book.iter_offers(lama_token.decode(STR_ENCODING), fiat_token.decode(STR_ENCODING)):
+        batch_offer_ids.append(offer_id)
+        logger.info("Batch matching offer {} ({} {} for {} {}) with account {}".format(offer_id, goods_amount, lama_token.decode(STR_ENCODING), price_amount, fiat_token.decode(STR_ENCODING), account_address_1_str))
+        execute(account_address_1, mp_app_id, 5, payload_match_marketplace(offer_id))
+    logger.info("Clearing marketplace batch at the end of the block")
+    assert len(mam.mine_block()) == 0
+    # the invalid match is skipped without blocking the others and the queue is emptied
+    assert all(len(mam.app_storage.read(MarketPlace.offer_storage_key(mp_app_id, offer_id))) == 0 for offer_id in batch_offer_ids)
+    assert len(mam.app_storage.read(MarketPlace.offer_storage_key(mp_app_id, invalid_offer_id))) > 0
+    assert MAM.unpack_int(mam.app_storage.read(MarketPlace.batch_queue_storage_key(mp_app_id))) == 0
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
     logger.info("Sending msg 'Hello' to 'world' with account {}".format(account_address_2_str))
     send_msg_payload = payload_send_msg('world'.encode(STR_ENCODING), 'Hello !'.encode(STR_ENCODING))
     execute(account_address_2, chat_app_id, 1, send_msg_payload)
+    logger.info("Sending msg 'Hi' to 'world' with account {}".format(account_address_1_str))
+    execute(account_address_1, chat_app_id, 1, payload_send_msg('world'.encode(STR_ENCODING), 'Hi'.encode(STR_ENCODING)))
+    for sender, msg in mam.id_to_app[chat_app_id].read_inbox('world'.encode(STR_ENCODING), 0, 10):
+        logger.info("Inbox of 'world': {} from {}".format(msg.decode(STR_ENCODING), sender.hex()))
+
+    for bnum, event in mam.event_log.query(0, mam.blockchain.bnum, app_id=amm_app_id, topics=[b'Swap', payload_pool(fiat_token, lama_token)]):
+        logger.info("Swap on pool {}/{} at block {}: {}".format(fiat_token.decode(STR_ENCODING), lama_token.decode(STR_ENCODING), bnum, event))
+
+    holder_index = mam.id_to_app[assets_app_id].holder_index
+    for token in tokens:
+        logger.info("{}: {} holders, circulating supply {}, top holders {}".format(token, holder_index.holder_count(token), holder_index.circulating_supply(token),
+                                                                                  ', '.join('{}={}'.format(address.hex(), balance) for address, balance in holder_index.top_holders(token, 3))))
     logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
     logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
-    mam.blockchain.mine_block()
-
+    mam.mine_block()
+
+    airdrop = sorted((secrets.token_bytes(12), 100) for i in range(100))
+    cursor_key = Assets.airdrop_cursor_storage_key(assets_app_id, lama_token)
+    logger.info("Airdropping {} to {} recipients by chunks of 40".format(lama_token.decode(STR_ENCODING), len(airdrop)))
+    interrupted = False
+    while True:
+        cursor = mam.app_storage.read(cursor_key)
+        start = len(cursor) <= 0
+        chunk = [(recipient, amount) for recipient, amount in airdrop if start or recipient > cursor][:40]
+        if len(chunk) <= 0:
+            break
+        payload = payload_bulk_mint(lama_token, chunk, start)
+        gas_used, gas_cost, error, events = mam.call(True, account_address_1, None, assets_app_id, 6, payload)
+        if error is not None:
+            raise Exception("Error on dry run:\t{}".format(error))
+        if not start and not interrupted:
+            gas_used //= 2  # simulate an interrupted airdrop, the next chunk resumes from the cursor
+            interrupted = True
+        gas_used, gas_cost, error, events = mam.call(False, account_address_1, gas_used, assets_app_id, 6, payload)
+        logger.info("Chunk of {} recipients after {}: {} gas{}".format(len(chunk), cursor.hex() if not start else 'start', gas_used, '' if error is None else ', ' + error.strip().splitlines()[-1]))
+        mam.mine_block()
+    logger.info("{}: {} holders".format(lama_token.decode(STR_ENCODING), mam.id_to_app[assets_app_id].holder_index.holder_count(lama_token.decode(STR_ENCODING))))
+
+    mam.rent_engine = RentEngine()
+    for address in [account_address_1, account_address_2]:
+        logger.info("Account {}: {} bytes ({} bytes of Assets), rent due {}".format(address.hex(), mam.storage_sizes.account_size(address), mam.storage_sizes.account_app_size(address, assets_app_id),
+                                                                                mam.rent_engine.rent_due(mam.storage_sizes, address)))
+    logger.info("Mining up to neo genesis block {} to charge storage rent".format(NEO_GENESIS_INTERVAL))
+    while mam.blockchain.bnum < NEO_GENESIS_INTERVAL:
+        mam.mine_block()
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info('\n{}'.format(get_address_info_log(account_address_2, mam, tokens)))
 
+    signer = Signer(secrets.token_bytes(32))
+    gas_used, gas_cost, error, events = mam.call(False, signer.address, 0, MCM_APP_ID, 2, payload_transfer_mcm([(1, account_address_2)]))
+    assert error is not None and len(mam.account_storage.read(signer.address)) == 0  # no phantom account for an unknown caller
+    logger.info("Creating WOTS signed address {} with account {}".format(signer.address.hex(), account_address_1_str))
+    execute(account_address_1, MCM_APP_ID, 1, payload_create_address(signer.address, 100_000))
+    envelopes = [signer.sign(1000, MCM_APP_ID, 2, payload_transfer_mcm([(1_000 * (i + 1), account_address_2)])) for i in range(4)]
+    verifier = SignatureVerifier(processes=2)
+    verifier.verify(envelopes)  # mempool validation
+    for gas_used, gas_cost, error, events in mam.call_transactions(envelopes, verifier, batch_size=2):
+        logger.info("Signed transfer: {} gas{}".format(gas_used, '' if error is None else ', ' + error.strip().splitlines()[-1]))
+    logger.info("Signature cache: {} hits, {} misses".format(verifier.hits, verifier.misses))
+    for gas_used, gas_cost, error, events in mam.call_transactions([envelopes[0], b'\x00garbage'], verifier):
+        logger.info("Rejected transaction: {} gas, {}".format(gas_used, error.strip().splitlines()[-1]))
+    verifier.close()
+    logger.info('\n{}'.format(get_address_info_log(signer.address, mam, tokens)))
+
+    logger.info("Writes since genesis: {}".format(mam.write_stats))
+    stored_value = mam.account_storage.read(account_address_2)
+    for value in [stored_value[:-8], stored_value[:-8] + bytes(3), stored_value + bytes(5)]:  # a value patched in place is truncated when it shrinks
+        ranges = Storage.changed_ranges(stored_value, value)
+        assert Storage.apply_ranges(stored_value, value, ranges) == value
+        logger.info("Changed ranges of a {} bytes value rewritten on {} bytes: {}".format(len(stored_value), len(value), ranges))
+    logger.info("App storage cache: {}".format(mam.app_storage.cache))
+    logger.info("Account storage cache: {}".format(mam.account_storage.cache))
+    logger.info("Account filter: {}".format(mam.account_storage.backend))
+
+    mam.mine_block()
+    bnum = mam.blockchain.bnum
+    trailer = mam.blockchain.trailers[-1]
+    logger.info("Block {} trailer: hash {}, state root {}, {} transactions".format(trailer.bnum, trailer.block_hash.hex(), trailer.state_root.hex(), trailer.tx_count))
+    balance = mam.balance_ledger.get(account_address_1)
+    logger.info("Block {} logged: {} blocks since the last checkpoint, {} fsyncs, {} bytes logged".format(bnum, wal.logged_blocks, wal.fsyncs, wal.bytes_logged))
+    execute(account_address_1, MCM_APP_ID, 2, payload_transfer_mcm([(10_000, account_address_2)]))
+    wal.f.write(WAL_MAGIC + (bnum + 1).to_bytes(BNUM_LENGTH, INT_ENCODING))  # the node crashes while logging the block
+    wal.close()
+    MAM.INSTANCE = None
+    start = time.perf_counter()
+    wal = WriteAheadLog.recover(wal_path)
+    mam = wal.mam
+    logger.info("Node recovered at block {} in {:.1f} ms, MCM balance of {}: {} (expected {})".format(mam.blockchain.bnum, (time.perf_counter() - start) * 1000, account_address_1_str,
+                                                                                                   mam.balance_ledger.get(account_address_1), balance))
+    assert mam.blockchain.bnum == bnum and mam.balance_ledger.get(account_address_1) == balance
+
+    undo_log = UndoLog(mam)
+    state_root = mam.state_root.digest()
+    for i in range(3):  # blocks of a fork that loses the race
+        mam.create_instance(chat_template.type)
+        execute(account_address_1, MCM_APP_ID, 2, payload_transfer_mcm([(1_000 * (i + 1), account_address_2)]))
+        mam.mine_block()
+    start = time.perf_counter()
+    restored = undo_log.rollback(3)
+    logger.info("Rolled back 3 blocks to block {} in {:.1f} ms, {} keys restored, MCM balance of {}: {} (expected {})".format(mam.blockchain.bnum, (time.perf_counter() - start) * 1000, restored,
+                                                                                                                        account_address_1_str, mam.balance_ledger.get(account_address_1), balance))
+    assert mam.blockchain.bnum == bnum and mam.state_root.digest() == state_root and mam.next_instance_id == chat_app_id + 1
+
+    estimation_snapshot_path = os.path.join(tempfile.mkdtemp(), 'estimation.snapshot')
+    Snapshot.save(mam, estimation_snapshot_path)
+    estimator = GasEstimator(estimation_snapshot_path, processes=2)
+    requests = [(account_address_2, assets_app_id, 3, payload_transfer_token(lama_token, 1_000, account_address_1)),
+                (account_address_1, chat_app_id, 1, payload_send_msg('world'.encode(STR_ENCODING), 'Estimated'.encode(STR_ENCODING))),
+                (account_address_1, MCM_APP_ID, 1, payload_create_address(signer.address, 100_000))]
+    pending = estimator.submit(requests)
+    execute(account_address_1, MCM_APP_ID, 2, payload_transfer_mcm([(1_000, account_address_2)]))  # the node keeps applying transactions meanwhile
+    for (caller, app_id, function_selector, function_param), (gas_used, error) in zip(requests, estimator.collect(pending)):
+        logger.info("Estimated gas of app {} selector {}: {}{}".format(app_id, function_selector, gas_used, '' if error is None else ', ' + error.strip().splitlines()[-1]))
+    estimator.close()
+
+    snapshot_path = os.path.join(tempfile.mkdtemp(), 'mip12.snapshot')
+    Snapshot.save(mam, snapshot_path)
+    logger.info("Snapshot of block {} written to {} ({} bytes)".format(mam.blockchain.bnum, snapshot_path, os.path.getsize(snapshot_path)))
+    MAM.INSTANCE = None  # the node restarts from the snapshot
+    start = time.perf_counter()
+    mam = Snapshot.load(snapshot_path)
+    logger.info("Node restarted from the snapshot at block {} in {:.1f} ms".format(mam.blockchain.bnum, (time.perf_counter() - start) * 1000))
+    logger.info('\n{}'.format(get_address_info_log(account_address_1, mam, tokens)))
+    logger.info("{}: {} holders".format(lama_token.decode(STR_ENCODING), mam.id_to_app[assets_app_id].holder_index.holder_count(lama_token.decode(STR_ENCODING))))
+    logger.info("Sending msg 'Back' to 'world' with account {}".format(account_address_1_str))
+    execute(account_address_1, chat_app_id, 1, payload_send_msg('world'.encode(STR_ENCODING), 'Back'.encode(STR_ENCODING)))
+    for sender, msg in mam.id_to_app[chat_app_id].read_inbox('world'.encode(STR_ENCODING), 0, 10):
+        logger.info("Inbox of 'world': {} from {}".format(msg.decode(STR_ENCODING), sender.hex()))
+    logger.info("Snapshot account storage cache: {}".format(mam.account_storage.cache))
+    logger.info("Snapshot account filter: {}".format(mam.account_storage.backend))
+
+    MAM.INSTANCE = None  # a marketplace holding many offers
+    mam = MAM(Storage(), Storage())
+    mam.add_app_template(assets_template)
+    assets_app_id = mam.create_instance(assets_template.type)
+    mam.add_app_template(mp_template)
+    mp_app_id = mam.create_instance(mp_template.type)
+    mam.account_storage.write(account_address_1, MAM.account_array_to_bytes([MCM_APP_ID.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(MCM.BALANCE_LENGTH) + int(10 ** 12).to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)]))
+    for app_id, function_selector, function_param in [(assets_app_id, 1, payload_create_token(lama_token, account_address_1)), (assets_app_id, 2, payload_mint_token(lama_token, 1_000_000, account_address_1)),
+                                                      (mp_app_id, 1, payload_create_marketplace())]:
+        mam.call(False, account_address_1, 10 ** 6, app_id, function_selector, function_param)
+    offer_count = 2_000
+    start = time.perf_counter()
+    for i in range(offer_count):
+        gas_used, gas_cost, error, events = mam.call(False, account_address_1, 10 ** 6, mp_app_id, 2, payload_list_marketplace(lama_token, 1, lama_token, 1 + i))
+        assert error is None, error
+    order_book = mam.id_to_app[mp_app_id].order_book
+    logger.info("Listed {} offers on a single marketplace in {:.1f} ms: {} bytes of app storage out of {}, best offer {}".format(offer_count, (time.perf_counter() - start) * 1000,
+                                                                                                                            mam.storage_sizes.app_size(mp_app_id), mam.id_to_app[mp_app_id].get_max_storage(),
+                                                                                                                            order_book.best_offer(lama_token.decode(STR_ENCODING), lama_token.decode(STR_ENCODING))))
+    assert len(order_book.offers) == offer_count
+
+    chain = Blockchain()
+    for i in range(24 * 3600 // 42):  # a day of blocks
+        chain.mine_block(secrets.token_bytes(32), i * 42)
+    peer = LocalPeer(chain.trailers)
+    synced_chain = Blockchain()
+    start = time.perf_counter()
+    TrailerSync(peer).sync(synced_chain)
+    logger.info("Synced {} trailers in {:.1f} ms with {} requests ({:.1f} ms per round trip), last hash {}".format(synced_chain.bnum, (time.perf_counter() - start) * 1000, peer.requests,
+                                                                                                        peer.latency * 1000, synced_chain.last_hash.hex()))
+    assert synced_chain.last_hash == chain.last_hash
+
+    MAM.INSTANCE = None  # a node in sharded mode, the MCM transactions are executed by the shard processes
+    sharded_storage = ShardedStorage(4)
+    mam = MAM(Storage(), sharded_storage)
+    coordinator = ShardCoordinator(mam, sharded_storage)
+    accounts = [bytes([shard * 0x40 + i]) + bytes(11) for shard in range(4) for i in range(2)]  # two accounts on each shard
+    mam.account_storage.write_batch([(address, value, [(0, len(value))]) for address, value in
+                                     ((address, MAM.account_array_to_bytes([MCM_APP_ID.to_bytes(APP_INSTANCE_ID_LENGTH, INT_ENCODING) + MAM.pack_length(MCM.BALANCE_LENGTH) + int(100_000).to_bytes(MCM.BALANCE_LENGTH, INT_ENCODING)]))
+                                      for address in accounts)])
+    logger.info("Sharded mode: accounts {} on shards {}".format(', '.join(address.hex() for address in accounts), [sharded_storage.shard(address) for address in accounts]))
+    transactions = [(accounts[i % len(accounts)], 5_000, 2, payload_transfer_mcm([(100 + i, accounts[(i + 1 + i // len(accounts)) % len(accounts)])])) for i in range(64)]
+    transactions.append((accounts[0], 5_000, 2, payload_transfer_mcm([(1_000, accounts[1]), (2_000, accounts[2]), (3_000, accounts[4]), (4_000, accounts[6])])))  # four shards
+    start = time.perf_counter()
+    results = coordinator.call_transactions(transactions)
+    logger.info("{} transactions in {:.1f} ms: {} single shard, {} cross shard".format(len(transactions), (time.perf_counter() - start) * 1000, coordinator.single_shard_transactions,
+                                                                                      coordinator.cross_shard_transactions))
+    assert all(error is None for gas_used, gas_cost, error, events in results)
+    balances = [MCM.get_account_balance(mam.account_storage.read(address)) for address in accounts]
+    assert sum(balances) == 100_000 * len(accounts) - sum(gas_cost for gas_used, gas_cost, error, events in results)
+    assert balances == [mam.balance_ledger.get(address) for address in accounts]  # the node indexes follow the writes of the shards
+    state_root = StateRoot()
+    for address, value in sharded_storage.items():
+        state_root.update(MAM.encode_storage_key(address), bytes(0), value)
+    assert state_root.digest() == mam.state_root.digest()
+
+    tx_id = next(sharded_storage.tx_ids)
+    locked_keys = {sharded_storage.shard(accounts[0]): [accounts[0]]}
+    sharded_storage.prepare(tx_id, locked_keys)  # a cross shard transaction left prepared
+    transfers = [(accounts[1], 5_000, 2, payload_transfer_mcm([(500, accounts[0])])), (accounts[2], 5_000, 2, payload_transfer_mcm([(500, accounts[0])]))]  # same shard, cross shard
+    for gas_used, gas_cost, error, events in coordinator.call_transactions(transfers):
+        logger.info("Transfer to an account locked by transaction {}: {}".format(tx_id, error))
+        assert error is not None
+    assert [MCM.get_account_balance(mam.account_storage.read(address)) for address in accounts] == balances
+    sharded_storage.abort(tx_id, locked_keys)
+    assert all(error is None for gas_used, gas_cost, error, events in coordinator.call_transactions(transfers))
+    trailer = mam.blockchain.mine_block(mam.state_root.digest())
+    logger.info("Sharded block {}: {} transactions, state root {}".format(trailer.bnum, trailer.tx_count, trailer.state_root.hex()))
+    logger.info("Balances: {}".format(', '.join('{}={}'.format(address.hex(), MCM.get_account_balance(mam.account_storage.read(address))) for address in accounts)))
+    logger.info("{} shard reads, {} single and {} cross shard batches, {} aborts, shard sizes {}".format(sharded_storage.reads, sharded_storage.single_shard_batches,
+                                                                                                        sharded_storage.cross_shard_batches, sharded_storage.aborts, sharded_storage.sizes()))
+    sharded_storage.close()